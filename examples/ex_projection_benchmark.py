@@ -0,0 +1,41 @@
+import time
+import torch
+from src.attacks import project_onto_ball, project_onto_l1_ball_sort, steepest_ascent_direction
+
+
+def kthvalue_l1_direction(grads):
+    """
+    The previous l1 steepest ascent step, thresholding at the kth value over all coordinates.
+    """
+    keep_vals = torch.kthvalue(grads.abs(), k=grads.shape[1] * 15 // 16, dim=1).values
+    grads[torch.abs(grads) < keep_vals.unsqueeze(1)] = 0
+    grads = torch.sign(grads)
+    grads_norm = torch.norm(grads, dim=1, p=1)
+    return grads / (grads_norm.unsqueeze(1) + 1e-8)
+
+
+def benchmark(fn, x, repeats=10):
+    fn(x.clone())
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(x.clone())
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+
+    torch.manual_seed(0)
+    batch_size, eps = 64, 1.0
+
+    print("dim\tsort (ms)\tpivot (ms)\tkthvalue (ms)\ttopk (ms)")
+    for dim in [784, 3 * 32 * 32, 3 * 224 * 224]:
+        # perturbations a little outside the ball, as after a PGD step
+        x = torch.randn(batch_size, dim)
+        x = 1.2 * eps * x / x.norm(p=1, dim=1, keepdim=True)
+        assert torch.allclose(project_onto_ball(x, eps, 1), project_onto_l1_ball_sort(x, eps),
+                              atol=1e-6)
+        times = [benchmark(lambda x: project_onto_l1_ball_sort(x, eps), x),
+                 benchmark(lambda x: project_onto_ball(x, eps, 1), x),
+                 benchmark(kthvalue_l1_direction, x),
+                 benchmark(lambda x: steepest_ascent_direction(x, 1), x)]
+        print(f"{dim}\t" + "\t".join(f"{1000 * t:.1f}" for t in times))
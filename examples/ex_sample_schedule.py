@@ -0,0 +1,62 @@
+import os
+import pickle
+import time
+import torch
+from argparse import ArgumentParser
+from torch.utils.data import DataLoader, Subset
+from src.attacks import *
+from src.noises import *
+from src.models import *
+from src.datasets import get_dataset, get_dim, get_stratified_indices
+from src.utils import parse_noise_from_args
+
+
+if __name__ == "__main__":
+
+    argparser = ArgumentParser(description="Compare a fixed number of noise samples per PGD step "
+                                           "against an annealed schedule on a trained model.")
+    argparser.add_argument("--device", default="cuda", type=str)
+    argparser.add_argument("--experiment-name", default="cifar", type=str)
+    argparser.add_argument("--size", default=200, type=int)
+    argparser.add_argument("--batch-size", default=16, type=int)
+    argparser.add_argument("--eps", default=0.5, type=float)
+    argparser.add_argument("--steps", default=20, type=int)
+    argparser.add_argument("--sample-size", default=128, type=int)
+    argparser.add_argument("--sample-size-min", default="8,16,32", type=str)
+    argparser.add_argument("--sample-size-pred", default=256, type=int)
+    argparser.add_argument("--noise-batch-size", default=512, type=int)
+    argparser.add_argument("--output-dir", type=str, default=os.getenv("PT_OUTPUT_DIR"))
+    args = argparser.parse_args()
+
+    experiment_path = f"{args.output_dir}/{args.experiment_name}"
+    exp_args = pickle.load(open(f"{experiment_path}/args.pkl", "rb"))
+    model = eval(exp_args.model)(dataset=exp_args.dataset, device=args.device)
+    model.load_state_dict(torch.load(f"{experiment_path}/model_ckpt.torch",
+                                     map_location=args.device))
+    model.eval()
+    noise = parse_noise_from_args(exp_args, device=args.device, dim=get_dim(exp_args.dataset))
+    adv = getattr(exp_args, "adv", 2)
+
+    test_dataset = get_dataset(exp_args.dataset, "test")
+    loader = DataLoader(Subset(test_dataset, get_stratified_indices(test_dataset, args.size)),
+                        batch_size=args.batch_size)
+
+    print("schedule\tsuccess rate\tsecs")
+    for sample_size_min in [None] + [int(s) for s in args.sample_size_min.split(",")]:
+        schedule = sample_size_schedule(args.sample_size, args.steps, sample_size_min)
+        torch.manual_seed(0)
+        fooled, secs = 0, 0.
+        for x, y in loader:
+            x, y = x.to(args.device), y.to(args.device)
+            start = time.time()
+            x_adv, _ = pgd_attack_smooth(model, x, y, args.eps, noise, args.sample_size,
+                                         steps=args.steps, adv=adv,
+                                         noise_batch_size=args.noise_batch_size,
+                                         detach_loss=True, sample_size_min=sample_size_min)
+            secs += time.time() - start
+            with torch.no_grad():
+                preds = smooth_predict_hard(model, x_adv, noise, args.sample_size_pred,
+                                            args.noise_batch_size).probs.argmax(dim=1)
+            fooled += (preds != y).sum().item()
+        print(f"{schedule[0]}->{schedule[-1]} ({sum(schedule)} forwards/example)\t"
+              f"{fooled / len(loader.dataset):.3f}\t{secs:.1f}")
@@ -0,0 +1,44 @@
+import time
+import torch
+from argparse import ArgumentParser, Namespace
+from src.train_sweep import SweepTrainer, StackedSweepTrainer
+
+
+def benchmark(trainer, x, y, steps):
+    for _ in range(3):
+        trainer.step(x, y)
+    start = time.perf_counter()
+    for _ in range(steps):
+        trainer.step(x, y)
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == "__main__":
+
+    argparser = ArgumentParser(description="Time a training step of a sigma sweep, looping over "
+                                           "the models (SweepTrainer) against one stacked step "
+                                           "(StackedSweepTrainer).")
+    argparser.add_argument("--models", default="LinearModel,MLP,LeNet", type=str)
+    argparser.add_argument("--num-runs", default="12,45", type=str)
+    argparser.add_argument("--batch-sizes", default="16,64", type=str)
+    argparser.add_argument("--steps", default=10, type=int)
+    argparser.add_argument("--num-threads", default=None, type=int)
+    args = argparser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    print(f"threads: {torch.get_num_threads()}")
+    print("model\truns\tbatch\tloop (ms)\tstacked (ms)\tspeedup")
+    for model in args.models.split(","):
+        for num_runs in [int(k) for k in args.num_runs.split(",")]:
+            run_args = [Namespace(model=model, dataset="mnist", device="cpu", lr=0.01,
+                                  num_epochs=1, print_every=10 ** 9, save_every=10 ** 9,
+                                  noise="GaussianNoise", sigma=0.1 * (k + 1), lambd=None, k=None,
+                                  j=None, a=None, experiment_name=f"run{k}", output_dir=None)
+                        for k in range(num_runs)]
+            for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+                x, y = torch.rand(batch_size, 1, 28, 28), torch.randint(0, 10, (batch_size,))
+                times = [benchmark(trainer_cls(run_args, 10 ** 6), x, y, args.steps)
+                         for trainer_cls in (SweepTrainer, StackedSweepTrainer)]
+                print(f"{model}\t{num_runs}\t{batch_size}\t{1000 * times[0]:.1f}\t"
+                      f"{1000 * times[1]:.1f}\t{times[0] / times[1]:.2f}")
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.autograd import grad
@@ -7,101 +8,300 @@ from src.smooth import *
 def project_onto_ball(x, eps, p="inf"):
     """
     Note that projection onto inf-norm and 2-norm take O(d) time, and projection onto 1-norm
-    takes O(dlogd) using the sorting-based algorithm given in [Duchi et al. 2008].
+    takes expected O(d) time using the pivoting algorithm of [Michelot 1986; Condat 2016].
+    eps is either a float or a tensor with one radius per row of x.
     """
     original_shape = x.shape
     x = x.view(x.shape[0], -1)
     assert not torch.isnan(x).any()
+    if torch.is_tensor(eps):
+        eps = eps.to(x).view(-1)
     if p == "inf":
-        x = x.clamp(-eps, eps)
+        x = x.clamp(-eps, eps) if not torch.is_tensor(eps) else \
+            torch.max(torch.min(x, eps.unsqueeze(1)), -eps.unsqueeze(1))
+    elif p == 2 and torch.is_tensor(eps):
+        norms = torch.norm(x, p=2, dim=1)
+        x = x * (eps / (norms + 1e-7)).clamp(max=1).unsqueeze(1)
     elif p == 2:
         x = x.renorm(p=2, dim=0, maxnorm=eps)
     elif p == 1:
-        mask = (torch.norm(x, p=1, dim=1) < eps).float().unsqueeze(1)
-        mu, _ = torch.sort(torch.abs(x), dim=1, descending=True)
-        cumsum = torch.cumsum(mu, dim=1)
-        arange = torch.arange(1, x.shape[1] + 1, device=x.device)
-        rho, _ = torch.max((mu * arange > (cumsum - eps)) * arange, dim=1)
-        theta = (cumsum[torch.arange(x.shape[0]), rho.cpu() - 1] - eps) / rho
-        proj = (torch.abs(x) - theta.unsqueeze(1)).clamp(min=0)
-        x = mask * x + (1 - mask) * proj * torch.sign(x)
+        v = torch.abs(x)
+        # the soft threshold theta solves sum((v - theta)+) = eps; starting from a lower bound,
+        # each pass recomputes it over the coordinates still above it, and the active set only
+        # shrinks until it is exact
+        theta = torch.maximum((v.sum(dim=1) - eps) / v.shape[1], v.max(dim=1).values - eps)
+        theta = theta.clamp(min=0)
+        count = None
+        while True:
+            active = v > theta.unsqueeze(1)
+            new_count = active.sum(dim=1)
+            if count is not None and torch.equal(new_count, count):
+                break
+            count = new_count
+            theta = ((v * active).sum(dim=1) - eps) / count
+        theta = torch.where(v.sum(dim=1) > eps, theta, torch.zeros_like(theta))
+        x = torch.sign(x) * (v - theta.unsqueeze(1)).clamp(min=0)
     else:
         raise ValueError("Can only project onto 1,2,inf norm balls.")
     return x.view(original_shape)
 
-def pgd_attack(model, x, y, eps, steps=20, adv="inf", clamp=(0, 1)):
-    """
-    Attack a model with PGD.
-    """
-    step_size = 2 * eps / steps
-    x.requires_grad = True
-    x_orig = x.clone().detach()
-
-    for _ in range(steps):
-        loss = model.loss(x, y).mean()
-        grads = grad(loss, x)[0].reshape(x.shape[0], -1)
-        if adv == 1:
-            keep_vals = torch.kthvalue(grads.abs(), k=grads.shape[1] * 15 // 16, dim=1).values
-            grads[torch.abs(grads) < keep_vals.unsqueeze(1)] = 0
-            grads = torch.sign(grads)
-            grads_norm = torch.norm(grads, dim=1, p=1)
-            grads = grads / (grads_norm.unsqueeze(1) + 1e-8)
-        elif adv == 2:
-            grads_norm = torch.norm(grads, dim=1, p=2)
-            grads = grads / (grads_norm.unsqueeze(1) + 1e-8)
-        elif adv == "inf":
-            grads = torch.sign(grads)
+def project_onto_l1_ball_sort(x, eps):
+    """
+    Sorting-based O(dlogd) projection onto the 1-norm ball [Duchi et al. 2008], kept as a
+    reference for project_onto_ball(p=1).
+    """
+    original_shape = x.shape
+    x = x.view(x.shape[0], -1)
+    mask = (torch.norm(x, p=1, dim=1) < eps).float().unsqueeze(1)
+    mu, _ = torch.sort(torch.abs(x), dim=1, descending=True)
+    cumsum = torch.cumsum(mu, dim=1)
+    arange = torch.arange(1, x.shape[1] + 1, device=x.device)
+    rho, _ = torch.max((mu * arange > (cumsum - eps)) * arange, dim=1)
+    theta = (cumsum[torch.arange(x.shape[0]), rho.cpu() - 1] - eps) / rho
+    proj = (torch.abs(x) - theta.unsqueeze(1)).clamp(min=0)
+    x = mask * x + (1 - mask) * proj * torch.sign(x)
+    return x.view(original_shape)
+
+def steepest_ascent_direction(grads, adv):
+    """
+    Normalized steepest ascent direction for an l1, l2 or linf adversary, given (n x d) gradients.
+    For l1 this is the sign of the top 1/16 of coordinates by magnitude, spread evenly.
+    """
+    if adv == 1:
+        k = grads.shape[1] - grads.shape[1] * 15 // 16 + 1
+        top = torch.topk(grads.abs(), k, dim=1, sorted=False).indices
+        return torch.zeros_like(grads).scatter_(1, top, torch.sign(grads.gather(1, top)) / k)
+    elif adv == 2:
+        grads_norm = torch.norm(grads, dim=1, p=2)
+        return grads / (grads_norm.unsqueeze(1) + 1e-8)
+    elif adv == "inf":
+        return torch.sign(grads)
+    raise ValueError
+
+def sample_size_schedule(sample_size, steps, sample_size_min=None):
+    """
+    Number of noise samples per example at each PGD step, growing geometrically from
+    sample_size_min to sample_size: early steps only need a rough ascent direction, the last
+    ones an accurate one. Without sample_size_min every step uses sample_size.
+
+    Returns
+    -------
+    schedule: list of ints, one per step
+    """
+    if sample_size_min is None or steps <= 1:
+        return [sample_size] * steps
+    sizes = np.geomspace(min(sample_size_min, sample_size), sample_size, steps)
+    return [int(round(size)) for size in sizes]
+
+def _pgd(loss_fn, x, y, eps, steps, adv, clamp, delta_init=None, restarts=1, early_stop=False):
+    """
+    PGD engine shared by the attacks below. The restarts form an extra (leading) batch dimension,
+    the first restart starting from delta_init (or x) and the others from random points of the
+    ball. With early_stop, an example leaves the active batch as soon as one of its restarts
+    changes the prediction, so later steps only run on the examples that still need them.
+
+    loss_fn(x, y, rows, step) gives the per-example losses, predicted labels and loss gradients
+    with respect to x for the given rows of the (restarts * n) batch, at the given step (None for
+    the final choice between restarts).
+
+    Returns
+    -------
+    x_adv: (n x ...) adversarial examples, from a successful restart if any, otherwise from the
+           one with the highest loss
+    rows: the row of the (restarts * n) batch that each adversarial example comes from
+    steps_used: number of gradient steps spent on each example, summed over restarts
+    """
+    n = x.shape[0]
+    ones = (1,) * (x.dim() - 1)
+    x_orig = x.detach().repeat(restarts, *ones)
+    y = y.repeat(restarts)
+    if torch.is_tensor(eps):
+        eps = eps.to(x_orig).repeat(restarts)
+        step_size = (2 * eps / steps).view(torch.Size([-1]) + ones)
+        eps_col = eps.view(torch.Size([-1]) + ones)
+    else:
+        step_size, eps_col = 2 * eps / steps, eps
+
+    delta = torch.zeros_like(x_orig)
+    if delta_init is not None:
+        delta[:n] = delta_init.detach().to(x_orig.dtype)
+    if restarts > 1:
+        directions = steepest_ascent_direction(torch.randn_like(x_orig[n:]).reshape(
+            len(x_orig) - n, -1), adv).reshape(x_orig[n:].shape)
+        directions = directions / directions.reshape(len(directions), -1).norm(
+            p=adv if adv != "inf" else float("inf"), dim=1).view(torch.Size([-1]) + ones)
+        delta[n:] = directions * torch.rand_like(directions[:, :1]) * \
+                    (eps_col[n:] if torch.is_tensor(eps_col) else eps_col)
+    x_adv = (x_orig + project_onto_ball(delta, eps, adv)).clamp(*clamp)
+
+    active = torch.arange(len(x_orig), device=x.device)
+    steps_used = torch.zeros(len(x_orig), dtype=torch.long, device=x.device)
+    success = torch.zeros(len(x_orig), dtype=torch.bool, device=x.device)
+
+    for t in range(steps):
+        x_active = x_adv[active]
+        losses, preds, grads = loss_fn(x_active, y[active], active, t)
+        flipped = preds != y[active]
+        if early_stop:
+            success[active[flipped]] = True
+            done = success.view(restarts, n).any(dim=0).repeat(restarts)
+            stepping = ~done[active]
+            if not stepping.any():
+                break
         else:
-            raise ValueError
-        diff = x + step_size * grads.reshape(x.shape) - x_orig
-        diff = project_onto_ball(diff, eps, adv)
-        x = (x_orig + diff).clamp(*clamp)
+            stepping = torch.ones_like(flipped)
+        grads = steepest_ascent_direction(grads.reshape(len(active), -1), adv)
+        grads = grads.reshape(x_active.shape)
+        rows = active[stepping]
+        step = step_size[rows] if torch.is_tensor(step_size) else step_size
+        diff = x_active[stepping] + step * grads[stepping] - x_orig[rows]
+        diff = project_onto_ball(diff, eps[rows] if torch.is_tensor(eps) else eps, adv)
+        x_adv[rows] = (x_orig[rows] + diff).clamp(*clamp)
+        steps_used[rows] += 1
+        active = rows
 
+    if restarts > 1:
+        # pick a successful restart for each example, otherwise the one with the highest loss
+        scores = torch.full((len(x_orig),), -float("inf"), device=x.device)
+        remaining = ~success
+        if remaining.any():
+            rows = remaining.nonzero().squeeze(1)
+            scores[rows] = loss_fn(x_adv[rows], y[rows], rows, None)[0].detach()
+        scores[success] = float("inf")
+        rows = torch.arange(n, device=x.device) + n * scores.view(restarts, n).argmax(dim=0)
+    else:
+        rows = torch.arange(n, device=x.device)
+    return x_adv[rows].detach(), rows, steps_used.view(restarts, n).sum(dim=0)
+
+def pgd_attack(model, x, y, eps, steps=20, adv="inf", clamp=(0, 1), restarts=1, early_stop=False,
+               return_steps=False):
+    """
+    Attack a model with PGD, optionally with several random restarts and with examples leaving
+    the batch once misclassified.
+    """
+    def loss_fn(x, y, rows, step):
+        x = x.requires_grad_()
+        logits = model.forward(x)
+        losses = -model.forecast(logits).log_prob(y)
+        return losses.detach(), logits.argmax(dim=1), grad(losses.sum(), x)[0]
+
+    x, _, steps_used = _pgd(loss_fn, x, y, eps, steps, adv, clamp, restarts=restarts,
+                            early_stop=early_stop)
     loss = model.loss(x, y).mean()
-    x = x.detach()
-    x.requires_grad = False
-    return x, loss
+    return (x, loss, steps_used) if return_steps else (x, loss)
 
-def pgd_attack_smooth(model, x, y, eps, noise, sample_size, steps=20, adv="inf", clamp=(0, 1)):
+def pgd_attack_smooth(model, x, y, eps, noise, sample_size, steps=20, adv="inf", clamp=(0, 1),
+                      delta_init=None, restarts=1, early_stop=False, return_steps=False,
+                      noise_batch_size=512, detach_loss=False, sample_size_min=None):
     """
-    Attack a smoothed model with PGD.
+    Attack a smoothed model with PGD, optionally warm-started from the perturbation delta_init.
+    One draw of sample_size noise offsets per example is reused by every step (common random
+    numbers), so that the steps ascend the same objective. eps may be a tensor with one radius
+    per example.
+
+    With restarts > 1, random restarts run side by side in the batch; with early_stop, an example
+    stops being attacked once the soft smoothed prediction (on the same noise draws) is wrong.
+    return_steps additionally returns the number of gradient steps spent on each example.
+
+    The gradients are computed by smooth_loss_grad, holding at most noise_batch_size noisy
+    forwards per example at a time. The returned loss keeps its graph (for adversarial training)
+    unless detach_loss is set, in which case it is also computed noise_batch_size at a time.
+
+    With sample_size_min, the number of noise samples grows from sample_size_min at the first
+    step to sample_size at the last (see sample_size_schedule); each step uses a prefix of the
+    same offsets. The returned loss and the choice between restarts use all sample_size samples,
+    while early stopping goes by the current step's estimate.
     """
-    step_size = 2 * eps / steps
-    x.requires_grad = True
-    x_orig = x.clone().detach()
-    rng = torch.cuda.get_rng_state_all()
+    offsets = sample_noise_offsets(noise, x.detach().repeat(restarts, *(1,) * (x.dim() - 1)),
+                                   sample_size)
+    schedule = sample_size_schedule(sample_size, steps, sample_size_min)
 
-    for _ in range(steps):
-        torch.cuda.set_rng_state_all(rng)
-        forecast = smooth_predict_soft(model, x, noise, sample_size)
-        loss = -forecast.log_prob(y).mean()
-        grads = grad(loss, x)[0].reshape(x.shape[0], -1)
-        if adv == 1:
-            keep_vals = torch.kthvalue(grads.abs(), k=grads.shape[1] * 15 // 16, dim=1).values
-            grads[torch.abs(grads) < keep_vals.unsqueeze(1)] = 0
-            grads = torch.sign(grads)
-            grads_norm = torch.norm(grads, dim=1, p=1)
-            grads = grads / (grads_norm.unsqueeze(1) + 1e-8)
-        elif adv == 2:
-            grads_norm = torch.norm(grads, dim=1, p=2)
-            grads = grads / (grads_norm.unsqueeze(1) + 1e-8)
-        elif adv == "inf":
-            grads = torch.sign(grads)
-        else:
-            raise ValueError
-        diff = x + step_size * grads.reshape(x.shape) - x_orig
-        diff = project_onto_ball(diff, eps, adv)
-        x = (x_orig + diff).clamp(*clamp)
-#        forecast = smooth_predict_hard(model, x, noise, sample_size).probs
-#        print(_, (torch.argmax(forecast, dim=1) == y).sum() / float(x.shape[0]),
-#              diff.reshape(x.shape[0], -1).norm(dim=1, p=1).mean(),
-#              diff.reshape(x.shape[0], -1).norm(dim=1, p=2).mean())
-
-    torch.cuda.set_rng_state_all(rng)
-    forecast = smooth_predict_soft(model, x, noise, sample_size)
+    def loss_fn(x, y, rows, step):
+        size = sample_size if step is None else schedule[step]
+        losses, probs, grads = smooth_loss_grad(model, x, y, noise, size, noise_batch_size,
+                                                offsets=offsets[rows, :size])
+        return losses, probs.argmax(dim=1), grads
+
+    x, rows, steps_used = _pgd(loss_fn, x, y, eps, steps, adv, clamp, delta_init=delta_init,
+                               restarts=restarts, early_stop=early_stop)
+    with torch.set_grad_enabled(not detach_loss):
+        forecast = smooth_predict_soft(model, x, noise, sample_size, noise_batch_size,
+                                       offsets=offsets[rows])
     loss = -forecast.log_prob(y).mean()
+    return (x, loss, steps_used) if return_steps else (x, loss)
+
+def pgd_attack_smooth_multi_eps(model, x, y, eps_range, noise, sample_size, steps=20, adv="inf",
+                                clamp=(0, 1), warm_start=False, warm_steps=10, restarts=1,
+                                early_stop=False, return_steps=False, noise_batch_size=512,
+                                sample_size_min=None):
+    """
+    Attack a smoothed model at several radii with one batched PGD run, the radii being stacked
+    into the batch dimension. With warm_start, the largest radius is attacked first, and its
+    solution, projected onto each smaller ball, starts a shorter attack of warm_steps steps at
+    all the other radii. restarts, early_stop, noise_batch_size and sample_size_min are passed
+    on to pgd_attack_smooth.
+
+    Returns
+    -------
+    x_adv: list of adversarial examples, one (n x ...) tensor per radius in eps_range
+    steps_used: if return_steps, list of gradient steps spent on each example, one per radius
+    """
+    eps_range = list(eps_range)
+    stack = lambda t, k: t.repeat(k, *(1,) * (t.dim() - 1))
+    kwargs = dict(adv=adv, clamp=clamp, restarts=restarts, early_stop=early_stop,
+                  return_steps=True, noise_batch_size=noise_batch_size, detach_loss=True,
+                  sample_size_min=sample_size_min)
+    if not warm_start or len(eps_range) == 1:
+        x_adv, _, steps_used = pgd_attack_smooth(
+            model, stack(x, len(eps_range)), stack(y, len(eps_range)),
+            torch.tensor(eps_range).repeat_interleave(len(x)), noise, sample_size, steps=steps,
+            **kwargs)
+        x_adv, steps_used = list(x_adv.split(len(x))), list(steps_used.split(len(x)))
+        return (x_adv, steps_used) if return_steps else x_adv
+    largest = max(range(len(eps_range)), key=lambda k: eps_range[k])
+    rest = [eps for k, eps in enumerate(eps_range) if k != largest]
+    x_largest, _, steps_largest = pgd_attack_smooth(model, x, y, eps_range[largest], noise,
+                                                    sample_size, steps=steps, **kwargs)
+    x_rest, _, steps_rest = pgd_attack_smooth(
+        model, stack(x, len(rest)), stack(y, len(rest)),
+        torch.tensor(rest).repeat_interleave(len(x)), noise, sample_size, steps=warm_steps,
+        delta_init=stack(x_largest - x, len(rest)), **kwargs)
+    x_rest, steps_rest = list(x_rest.split(len(x))), list(steps_rest.split(len(x)))
+    x_adv = [x_largest if k == largest else x_rest.pop(0) for k in range(len(eps_range))]
+    # the warm-started radii also count the steps of the attack they started from
+    steps_used = [steps_largest if k == largest else steps_rest.pop(0) + steps_largest
+                  for k in range(len(eps_range))]
+    return (x_adv, steps_used) if return_steps else x_adv
 
-    x = x.detach()
-    x.requires_grad = False
-    return x, loss
+def free_adversarial_step(model, optimizer, x, y, eps, noise, sample_size, replays=4, adv="inf",
+                          delta=None, clamp=(0, 1), timer=None):
+    """
+    "Free" adversarial training step for a smoothed model [Shafahi et al. 2019]: the minibatch is
+    replayed several times, and the backward pass of every parameter update also yields the input
+    gradient used to take one ascent step on the perturbation.
+
+    If a PhaseTimer is given, every replay charges its forward, backward, parameter update and
+    ascent step to the "forward", "backward", "optimizer" and "noise" phases.
+
+    Returns
+    -------
+    loss: the loss at the last replay
+    delta: the perturbation after the last ascent step, to be carried over
+    """
+    delta = torch.zeros_like(x) if delta is None else delta
+    mark = timer.mark if timer is not None else lambda phase: None
+    for _ in range(replays):
+        x_adv = (x + delta).clamp(*clamp).requires_grad_()
+        forecast = smooth_predict_soft(model, x_adv, noise, sample_size)
+        loss = -forecast.log_prob(y).mean()
+        mark("forward")
+        optimizer.zero_grad()
+        loss.backward()
+        mark("backward")
+        optimizer.step()
+        mark("optimizer")
+        grads = steepest_ascent_direction(x_adv.grad.reshape(x.shape[0], -1), adv)
+        delta = project_onto_ball(delta + eps * grads.reshape(x.shape), eps, adv).detach()
+        mark("noise")
+    return loss, delta
 
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import pickle
+import time
+import numpy as np
+import torch
+from argparse import ArgumentParser
+from torch.utils.data import DataLoader, Subset
+from src.models import *
+from src.smooth import *
+from src.noises import *
+from src.datasets import get_dataset, get_dim, get_stratified_indices
+from src.utils import parse_noise_from_args, append_jsonl
+
+
+def get_final_epoch(experiment_path, exp_args):
+    """
+    Epoch of the final checkpoint: the last one trained, which is earlier than num_epochs - 1 if
+    training stopped on a validation plateau (recorded in early_stop.json).
+    """
+    early_stop_path = f"{experiment_path}/early_stop.json"
+    if os.path.exists(early_stop_path):
+        return json.load(open(early_stop_path))["end_epoch"] - 1
+    return exp_args.num_epochs - 1
+
+
+def certify_checkpoints(experiment_path, size=500, sample_size=1000, radii=(0.25, 0.5, 1.0),
+                        device="cpu", num_threads=1, poll_secs=10.0, batch_size=64,
+                        start_time=None):
+    """
+    Follow a training run and certify every checkpoint it saves, {epoch}/model_ckpt.torch as
+    well as the final model_ckpt.torch, on a fixed stratified subset of the test set.
+
+    Each result is appended to cert_acc_epochs.jsonl as soon as it is available; the whole
+    curve is saved to cert_acc_epochs.npy (one row per checkpoint: epoch, then the certified
+    accuracy at each radius) once the final checkpoint has been certified. Final checkpoints
+    older than start_time are taken to be left over from a previous run and ignored.
+    """
+    torch.set_num_threads(num_threads)
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    exp_args = pickle.load(open(f"{experiment_path}/args.pkl", "rb"))
+    model = eval(exp_args.model)(dataset=exp_args.dataset, device=device)
+    model.eval()
+    noise = parse_noise_from_args(exp_args, device=device, dim=get_dim(exp_args.dataset))
+    adv = getattr(exp_args, "adv", 2)
+
+    test_dataset = get_dataset(exp_args.dataset, "test")
+    loader = DataLoader(Subset(test_dataset, get_stratified_indices(test_dataset, size)),
+                        batch_size=batch_size)
+
+    curve_path = f"{experiment_path}/cert_acc_epochs.jsonl"
+    final_path = f"{experiment_path}/model_ckpt.torch"
+    start_time = time.time() if start_time is None else start_time
+    certified, curve = set(), []
+
+    def certify(epoch, ckpt_path):
+        model.load_state_dict(torch.load(ckpt_path, map_location=device))
+        # the same noise draws for every checkpoint, so that the curve only reflects training
+        torch.manual_seed(0)
+        start = time.time()
+        cert_acc = certified_accuracy(model, noise, loader, radii, adv, sample_size_cert=sample_size)
+        append_jsonl(curve_path, {"epoch": epoch, "radii": list(radii),
+                                  "cert_acc": cert_acc.tolist(), "secs": time.time() - start})
+        logger.info(f"Epoch: {epoch}\t" +
+                    "\t".join(f"{r}: {acc:.3f}" for r, acc in zip(radii, cert_acc)))
+        certified.add(epoch)
+        curve.append([epoch] + cert_acc.tolist())
+
+    while True:
+        epochs = sorted(int(name) for name in os.listdir(experiment_path) if name.isdigit() and
+                        os.path.exists(f"{experiment_path}/{name}/model_ckpt.torch"))
+        pending = [epoch for epoch in epochs if epoch not in certified]
+        if pending:
+            # newest first, so that the curve's leading edge stays current when falling behind
+            certify(pending[-1], f"{experiment_path}/{pending[-1]}/model_ckpt.torch")
+            continue
+        if os.path.exists(final_path) and os.path.getmtime(final_path) >= start_time:
+            final_epoch = get_final_epoch(experiment_path, exp_args)
+            if final_epoch not in certified:
+                certify(final_epoch, final_path)
+            break
+        time.sleep(poll_secs)
+
+    np.save(f"{experiment_path}/cert_acc_epochs.npy", np.array(sorted(curve)))
+
+
+if __name__ == "__main__":
+
+    argparser = ArgumentParser()
+    argparser.add_argument("--device", default="cpu", type=str)
+    argparser.add_argument("--experiment-name", type=str, required=True)
+    argparser.add_argument("--size", default=500, type=int)
+    argparser.add_argument("--sample-size", default=1000, type=int)
+    argparser.add_argument("--radii", default="0.25,0.5,1.0", type=str)
+    argparser.add_argument("--num-threads", default=1, type=int)
+    argparser.add_argument("--poll-secs", default=10.0, type=float)
+    argparser.add_argument("--output-dir", type=str, default=os.getenv("PT_OUTPUT_DIR"))
+    args = argparser.parse_args()
+
+    certify_checkpoints(f"{args.output_dir}/{args.experiment_name}", args.size, args.sample_size,
+                        [float(r) for r in args.radii.split(",")], args.device, args.num_threads,
+                        args.poll_secs, start_time=0)
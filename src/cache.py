@@ -0,0 +1,160 @@
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+import torch
+from src.smooth import smooth_count_hard, smooth_predict_hard, certify_radius, prob_lb_from_counts
+
+
+def model_fingerprint(model):
+    """
+    Hash of a model's weights, so that cached votes are never reused across checkpoints.
+    """
+    h = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+def noise_fingerprint(noise):
+    return f"{noise},dim={noise.dim},lambd={noise.lambd}"
+
+
+class CertificateCache(object):
+    """
+    Bounded LRU cache of accumulated certification votes, keyed by a hash of
+    (input bytes, model weights, noise config), with an optional disk tier for evicted entries.
+
+    Each entry holds the selected class, the number of certification votes for it and the number
+    of certification samples drawn so far. Selection votes are never mixed with certification votes.
+
+    The disk tier is bounded in LRU order too, through an in-memory index of its entries that is
+    read from the directory once, so that an eviction never lists the directory.
+    """
+    def __init__(self, max_entries=10000, disk_dir=None, max_disk_entries=1000000):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.disk_entries = OrderedDict()
+        self.hits = self.refinements = self.misses = 0
+        self.disk_hits = self.evictions = self.disk_evictions = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            paths = [os.path.join(disk_dir, f) for f in os.listdir(disk_dir) if f.endswith(".npy")]
+            for path in sorted(paths, key=os.path.getmtime):
+                self.disk_entries[os.path.basename(path)[:-len(".npy")]] = None
+            self._bound_disk()
+
+    def key(self, x, model_key, noise_key):
+        h = hashlib.sha1(x.detach().cpu().contiguous().numpy().tobytes())
+        h.update(model_key.encode())
+        h.update(noise_key.encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if key in self.disk_entries:
+            self.disk_hits += 1
+            self.disk_entries.move_to_end(key)
+            entry = np.load(self._disk_path(key))
+            self.put(key, entry)
+            return entry
+        return None
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.evictions += 1
+            if self.disk_dir is not None:
+                np.save(self._disk_path(old_key), old_entry)
+                self.disk_entries[old_key] = None
+                self.disk_entries.move_to_end(old_key)
+                self._bound_disk()
+
+    def stats(self):
+        requests = self.hits + self.refinements + self.misses
+        return {
+            "requests": requests,
+            "hit_rate": self.hits / max(requests, 1),
+            "refinement_rate": self.refinements / max(requests, 1),
+            "miss_rate": self.misses / max(requests, 1),
+            "disk_hits": self.disk_hits,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "entries": len(self.entries),
+            "disk_entries": len(self.disk_entries),
+        }
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.npy")
+
+    def _bound_disk(self):
+        while len(self.disk_entries) > self.max_disk_entries:
+            old_key, _ = self.disk_entries.popitem(last=False)
+            os.remove(self._disk_path(old_key))
+            self.disk_evictions += 1
+
+
+def certify_cached(model, x, noise, cache, radius, adv, alpha=0.001, sample_size_pred=64,
+                   sample_sizes=(1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+                   noise_batch_size=512, model_key=None):
+    """
+    Certify each example in x to the requested radius, reusing votes from previous requests.
+
+    Certification samples are accumulated along the fixed ladder sample_sizes, and a bound is only
+    ever computed at a ladder size with level alpha / len(sample_sizes). The union bound over the
+    ladder keeps the certificate valid however many times an entry is refined and re-checked.
+    A repeat request is answered from the cache if the stored votes already reach the radius,
+    otherwise only the samples up to the next ladder sizes are drawn.
+
+    Returns
+    -------
+    top_cats: n-length tensor of ints
+    prob_lb: n-length tensor of floats
+    radius: n-length tensor of floats, the certified radii
+    """
+    model_key = model_key or model_fingerprint(model)
+    noise_key = noise_fingerprint(noise)
+    sample_sizes = sorted(sample_sizes)
+    level_alpha = alpha / len(sample_sizes)
+    top_cats = torch.zeros(len(x), dtype=torch.long)
+    prob_lb = torch.zeros(len(x))
+
+    for i in range(len(x)):
+        key = cache.key(x[i], model_key, noise_key)
+        entry = cache.get(key)
+        if entry is None:
+            cache.misses += 1
+            top_cat = smooth_predict_hard(model, x[i:i + 1], noise, sample_size_pred,
+                                          noise_batch_size).probs.argmax(dim=1).item()
+            entry = np.array([top_cat, 0, 0])
+        top_cat, top_count, sample_size = (int(v) for v in entry)
+        refined = False
+
+        while True:
+            if sample_size > 0:
+                counts = torch.tensor([[top_count, sample_size - top_count]])
+                lower = prob_lb_from_counts(counts, torch.tensor([0]), level_alpha)
+                if certify_radius(noise, lower, adv).item() >= radius or \
+                   sample_size >= sample_sizes[-1]:
+                    break
+            next_size = next(n for n in sample_sizes if n > sample_size)
+            counts = smooth_count_hard(model, x[i:i + 1], noise, next_size - sample_size,
+                                       noise_batch_size)
+            top_count += int(counts[0, top_cat].item())
+            sample_size = next_size
+            refined = True
+
+        if refined and entry[2] > 0:
+            cache.refinements += 1
+        elif not refined:
+            cache.hits += 1
+        cache.put(key, np.array([top_cat, top_count, sample_size]))
+        top_cats[i], prob_lb[i] = top_cat, lower[0]
+
+    return top_cats, prob_lb, certify_radius(noise, prob_lb, adv)
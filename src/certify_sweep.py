@@ -0,0 +1,105 @@
+import numpy as np
+import pickle
+import os
+import torch
+from argparse import ArgumentParser
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+from src.models import *
+from src.smooth import *
+from src.noises import *
+from src.datasets import *
+from src.counts import save_results
+from src.ensemble import StackedForecaster
+from src.utils import parse_noise_from_args, manual_seed_all, derive_seed
+
+
+if __name__ == "__main__":
+
+    argparser = ArgumentParser()
+    argparser.add_argument("--device", default="cuda", type=str)
+    argparser.add_argument("--batch-size", default=2, type=int)
+    argparser.add_argument("--num-workers", default=min(os.cpu_count(), 8), type=int)
+    argparser.add_argument("--sample-size-pred", default=64, type=int)
+    argparser.add_argument("--sample-size-cert", default=100000, type=int)
+    argparser.add_argument("--noise-batch-size", default=512, type=int)
+    argparser.add_argument("--dataset-skip", default=1, type=int)
+    argparser.add_argument("--experiment-names", type=str, required=True)
+    argparser.add_argument("--seed", type=int, default=None)
+    argparser.add_argument("--output-dir", type=str, default=os.getenv("PT_OUTPUT_DIR"))
+    args = argparser.parse_args()
+
+    # every experiment must have been trained (by src.train or src.train_sweep) with the same
+    # small model and dataset; each keeps its own noise
+    experiment_names = args.experiment_names.split(",")
+    experiment_args = [pickle.load(open(f"{args.output_dir}/{name}/args.pkl", "rb"))
+                       for name in experiment_names]
+    dataset = experiment_args[0].dataset
+    models, noises = [], []
+    for name, exp_args in zip(experiment_names, experiment_args):
+        assert exp_args.model == experiment_args[0].model and exp_args.dataset == dataset
+        models.append(load_model(exp_args.model, dataset, args.device,
+                                 f"{args.output_dir}/{name}/model_ckpt.torch"))
+        noises.append(parse_noise_from_args(exp_args, device=args.device, dim=get_dim(dataset)))
+    stacked = StackedForecaster(models)
+
+    test_dataset = get_dataset(dataset, "test")
+    test_dataset = Subset(test_dataset, list(range(0, len(test_dataset), args.dataset_skip)))
+    test_loader = DataLoader(test_dataset, shuffle=False, batch_size=args.batch_size,
+                             num_workers=args.num_workers)
+
+    K, n, num_labels = len(models), len(test_dataset), get_num_labels(dataset)
+    preds_all = np.zeros((K, n, num_labels))
+    counts_all = np.zeros((K, n, num_labels), dtype=np.int64)
+    labels = np.zeros(n)
+    seeds = np.zeros(n, dtype=np.uint64)
+    pilot_seeds = np.zeros(n, dtype=np.uint64)
+
+    for i, (x, y) in tqdm(enumerate(test_loader), total=len(test_loader)):
+
+        x = x.to(args.device)
+        lower, upper = i * args.batch_size, (i + 1) * args.batch_size
+        # selection and certification draw from separate recorded streams, as in test.py
+        seed = torch.seed() if args.seed is None else args.seed + i
+        manual_seed_all(derive_seed(seed, "pilot", 0))
+        preds = smooth_count_hard_stacked(stacked, x, noises, args.sample_size_pred,
+                                          args.noise_batch_size)
+        manual_seed_all(seed)
+        counts = smooth_count_hard_stacked(stacked, x, noises, args.sample_size_cert,
+                                           args.noise_batch_size)
+        preds_all[:, lower:upper] = (preds / args.sample_size_pred).cpu().numpy()
+        counts_all[:, lower:upper] = counts.cpu().numpy()
+        labels[lower:upper] = y.numpy()
+        seeds[lower:upper] = seed
+        pilot_seeds[lower:upper] = derive_seed(seed, "pilot", 0)
+
+    train_dataset = get_dataset(dataset, "train")
+    train_loader = DataLoader(train_dataset, shuffle=False,
+                              batch_size=args.batch_size,
+                              num_workers=args.num_workers)
+    correct_train = np.zeros(K)
+
+    for x, y in tqdm(train_loader):
+
+        x, y = x.to(args.device), y.to(args.device)
+        preds = smooth_count_hard_stacked(stacked, x, noises, args.sample_size_pred,
+                                          args.noise_batch_size)
+        correct_train += (preds.argmax(dim=2) == y.unsqueeze(0)).sum(dim=1).cpu().numpy()
+
+    for k, (name, exp_args, noise) in enumerate(zip(experiment_names, experiment_args, noises)):
+        top_cats = preds_all[k].argmax(axis=1)
+        prob_lb = prob_lb_from_counts(counts_all[k], top_cats, 0.001)
+        preds = torch.tensor(preds_all[k])
+        results = {
+            "preds": preds_all[k],
+            "labels": labels,
+            "prob_lb": prob_lb.numpy(),
+            "preds_nll": -torch.log(preds[torch.arange(n), torch.tensor(labels).long()]).numpy(),
+            "radius_l1": noise.certifyl1(prob_lb).cpu().numpy(),
+            "radius_l2": noise.certifyl2(prob_lb).cpu().numpy(),
+            "radius_linf": noise.certifylinf(prob_lb).cpu().numpy(),
+            "acc_train": np.array([correct_train[k] / len(train_dataset), 0.0]),
+        }
+        save_results(f"{args.output_dir}/{name}", results, counts_all[k], top_cats, labels,
+                     seeds, exp_args, pilot_seeds=pilot_seeds)
+        print(f"{name}: training accuracy: {correct_train[k] / len(train_dataset):.4f}")
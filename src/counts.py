@@ -0,0 +1,66 @@
+import json
+import pathlib
+import numpy as np
+
+
+def save_counts(path, counts, top_cats, labels, seeds, meta, pilot_seeds=None):
+    """
+    Save certification votes in a compact columnar store (a single .npz file).
+
+    Counts are stored sparsely (CSR layout over classes), which keeps ImageNet's 1000 classes cheap
+    since the votes of a smoothed classifier concentrate on very few classes. seeds are those of
+    the noise each example was certified with, pilot_seeds (optional) those of the noise its class
+    was selected with.
+    """
+    extra = {} if pilot_seeds is None else {"pilot_seeds": np.asarray(pilot_seeds).astype(np.uint64)}
+    counts = np.asarray(counts)
+    rows, cols = np.nonzero(counts)
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(counts)), out=indptr[1:])
+    np.savez_compressed(path,
+                        indptr=indptr,
+                        classes=cols.astype(np.int32),
+                        votes=counts[rows, cols].astype(np.uint32),
+                        num_classes=np.array(counts.shape[1]),
+                        sample_size=counts.sum(axis=1).astype(np.int64),
+                        top_cats=np.asarray(top_cats).astype(np.int32),
+                        labels=np.asarray(labels).astype(np.int32),
+                        seeds=np.asarray(seeds).astype(np.uint64),
+                        meta=np.array(json.dumps(meta)),
+                        **extra)
+
+def load_counts(path):
+    """
+    Load a store written by save_counts.
+
+    Returns
+    -------
+    store: dict with dense (n x num_classes) "counts", plus "sample_size", "top_cats", "labels",
+           "seeds", "pilot_seeds" (None if not saved) and the "meta" dict
+    """
+    with np.load(path) as data:
+        indptr = data["indptr"]
+        counts = np.zeros((len(indptr) - 1, int(data["num_classes"])), dtype=np.int64)
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        counts[rows, data["classes"]] = data["votes"]
+        return {
+            "counts": counts,
+            "sample_size": data["sample_size"],
+            "top_cats": data["top_cats"],
+            "labels": data["labels"],
+            "seeds": data["seeds"],
+            "pilot_seeds": data["pilot_seeds"] if "pilot_seeds" in data.files else None,
+            "meta": json.loads(str(data["meta"])),
+        }
+
+def save_results(save_path, results, counts, top_cats, labels, seeds, args, pilot_seeds=None):
+    """
+    Write the per-example results of a certification run, one .npy file per key, and its votes
+    to counts.npz, recording the noise (and dataset) of args for recertify.
+    """
+    pathlib.Path(save_path).mkdir(parents=True, exist_ok=True)
+    for k, v in results.items():
+        np.save(f"{save_path}/{k}.npy", v)
+    meta = {k: getattr(args, k) for k in ("noise", "sigma", "lambd", "k", "j", "a", "dataset")}
+    save_counts(f"{save_path}/counts.npz", counts, top_cats, labels, seeds,
+                dict(meta, alpha=0.001), pilot_seeds=pilot_seeds)
@@ -1,7 +1,11 @@
+import numpy as np
 import torch
+import torch.nn.functional as F
 import random
+from torch.utils.data.dataloader import default_collate
 from torchvision import datasets, transforms
 from src.lib.zipdata import ZipData
+from src.utils import manual_seed_all
 
 
 def get_dim(name):
@@ -59,14 +63,16 @@ def get_dataset(name, split):
 					   "/mnt/imagenet/train_map.txt",
                        transforms.Compose([transforms.RandomResizedCrop(224),
                                            transforms.RandomHorizontalFlip(),
-                                           transforms.ToTensor()]))
+                                           transforms.ToTensor()]),
+                       index_file="./data/imagenet/train_index.npz")
 
     if name == "imagenet" and split == "test":
         return ZipData("/mnt/imagenet/val.zip",
 					   "/mnt/imagenet/val_map.txt",
                        transforms.Compose([transforms.Resize(256),
                                            transforms.CenterCrop(224),
-                                           transforms.ToTensor()]))
+                                           transforms.ToTensor()]),
+                       index_file="./data/imagenet/val_index.npz")
 
     if name == "mnist":
         return datasets.MNIST("./data/mnist", train=(split == "train"), download=True,
@@ -79,3 +85,185 @@ def get_dataset(name, split):
                              transform=transforms.ToTensor())
 
     raise ValueError
+
+def get_uint8_dataset(name, split):
+    """
+    Load a whole split as one contiguous uint8 tensor in shared memory.
+
+    Returns
+    -------
+    data: (n x c x h x w) uint8 tensor
+    targets: n-length tensor of ints
+    """
+    if name == "cifar":
+        base = datasets.CIFAR10("./data/cifar_10", train=(split == "train"), download=True)
+        data = torch.from_numpy(base.data).permute(0, 3, 1, 2)
+    elif name == "mnist":
+        base = datasets.MNIST("./data/mnist", train=(split == "train"), download=True)
+        data = base.data.unsqueeze(1)
+    elif name == "fashion":
+        base = datasets.FashionMNIST("./data/fashion", train=(split == "train"), download=True)
+        data = base.data.unsqueeze(1)
+    elif name == "svhn":
+        base = datasets.SVHN("./data/svhn", split=split, download=True)
+        data = torch.from_numpy(base.data)
+        base.targets = base.labels
+    else:
+        raise ValueError
+    data = data.contiguous().share_memory_()
+    targets = torch.as_tensor(np.asarray(base.targets), dtype=torch.long).share_memory_()
+    return data, targets
+
+def random_crop_flip(x, padding=4, generator=None):
+    """
+    Batched equivalent of RandomCrop(size, padding) followed by RandomHorizontalFlip(),
+    done as a single gather over the zero-padded batch.
+    """
+    n, c, h, w = x.shape
+    x = F.pad(x, (padding, padding, padding, padding))
+    oy = torch.randint(0, 2 * padding + 1, (n, 1), generator=generator)
+    ox = torch.randint(0, 2 * padding + 1, (n, 1), generator=generator)
+    flip = torch.rand(n, 1, generator=generator) < 0.5
+    rows = oy + torch.arange(h)
+    cols = torch.where(flip, ox + torch.arange(w - 1, -1, -1), ox + torch.arange(w))
+    return x[torch.arange(n)[:, None, None, None], torch.arange(c)[None, :, None, None],
+             rows[:, None, :, None].to(x.device), cols[:, None, None, :].to(x.device)]
+
+
+class InMemoryLoader(object):
+    """
+    Drop-in replacement for a DataLoader over CIFAR/MNIST/Fashion/SVHN that keeps the split as a
+    uint8 tensor and does cropping, flipping and float conversion per batch in vectorised form.
+    The augmentation matches the torchvision pipeline of get_dataset in distribution.
+    If noise is given, the returned batches are already noised.
+
+    With num_replicas > 1 each rank iterates over its own equally sized shard, as with
+    DistributedSampler: every epoch the whole split is shuffled by a permutation seeded by seed
+    and the epoch (so shared by all ranks, call set_epoch) and cut into shards. The returned
+    indices always refer to the whole split.
+    """
+    def __init__(self, name, split, batch_size, shuffle=False, noise=None, device="cpu",
+                 indices=None, drop_last=False, return_indices=False, num_replicas=1, rank=0,
+                 seed=0):
+        self.data, self.targets = get_uint8_dataset(name, split)
+        if indices is not None:
+            self.data, self.targets = self.data[indices], self.targets[indices]
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = name == "cifar" and split == "train"
+        self.noise = noise
+        self.device = device
+        self.drop_last = drop_last
+        self.return_indices = return_indices
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        num_examples = len(self.data) // self.num_replicas
+        if self.drop_last:
+            return num_examples // self.batch_size
+        return (num_examples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.num_replicas > 1:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.data), generator=generator) if self.shuffle else \
+                    torch.arange(len(self.data))
+            order = order[:len(self.data) - len(self.data) % self.num_replicas]
+            order = order[self.rank::self.num_replicas]
+        else:
+            order = torch.randperm(len(self.data)) if self.shuffle else torch.arange(len(self.data))
+        for i in range(len(self)):
+            idx = order[i * self.batch_size:(i + 1) * self.batch_size]
+            x = self.data[idx].to(self.device, non_blocking=True)
+            if self.augment:
+                x = random_crop_flip(x)
+            x = x.float().div_(255)
+            if self.noise is not None:
+                x = self.noise.sample(x.view(len(x), -1)).view(x.shape)
+            if self.return_indices:
+                yield x, self.targets[idx].to(self.device, non_blocking=True), idx
+            else:
+                yield x, self.targets[idx].to(self.device, non_blocking=True)
+
+
+class NoiseCollate(object):
+    """
+    Collate function that noises training batches inside DataLoader workers, so that the main
+    process only runs forward and backward passes. The noise must live on the CPU.
+
+    Batches come out as (x, x_noisy, y). For mode="direct", x_noisy holds sample_size noisy
+    copies of each example, laid out as expected by smooth.direct_train_log_lik.
+    """
+    def __init__(self, noise, mode="augment", sample_size=16):
+        self.noise = noise
+        self.mode = mode
+        self.sample_size = sample_size
+
+    def __call__(self, batch):
+        x, y = default_collate(batch)
+        if self.mode == "direct":
+            samples = x.unsqueeze(1).expand(torch.Size([len(x), self.sample_size]) + x.shape[1:])
+            samples = samples.reshape(torch.Size([-1]) + x.shape[1:])
+        else:
+            samples = x
+        x_noisy = self.noise.sample(samples.reshape(len(samples), -1)).view(samples.shape)
+        return x, x_noisy, y
+
+
+def seed_noise_worker(worker_id):
+    """
+    DataLoader worker_init_fn seeding every generator of a worker from its torch seed.
+    """
+    manual_seed_all(torch.initial_seed())
+    random.seed(torch.initial_seed() % 2 ** 32)
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """
+    Wraps a dataset so that each item also returns its index, e.g. to keep per-example state.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        x, y = self.dataset[index]
+        return x, y, index
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def get_targets(dataset):
+    """
+    Labels of every example in a dataset, without decoding the inputs where possible.
+    """
+    if isinstance(dataset, torch.utils.data.Subset):
+        return np.asarray(get_targets(dataset.dataset))[dataset.indices]
+    for attr in ("targets", "labels"):
+        if hasattr(dataset, attr):
+            return np.asarray(getattr(dataset, attr))
+    if hasattr(dataset, "samples"):
+        return np.array([target for _, target in dataset.samples])
+    return np.array([dataset[i][1] for i in range(len(dataset))])
+
+def get_stratified_indices(dataset, size, seed=0):
+    """
+    A fixed subset of size examples with (as far as possible) equally many per class.
+    """
+    targets = get_targets(dataset)
+    rng = np.random.RandomState(seed)
+    classes = np.unique(targets)
+    per_class = [rng.permutation(np.nonzero(targets == c)[0]) for c in classes]
+    indices = []
+    for rank in range(max(len(idx) for idx in per_class)):
+        indices += [idx[rank] for idx in per_class if rank < len(idx)]
+        if len(indices) >= size:
+            break
+    return sorted(indices[:size])
+
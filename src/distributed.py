@@ -0,0 +1,177 @@
+import os
+import torch
+from contextlib import contextmanager
+import torch.nn as nn
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed(backend="gloo"):
+    """
+    Join the process group described by the environment variables that torchrun sets, e.g.
+
+        torchrun --nproc-per-node 4 -m src.train --distributed ...
+
+    Returns
+    -------
+    rank: global rank of this process
+    world_size: total number of processes
+    local_world_size: number of processes on this machine
+    """
+    dist.init_process_group(backend)
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", dist.get_world_size()))
+    return dist.get_rank(), dist.get_world_size(), local_world_size
+
+
+def broadcast_module(module, src=0):
+    """
+    Overwrite the parameters and buffers of the module with those of rank src, so that every
+    process starts from the same initialization.
+    """
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor, src)
+
+
+def average_gradients(params):
+    """
+    Average the gradients of params over all processes with a single all-reduce.
+    """
+    grads = [p.grad for p in params if p.grad is not None]
+    if not grads:
+        return
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    for grad, synced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        grad.copy_(synced)
+
+
+def sync_gradients_before_step(optimizer):
+    """
+    Register a hook that averages gradients across processes right before every optimizer step.
+    This covers every training mode, including those that take several steps per minibatch or
+    run forward passes that are never backpropagated to the parameters, which a
+    DistributedDataParallel wrapper would not.
+    """
+    params = [p for group in optimizer.param_groups for p in group["params"]]
+    return optimizer.register_step_pre_hook(lambda *_: average_gradients(params))
+
+
+def average_buffers(module):
+    """
+    Average the floating point buffers of the module over all processes. Without SyncBatchNorm
+    each process tracks batch norm running statistics on its own shard only.
+    """
+    buffers = [b for b in module.buffers() if b.is_floating_point()]
+    if not buffers:
+        return
+    with torch.no_grad():
+        flat = _flatten_dense_tensors(buffers)
+        dist.all_reduce(flat)
+        flat /= dist.get_world_size()
+        for buf, synced in zip(buffers, _unflatten_dense_tensors(flat, buffers)):
+            buf.copy_(synced)
+
+
+@contextmanager
+def averaged_buffers(module):
+    """
+    Temporarily average the buffers of the module over all processes, e.g. to save a checkpoint
+    that reflects the whole training set, then restore each process's own.
+    """
+    saved = [b.clone() for b in module.buffers()]
+    average_buffers(module)
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buf, own in zip(module.buffers(), saved):
+                buf.copy_(own)
+
+
+def broadcast_flag(flag, src=0):
+    """
+    Make a boolean decision taken on rank src (e.g. a wall-clock checkpoint trigger) binding
+    for every process.
+    """
+    tensor = torch.tensor([int(flag)])
+    dist.broadcast(tensor, src)
+    return bool(tensor.item())
+
+
+def broadcast_scalar(value, src=0):
+    """
+    Make a float computed on rank src (e.g. a validation loss that early stopping acts on)
+    identical on every process.
+    """
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    dist.broadcast(tensor, src)
+    return tensor.item()
+
+
+class AllReduceSum(torch.autograd.Function):
+    """
+    Sum of a tensor over all processes; the gradient is summed over processes in turn.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone()
+        dist.all_reduce(grad)
+        return grad
+
+
+class SyncBatchNorm(nn.modules.batchnorm._BatchNorm):
+    """
+    Batch normalization with statistics computed over the whole distributed batch. Unlike
+    nn.SyncBatchNorm this works on CPU, at the cost of one (autograd-aware) all-reduce of the
+    per-channel sums per layer.
+    """
+    def _check_input_dim(self, x):
+        if x.dim() < 2:
+            raise ValueError(f"expected at least 2D input (got {x.dim()}D input)")
+
+    def forward(self, x):
+        if not self.training or not dist.is_initialized():
+            return super().forward(x)
+        dims = [0] + list(range(2, x.dim()))
+        count = x.new_tensor([x.numel() / x.shape[1]])
+        stats = AllReduceSum.apply(torch.cat([x.sum(dims), (x * x).sum(dims), count]))
+        channels = x.shape[1]
+        n = stats[-1]
+        mean = stats[:channels] / n
+        var = stats[channels:2 * channels] / n - mean ** 2
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked += 1
+                momentum = self.momentum if self.momentum is not None else \
+                           1.0 / float(self.num_batches_tracked)
+                self.running_mean.mul_(1 - momentum).add_(momentum * mean)
+                self.running_var.mul_(1 - momentum).add_(momentum * var * n / (n - 1))
+        shape = [1, channels] + [1] * (x.dim() - 2)
+        x = (x - mean.view(shape)) * torch.rsqrt(var.view(shape) + self.eps)
+        if self.affine:
+            x = x * self.weight.view(shape) + self.bias.view(shape)
+        return x
+
+
+def convert_sync_batchnorm(module):
+    """
+    Recursively replace the batch normalization layers of a module by SyncBatchNorm, keeping
+    their parameters and running statistics.
+    """
+    if isinstance(module, nn.modules.batchnorm._BatchNorm):
+        converted = SyncBatchNorm(module.num_features, module.eps, module.momentum,
+                                  module.affine, module.track_running_stats)
+        converted.load_state_dict(module.state_dict())
+        converted.train(module.training)
+        return converted.to(next(module.buffers(), torch.empty(0)).device)
+    for name, child in module.named_children():
+        setattr(module, name, convert_sync_batchnorm(child))
+    return module
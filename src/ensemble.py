@@ -0,0 +1,69 @@
+import copy
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+
+
+class StackedForecaster(object):
+    """
+    K Forecasters of the same (small, BatchNorm-free) architecture, e.g. LinearModel, MLP or LeNet,
+    whose parameters are stacked along a leading dimension and evaluated with a single vmapped
+    forward pass. Since SGD updates are elementwise, optimizing the stacked parameters is the
+    same as optimizing the K models separately with identical hyper-parameters.
+
+    Matrix-shaped parameters (the weights of linear layers) are stored transposed: the vmapped
+    backward pass produces their gradients in that layout, so storing them as is would cost a
+    strided copy of every weight gradient at every step.
+    """
+    def __init__(self, models):
+        self.models = models
+        self.device = models[0].device
+        self.params, self.buffers = stack_module_state(models)
+        self.transposed = {name for name, p in self.params.items() if p.dim() == 3}
+        for name in self.transposed:
+            self.params[name] = self.params[name].detach().mT.contiguous().requires_grad_(
+                self.params[name].requires_grad)
+        self.base = copy.deepcopy(models[0]).to("meta")
+
+    def __len__(self):
+        return len(self.models)
+
+    def _forward_one(self, params, buffers, x):
+        params = {name: p.mT if name in self.transposed else p for name, p in params.items()}
+        return functional_call(self.base, (params, buffers), (x,))
+
+    def forward(self, x):
+        """
+        x: (K x n x ...) tensor, one batch of inputs per model
+
+        Returns
+        -------
+        logits: (K x n x num_classes) tensor
+        """
+        return vmap(self._forward_one)(self.params, self.buffers, x)
+
+    def loss(self, x, y):
+        """
+        Returns
+        -------
+        loss: (K x n) tensor of negative log-likelihoods
+        """
+        logits = self.forward(x)
+        return F.cross_entropy(logits.reshape(-1, logits.shape[-1]), y.repeat(len(self)),
+                               reduction="none").view(logits.shape[:2])
+
+    def parameters(self):
+        return [p for p in self.params.values() if p.requires_grad]
+
+    def unstack(self):
+        """
+        Copy the stacked parameters back into the K models.
+        """
+        with torch.no_grad():
+            for k, model in enumerate(self.models):
+                for name, p in model.named_parameters():
+                    p.copy_(self.params[name][k].mT if name in self.transposed else
+                            self.params[name][k])
+                for name, b in model.named_buffers():
+                    b.copy_(self.buffers[name][k])
+        return self.models
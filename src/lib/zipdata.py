@@ -1,90 +1,223 @@
-import multiprocessing
+import mmap
+import os
 import os.path as op
-from threading import local
-from zipfile import ZipFile, BadZipFile
+import struct
+import zlib
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
 
+import numpy as np
 from PIL import Image
 from io import BytesIO
 import torch.utils.data as data
+from torchvision import transforms
 
 _VALID_IMAGE_TYPES = ['.jpg', '.jpeg', '.tiff', '.bmp', '.png']
 
-class ZipData(data.Dataset):
-    _IGNORE_ATTRS = {'_zip_file'}
+# size of the fixed part of a zip local file header, and the offset of its name/extra lengths
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_LENGTHS = 26
 
-    def __init__(self, path, map_file,
-                 transform=None, target_transform=None,
-                 extensions=None):
-        self._path = path
-        if not extensions:
-            extensions = _VALID_IMAGE_TYPES
-        self._zip_file = ZipFile(path)
-        self.zip_dict = {}
-        self.samples = []
-        self.transform = transform
-        self.target_transform = target_transform
-        self.class_to_idx = {}
-        with open(map_file, 'r') as f:
-            for line in iter(f.readline, ""):
-                line = line.strip()
-                if not line:
-                    continue
-                cls_idx = [l for l in line.split('\t') if l]
-                if not cls_idx:
-                    continue
-                assert len(cls_idx) >= 2, "invalid line: {}".format(line)
-                idx = int(cls_idx[1])
-                cls = cls_idx[0]
-                del cls_idx
-                at_idx = cls.find('@')
-                assert at_idx >= 0, "invalid class: {}".format(cls)
-                cls = cls[at_idx + 1:]
-                if cls.startswith('/'):
-                    # Python ZipFile expects no root
-                    cls = cls[1:]
-                assert cls, "invalid class in line {}".format(line)
-                prev_idx = self.class_to_idx.get(cls)
-                assert prev_idx is None or prev_idx == idx, "class: {} idx: {} previously had idx: {}".format(
-                    cls, idx, prev_idx
-                )
-                self.class_to_idx[cls] = idx
-
-        for fst in self._zip_file.infolist():
+
+def read_class_map(map_file):
+    """
+    Parse a map file of tab-separated "<anything>@<member path>" and class index lines.
+
+    Returns
+    -------
+    class_to_idx: dict from member path (without leading slash) to class index
+    """
+    class_to_idx = {}
+    with open(map_file, 'r') as f:
+        for line in iter(f.readline, ""):
+            line = line.strip()
+            if not line:
+                continue
+            cls_idx = [l for l in line.split('\t') if l]
+            if not cls_idx:
+                continue
+            assert len(cls_idx) >= 2, "invalid line: {}".format(line)
+            idx = int(cls_idx[1])
+            cls = cls_idx[0]
+            del cls_idx
+            at_idx = cls.find('@')
+            assert at_idx >= 0, "invalid class: {}".format(cls)
+            cls = cls[at_idx + 1:]
+            if cls.startswith('/'):
+                # Python ZipFile expects no root
+                cls = cls[1:]
+            assert cls, "invalid class in line {}".format(line)
+            prev_idx = class_to_idx.get(cls)
+            assert prev_idx is None or prev_idx == idx, "class: {} idx: {} previously had idx: {}".format(
+                cls, idx, prev_idx
+            )
+            class_to_idx[cls] = idx
+    return class_to_idx
+
+
+def build_index(path, map_file, extensions=None):
+    """
+    Scan the central directory of the zip once for the members listed in map_file.
+
+    Returns
+    -------
+    index: dict of arrays, one entry per image: offsets (of the local file headers), sizes
+           (compressed), compress_types, targets and names (utf-8 encoded member paths)
+    """
+    extensions = extensions or _VALID_IMAGE_TYPES
+    class_to_idx = read_class_map(map_file)
+    offsets, sizes, compress_types, targets, names = [], [], [], [], []
+    with ZipFile(path) as zip_file:
+        for fst in zip_file.infolist():
             fname = fst.filename
-            target = self.class_to_idx.get(fname)
+            target = class_to_idx.get(fname)
             if target is None:
                 continue
             if fname.endswith('/') or fname.startswith('.') or fst.file_size == 0:
                 continue
             ext = op.splitext(fname)[1].lower()
-            if ext in extensions:
-                self.samples.append((fname, target))
+            if ext not in extensions:
+                continue
+            assert fst.compress_type in (ZIP_STORED, ZIP_DEFLATED), \
+                "unsupported compression for {}".format(fname)
+            offsets.append(fst.header_offset)
+            sizes.append(fst.compress_size)
+            compress_types.append(fst.compress_type)
+            targets.append(target)
+            names.append(fname.encode())
+    return {"offsets": np.array(offsets, dtype=np.int64),
+            "sizes": np.array(sizes, dtype=np.int64),
+            "compress_types": np.array(compress_types, dtype=np.int8),
+            "targets": np.array(targets, dtype=np.int64),
+            "names": np.array(names, dtype=np.bytes_)}
+
+
+def load_index(path, map_file, index_file, extensions=None, names=False):
+    """
+    Load the index of build_index from index_file, rebuilding (and saving) it if it is missing
+    or was built from a different zip or map file. If index_file cannot be written the index is
+    only kept in memory. The member names, which reading the images does not need, are only
+    returned with names.
+    """
+    stamp = np.array([op.getsize(path), op.getmtime(path), op.getsize(map_file),
+                      op.getmtime(map_file)], dtype=np.float64)
+    keys = {"offsets", "sizes", "compress_types", "targets"} | ({"names"} if names else set())
+    if op.exists(index_file):
+        with np.load(index_file) as saved:
+            if np.array_equal(saved["stamp"], stamp) and keys <= set(saved.files):
+                return {key: saved[key] for key in keys}
+    index = build_index(path, map_file, extensions)
+    try:
+        # written under a temporary name so that concurrent readers never see a partial file
+        os.makedirs(op.dirname(op.abspath(index_file)), exist_ok=True)
+        tmp_file = "{}.{}.tmp.npz".format(index_file, os.getpid())
+        np.savez(tmp_file, stamp=stamp, **index)
+        os.replace(tmp_file, index_file)
+    except OSError:
+        pass
+    return {key: index[key] for key in keys}
+
+
+def get_draft_size(transform):
+    """
+    Smallest (width, height) the transform needs, if it starts by resizing to a fixed size, in
+    which case JPEGs can be decoded at a reduced scale (PIL draft mode) before resizing.
+    """
+    if isinstance(transform, transforms.Compose) and transform.transforms:
+        transform = transform.transforms[0]
+    if not isinstance(transform, transforms.Resize) or getattr(transform, "max_size", None):
+        return None
+    size = transform.size
+    if isinstance(size, int) or len(size) == 1:
+        size = size if isinstance(size, int) else size[0]
+        return (size, size)
+    return (size[1], size[0])
+
+
+class ZipData(data.Dataset):
+    """
+    Images read straight out of a zip file, following a map file of member paths and class
+    indices.
+
+    The central directory is only scanned once: the offsets, sizes and labels of the members are
+    saved to index_file (by default next to the zip) and reused by later runs and by every data
+    loader worker. Members are read through one read-only mmap of the zip per process, opened on
+    first use and never pickled, so forked and spawned workers alike never share file positions.
+
+    When the transform starts by resizing to a fixed size (e.g. Resize(256) for evaluation),
+    JPEGs are decoded with DCT scaling to the smallest scale that is still at least that size,
+    which is several times faster than decoding at full size.
+
+    samples (member path and class index per image, as in ImageFolder) and class_to_idx (from
+    the map file) are only loaded when first accessed.
+    """
+    _IGNORE_ATTRS = {'_file', '_mmap', '_samples', '_class_to_idx'}
+
+    def __init__(self, path, map_file,
+                 transform=None, target_transform=None,
+                 extensions=None, index_file=None, draft=True):
+        self._path = path
+        self._map_file = map_file
+        self._extensions = extensions
+        self._index_file = index_file or path + ".index.npz"
+        self.transform = transform
+        self.target_transform = target_transform
+        index = load_index(path, map_file, self._index_file, extensions)
+        self._offsets = index["offsets"]
+        self._sizes = index["sizes"]
+        self._compress_types = index["compress_types"]
+        self.targets = index["targets"]
+        self.draft_size = get_draft_size(transform) if draft else None
+        self._file = None
+        self._mmap = None
+        self._samples = None
+        self._class_to_idx = None
         assert len(self), "No images found in: {} with map: {}".format(self._path, map_file)
 
+    @property
+    def samples(self):
+        if self._samples is None:
+            names = load_index(self._path, self._map_file, self._index_file, self._extensions,
+                               names=True)["names"]
+            self._samples = [(name.decode(), int(target))
+                             for name, target in zip(names, self.targets)]
+        return self._samples
+
+    @property
+    def class_to_idx(self):
+        if self._class_to_idx is None:
+            self._class_to_idx = read_class_map(self._map_file)
+        return self._class_to_idx
+
     def __repr__(self):
         return 'ZipData({}, size={})'.format(self._path, len(self))
 
     def __getstate__(self):
         return {
             key: val if key not in self._IGNORE_ATTRS else None
-            for key, val in self.__dict__.iteritems()
+            for key, val in self.__dict__.items()
         }
 
-    def __getitem__(self, index):
-        proc = multiprocessing.current_process()
-        pid = proc.pid # get pid of this process.
-        if pid not in self.zip_dict:
-            self.zip_dict[pid] = ZipFile(self._path)
-        zip_file = self.zip_dict[pid]
+    def _read(self, index):
+        if self._mmap is None:
+            self._file = open(self._path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = int(self._offsets[index])
+        name_len, extra_len = struct.unpack(
+            '<HH', self._mmap[offset + _LOCAL_HEADER_LENGTHS:offset + _LOCAL_HEADER_SIZE])
+        start = offset + _LOCAL_HEADER_SIZE + name_len + extra_len
+        raw = self._mmap[start:start + int(self._sizes[index])]
+        if self._compress_types[index] == ZIP_DEFLATED:
+            return zlib.decompress(raw, -zlib.MAX_WBITS)
+        return raw
 
+    def __getitem__(self, index):
         if index >= len(self) or index < 0:
             raise KeyError("{} is invalid".format(index))
-        path, target = self.samples[index]
-        try:
-            sample = Image.open(BytesIO(zip_file.read(path))).convert('RGB')
-        except BadZipFile:
-            print("bad zip file")
-            return None, None
+        sample = Image.open(BytesIO(self._read(index)))
+        if self.draft_size is not None:
+            sample.draft('RGB', self.draft_size)
+        sample = sample.convert('RGB')
+        target = int(self.targets[index])
         if self.transform is not None:
             sample = self.transform(sample)
         if self.target_transform is not None:
@@ -92,5 +225,4 @@ class ZipData(data.Dataset):
         return sample, target
 
     def __len__(self):
-        return len(self.samples)
-
+        return len(self.targets)
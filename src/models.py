@@ -47,9 +47,9 @@ class ResNet(Forecaster):
 
 class WideResNet(Forecaster):
     
-    def __init__(self, dataset, device):
+    def __init__(self, dataset, device, depth=40, widen_factor=2):
         super().__init__(dataset, device)
-        self.model = nn.DataParallel(WideResNetBase(depth=40, widen_factor=2,
+        self.model = nn.DataParallel(WideResNetBase(depth=depth, widen_factor=widen_factor,
                                                     num_classes=get_num_labels(dataset)))
         self.norm = nn.DataParallel(self.norm)
         self.norm = self.norm.to(device)
@@ -60,6 +60,14 @@ class WideResNet(Forecaster):
         return self.model(x)
 
 
+class NarrowWideResNet(WideResNet):
+    """
+    WRN-16-1, a small student for distillation from the larger models above.
+    """
+    def __init__(self, dataset, device):
+        super().__init__(dataset, device, depth=16, widen_factor=1)
+
+
 class LinearModel(Forecaster):
 
     def __init__(self, dataset, device):
@@ -113,6 +121,42 @@ class MLP(Forecaster):
         return self.model(x)
 
 
+def load_model(model_name, dataset, device, save_path):
+    """
+    Forecaster of class model_name with the weights saved at save_path, in eval mode.
+    """
+    model = eval(model_name)(dataset=dataset, device=device)
+    model.load_state_dict(torch.load(save_path, map_location=device))
+    model.eval()
+    return model
+
+
+def unwrap_data_parallel(model):
+    """
+    Replace the nn.DataParallel wrappers around a Forecaster's submodules by the modules
+    themselves, e.g. for multi-process training where each process drives one replica.
+    The names of the unwrapped submodules are kept so that data_parallel_state_dict can still
+    write checkpoints in the layout that test.py loads.
+    """
+    model.unwrapped = []
+    for name, child in list(model.named_children()):
+        if isinstance(child, nn.DataParallel):
+            setattr(model, name, child.module)
+            model.unwrapped.append(name)
+    return model
+
+
+def data_parallel_state_dict(model):
+    """
+    State dict of a model passed through unwrap_data_parallel, with keys as if it still had its
+    nn.DataParallel wrappers.
+    """
+    prefixes = tuple(f"{name}." for name in getattr(model, "unwrapped", []))
+    return type(model.state_dict())(
+        (k.replace(".", ".module.", 1) if k.startswith(prefixes) else k, v)
+        for k, v in model.state_dict().items())
+
+
 class NormalizeLayer(nn.Module):
     """
     Normalizes across the first non-batch axis.
@@ -0,0 +1,58 @@
+import inspect
+import numpy as np
+import pathlib
+import os
+import time
+from argparse import ArgumentParser, Namespace
+from src.noises import *
+from src.counts import load_counts
+from src.datasets import get_dim
+from src.smooth import prob_lb_from_counts
+from src.utils import parse_noise_from_args
+
+
+if __name__ == "__main__":
+
+    argparser = ArgumentParser()
+    argparser.add_argument("--experiment-name", default="cifar", type=str)
+    argparser.add_argument("--output-dir", type=str, default=os.getenv("PT_OUTPUT_DIR"))
+    argparser.add_argument("--alpha", default=0.001, type=float)
+    argparser.add_argument("--certifiers", default="certifyl1,certifyl2,certifylinf", type=str)
+    argparser.add_argument("--mode", default=None, type=str)
+    argparser.add_argument("--tag", default=None, type=str)
+    argparser.add_argument("--eps", default="0.25,0.5,1.0,1.5,2.0", type=str)
+    args = argparser.parse_args()
+
+    save_path = f"{args.output_dir}/{args.experiment_name}"
+    store = load_counts(f"{save_path}/counts.npz")
+    meta = store["meta"]
+    noise = parse_noise_from_args(Namespace(**meta), device="cpu", dim=get_dim(meta["dataset"]))
+
+    start = time.time()
+    results = {"prob_lb": prob_lb_from_counts(store["counts"], store["top_cats"], args.alpha)}
+    for certifier in args.certifiers.split(","):
+        certify = getattr(noise, certifier)
+        # only some certifiers can trade accuracy for speed with a mode
+        takes_mode = "mode" in inspect.signature(certify).parameters
+        kwargs = {"mode": args.mode} if args.mode is not None and takes_mode else {}
+        radius = certify(results["prob_lb"], **kwargs)
+        name = certifier.replace("certify", "radius_") if certifier in \
+               ("certifyl1", "certifyl2", "certifylinf") else f"radius_{certifier}"
+        results[name] = np.asarray(radius)
+
+    tag = args.tag or f"alpha{args.alpha}" + (f"_{args.mode}" if args.mode else "")
+    recert_path = f"{save_path}/recertify_{tag}"
+    pathlib.Path(recert_path).mkdir(parents=True, exist_ok=True)
+    for k, v in results.items():
+        np.save(f"{recert_path}/{k}.npy", np.asarray(v))
+
+    print(f"Recertified {len(store['counts'])} examples of {noise} "
+          f"(sample sizes {store['sample_size'].min()}-{store['sample_size'].max()}) "
+          f"in {time.time() - start:.2f}s, saved to {recert_path}")
+    correct = store["top_cats"] == store["labels"]
+    for name, radius in results.items():
+        if not name.startswith("radius_"):
+            continue
+        accs = "\t".join(f"{eps}: {((radius >= float(eps)) & correct).mean():.3f}"
+                         for eps in args.eps.split(","))
+        print(f"{name}\t{accs}")
@@ -0,0 +1,89 @@
+import time
+import torch
+from torch.distributions import Categorical
+from src.smooth import smooth_predict_hard
+
+
+def synchronize(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+class Selector(object):
+    """
+    Chooses the class to certify for each example (the "prediction" stage of certification).
+
+    Any selection rule that does not look at the certification samples keeps the certificate
+    valid, so the selector only trades off agreement with the smoothed vote against compute.
+    Each selector counts the per-image forward passes it issues and the wall-clock time spent.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.num_forwards = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        raise NotImplementedError
+
+    def _select(self, x):
+        raise NotImplementedError
+
+    def select(self, x):
+        """
+        Returns
+        -------
+        preds: Categorical, class probabilities used for the selection
+        top_cats: n-length tensor of ints, the classes to certify
+        """
+        synchronize(self.device)
+        start = time.perf_counter()
+        preds = self._select(x)
+        synchronize(self.device)
+        self.elapsed += time.perf_counter() - start
+        return preds, preds.probs.argmax(dim=1)
+
+
+class SmoothedVoteSelector(Selector):
+    """
+    Majority vote of the smoothed model over sample_size noisy forwards (the default).
+    """
+    def __init__(self, model, noise, sample_size=64, noise_batch_size=512):
+        super().__init__(model.device)
+        self.model = model
+        self.noise = noise
+        self.sample_size = sample_size
+        self.noise_batch_size = noise_batch_size
+
+    def __str__(self):
+        return f"SmoothedVote,n={self.sample_size}"
+
+    def _select(self, x):
+        self.num_forwards += len(x) * self.sample_size
+        return smooth_predict_hard(self.model, x, self.noise, self.sample_size,
+                                   self.noise_batch_size)
+
+
+class CleanSelector(Selector):
+    """
+    A single forward pass of the base model on the clean input.
+    """
+    def __init__(self, model):
+        super().__init__(model.device)
+        self.model = model
+
+    def __str__(self):
+        return "Clean"
+
+    def _select(self, x):
+        self.num_forwards += len(x)
+        with torch.no_grad():
+            return Categorical(logits=self.model.forward(x))
+
+
+class ProxySelector(SmoothedVoteSelector):
+    """
+    Majority vote of a small proxy model (e.g. LeNet or MLP) trained on the same noise.
+    Forward passes are counted separately since they are much cheaper than the base model's.
+    """
+    def __str__(self):
+        return f"Proxy,{type(self.model).__name__},n={self.sample_size}"
@@ -1,26 +1,150 @@
 import numpy as np
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
+from contextlib import contextmanager
 from torch.distributions import Categorical, Normal
+from scipy.stats import betabinom
 from statsmodels.stats.proportion import proportion_confint
 
 
-def direct_train_log_lik(model, x, y, noise, sample_size=16):
+def direct_train_log_lik(model, x, y, noise, sample_size=16, samples=None):
     """
     Log-likelihood for direct training (numerically stable with logusmexp trick).
+    Pre-drawn noisy samples, (n * sample_size) in example-major order, can be passed in samples.
     """
-    samples_shape = torch.Size([x.shape[0], sample_size]) + x.shape[1:]
-    samples = x.unsqueeze(1).expand(samples_shape)
-    samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
-    samples = noise.sample(samples)
+    if samples is None:
+        samples_shape = torch.Size([x.shape[0], sample_size]) + x.shape[1:]
+        samples = x.unsqueeze(1).expand(samples_shape)
+        samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
+        samples = noise.sample(samples)
     thetas = model.forward(samples).view(x.shape[0], sample_size, -1)
     return torch.logsumexp(thetas[torch.arange(x.shape[0]), :, y] - \
                            torch.logsumexp(thetas, dim=2), dim=1) - \
            torch.log(torch.tensor(sample_size, dtype=torch.float, device=x.device))
 
-def smooth_predict_soft(model, x, noise, sample_size=64, noise_batch_size=512):
+@contextmanager
+def frozen_running_stats(model):
+    """
+    Run forwards in train mode (batch statistics) without updating the running statistics of the
+    batch norm layers of model.
+    """
+    layers = [m for m in model.modules()
+              if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in layers]
+    for m in layers:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(layers, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+def direct_train_backward(model, x, y, noise, sample_size=16, micro_batch_size=512, samples=None,
+                          timer=None):
+    """
+    Backpropagate -direct_train_log_lik(model, x, y, noise, sample_size).mean() while holding the
+    activations of at most micro_batch_size noisy forwards at a time.
+
+    If micro_batch_size >= sample_size, whole examples are processed per micro-batch and the
+    gradients are simply accumulated. Otherwise each example's samples are processed in two passes:
+    the first (without gradients) computes the per-sample log-likelihoods and their logsumexp,
+    the second backpropagates each chunk weighted by its softmax weight exp(log_lik - logsumexp),
+    which is exactly the chain rule through the logsumexp. The first pass leaves the batch norm
+    running statistics alone, so they are updated once per sample as in the second.
+
+    The gradient matches the single-forward objective for models without batch norm or dropout;
+    with batch norm the statistics are computed per micro-batch.
+
+    If a PhaseTimer is given, the noise sampling, forward and backward passes are charged to the
+    "noise", "forward" and "backward" phases.
+
+    Returns
+    -------
+    loss: detached scalar, the value of the objective
+    """
+    n = x.shape[0]
+    if samples is None:
+        samples_shape = torch.Size([n, sample_size]) + x.shape[1:]
+        samples = x.unsqueeze(1).expand(samples_shape)
+        samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
+        samples = noise.sample(samples)
+    samples = samples.view(torch.Size([n, sample_size]) + x.shape[1:])
+    log_sample_size = np.log(sample_size)
+    total = torch.zeros((), device=x.device)
+    mark = timer.mark if timer is not None else lambda phase: None
+    mark("noise")
+
+    if micro_batch_size >= sample_size:
+        num_examples = micro_batch_size // sample_size
+        for lower in range(0, n, num_examples):
+            upper = min(lower + num_examples, n)
+            chunk = samples[lower:upper].reshape(torch.Size([-1]) + x.shape[1:])
+            thetas = F.log_softmax(model.forward(chunk), dim=1).view(upper - lower, sample_size, -1)
+            log_lik = torch.logsumexp(thetas[torch.arange(upper - lower), :, y[lower:upper]], dim=1)
+            loss = -(log_lik - log_sample_size).sum() / n
+            mark("forward")
+            loss.backward()
+            mark("backward")
+            total += loss.detach()
+        return total
+
+    for i in range(n):
+        with torch.no_grad(), frozen_running_stats(model):
+            log_lik = torch.cat([
+                F.log_softmax(model.forward(samples[i, lower:lower + micro_batch_size]), dim=1)[:, y[i]]
+                for lower in range(0, sample_size, micro_batch_size)])
+            normalizer = torch.logsumexp(log_lik, dim=0)
+            weights = torch.exp(log_lik - normalizer)
+        for lower in range(0, sample_size, micro_batch_size):
+            chunk = samples[i, lower:lower + micro_batch_size]
+            chunk_log_lik = F.log_softmax(model.forward(chunk), dim=1)[:, y[i]]
+            loss = -(weights[lower:lower + micro_batch_size] * chunk_log_lik).sum() / n
+            mark("forward")
+            loss.backward()
+            mark("backward")
+        total += -(normalizer - log_sample_size) / n
+    return total
+
+def estimate_micro_batch_size(model, x, memory_budget_mb):
+    """
+    Number of forwards whose activations fit in memory_budget_mb, estimated from the output sizes
+    of every leaf module on a single input (doubled to account for the gradients in backward).
+    """
+    sizes = []
+    def hook(module, inputs, output):
+        if torch.is_tensor(output):
+            sizes.append(output.numel() * output.element_size())
+    handles = [m.register_forward_hook(hook) for m in model.modules()
+               if len(list(m.children())) == 0]
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        model.forward(x[:1])
+    model.train(training)
+    for handle in handles:
+        handle.remove()
+    return max(1, int(memory_budget_mb * 2 ** 20 // (2 * sum(sizes))))
+
+def sample_noise_offsets(noise, x, sample_size):
+    """
+    Draw sample_size noise offsets per example of x, which smooth_predict_soft can reuse across
+    calls (common random numbers). All noises in src.noises are additive, so they are sampled
+    around zero.
+
+    Returns
+    -------
+    offsets: (n x sample_size x ...) tensor
+    """
+    shape = torch.Size([x.shape[0], sample_size]) + x.shape[1:]
+    zeros = torch.zeros(shape[0] * shape[1], x[0].numel(), device=x.device)
+    return noise.sample(zeros).view(shape)
+
+def smooth_predict_soft(model, x, noise, sample_size=64, noise_batch_size=512, offsets=None):
     """
-    Make soft predictions for a model smoothed by noise.
+    Make soft predictions for a model smoothed by noise. If offsets from sample_noise_offsets
+    are given, they are used in place of fresh noise.
 
     Returns
     -------
@@ -32,16 +156,68 @@ def smooth_predict_soft(model, x, noise, sample_size=64, noise_batch_size=512):
     while num_samples_left > 0:
 
         shape = torch.Size([x.shape[0], min(num_samples_left, noise_batch_size)]) + x.shape[1:]
-        samples = x.unsqueeze(1).expand(shape)
-        samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
-        samples = noise.sample(samples.view(len(samples), -1)).view(samples.shape)
+        if offsets is not None:
+            lower = sample_size - num_samples_left
+            samples = x.unsqueeze(1) + offsets[:, lower:lower + shape[1]]
+            samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
+        else:
+            samples = x.unsqueeze(1).expand(shape)
+            samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
+            samples = noise.sample(samples.view(len(samples), -1)).view(samples.shape)
         logits = model.forward(samples).view(shape[:2] + torch.Size([-1]))
         if counts is None:
             counts = torch.zeros(x.shape[0], logits.shape[-1], dtype=torch.float, device=x.device)
-        counts += F.softmax(logits, dim=-1).mean(dim=1)
+        counts += F.softmax(logits, dim=-1).sum(dim=1)
         num_samples_left -= noise_batch_size
 
-    return Categorical(probs=counts)
+    return Categorical(probs=counts / sample_size)
+
+def smooth_loss_grad(model, x, y, noise, sample_size=64, noise_batch_size=512, offsets=None):
+    """
+    Loss -log p(y) of the soft smoothed classifier, p(y) being the mean over noisy samples of the
+    base model's softmax, and its gradient with respect to x, holding the activations of at most
+    noise_batch_size noisy forwards per example at a time.
+
+    The gradient is -sum_s grad softmax(x + noise_s)[y] / (sample_size * p(y)): the numerator is
+    accumulated chunk by chunk and divided by the normaliser p(y) once all chunks have been seen,
+    so a single pass gives the exact gradient of the unchunked objective.
+
+    Returns
+    -------
+    loss: n-length tensor of floats, detached
+    probs: (n x num_classes) tensor, probabilities of the soft smoothed classifier, detached
+    grads: tensor of the shape of x
+    """
+    x = x.detach().requires_grad_()
+    rows = torch.arange(x.shape[0], device=x.device)
+    grads = torch.zeros_like(x)
+    counts = None
+
+    for lower in range(0, sample_size, noise_batch_size):
+
+        shape = torch.Size([x.shape[0], min(sample_size - lower, noise_batch_size)]) + x.shape[1:]
+        if offsets is not None:
+            samples = x.unsqueeze(1) + offsets[:, lower:lower + shape[1]]
+            samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
+        else:
+            samples = x.unsqueeze(1).expand(shape)
+            samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
+            samples = noise.sample(samples.view(len(samples), -1)).view(samples.shape)
+        logits = model.forward(samples).view(shape[:2] + torch.Size([-1]))
+        chunk_counts = F.softmax(logits, dim=-1).sum(dim=1)
+        grads += torch.autograd.grad(chunk_counts[rows, y].sum(), x)[0]
+        if counts is None:
+            counts = torch.zeros_like(chunk_counts.detach())
+        counts += chunk_counts.detach()
+
+    probs = counts / sample_size
+    # clamped like Categorical.log_prob, which has no gradient where the clamp is active
+    eps = torch.finfo(probs.dtype).eps
+    prob_y = probs[rows, y]
+    prob_y_clamped = prob_y.clamp(eps, 1 - eps)
+    scale = -(prob_y == prob_y_clamped).float() / (sample_size * prob_y_clamped)
+    grads *= scale.view(torch.Size([-1]) + (1,) * (x.dim() - 1))
+    return -torch.log(prob_y_clamped), probs, grads
 
 def smooth_predict_hard(model, x, noise, sample_size=64, noise_batch_size=512):
     """
@@ -51,6 +227,16 @@ def smooth_predict_hard(model, x, noise, sample_size=64, noise_batch_size=512):
     -------
     predictions: Categorical, probabilities for each class returned by hard smoothed classifier
     """
+    return Categorical(probs=smooth_count_hard(model, x, noise, sample_size, noise_batch_size))
+
+def smooth_count_hard(model, x, noise, sample_size=64, noise_batch_size=512):
+    """
+    Count the votes for each class of a model smoothed by noise.
+
+    Returns
+    -------
+    counts: (n x num_classes) tensor of floats, number of noisy samples voting for each class
+    """
     counts = None
     num_samples_left = sample_size
 
@@ -67,22 +253,238 @@ def smooth_predict_hard(model, x, noise, sample_size=64, noise_batch_size=512):
         counts += F.one_hot(top_cats, logits.shape[-1]).float().sum(dim=1)
         num_samples_left -= noise_batch_size
 
-    return Categorical(probs=counts)
+    return counts
 
-def certify_prob_lb(model, x, top_cats, alpha, noise, sample_size=10**5, noise_batch_size=512):
+def smooth_count_hard_stacked(stacked, x, noises, sample_size=64, noise_batch_size=512):
+    """
+    Count the votes of K models smoothed by K noises (one per model), evaluated with a single
+    batched forward pass of a StackedForecaster per noise batch.
+
+    Returns
+    -------
+    counts: (K x n x num_classes) tensor of floats
+    """
+    counts = None
+    num_samples_left = sample_size
+
+    while num_samples_left > 0:
+
+        shape = torch.Size([x.shape[0], min(num_samples_left, noise_batch_size)]) + x.shape[1:]
+        samples = x.unsqueeze(1).expand(shape)
+        samples = samples.reshape(torch.Size([-1]) + samples.shape[2:])
+        samples = torch.stack([noise.sample(samples.view(len(samples), -1)).view(samples.shape)
+                               for noise in noises])
+        with torch.no_grad():
+            logits = stacked.forward(samples).view(torch.Size([len(noises)]) + shape[:2] +
+                                                   torch.Size([-1]))
+        top_cats = torch.argmax(logits, dim=3)
+        if counts is None:
+            counts = torch.zeros(len(noises), x.shape[0], logits.shape[-1], dtype=torch.float,
+                                 device=x.device)
+        counts += F.one_hot(top_cats, logits.shape[-1]).float().sum(dim=2)
+        num_samples_left -= noise_batch_size
+
+    return counts
+
+def certify_prob_lb(model, x, top_cats, alpha, noise, sample_size=10**5, noise_batch_size=512,
+                    return_counts=False):
     """
     Certify a probability lower bound (rho).
 
     Returns
     -------
     prob_lb: n-length tensor of floats
+    counts: (n x num_classes) tensor, the certification votes (only if return_counts is True)
     """
-    preds = smooth_predict_hard(model, x, noise, sample_size, noise_batch_size)
-    top_probs = preds.probs.gather(dim=1, index=top_cats.unsqueeze(1)).detach().cpu()
-    lower, _ = proportion_confint(top_probs * sample_size, sample_size, alpha=alpha, method="beta")
-    lower = torch.tensor(lower.squeeze(), dtype=torch.float)
+    counts = smooth_count_hard(model, x, noise, sample_size, noise_batch_size)
+    lower = prob_lb_from_counts(counts, top_cats, alpha)
+    if return_counts:
+        return lower, counts
     return lower
 
+def prob_lb_from_counts(counts, top_cats, alpha):
+    """
+    Clopper-Pearson lower bound on the probability of top_cats given the votes in counts.
+    Rows without any votes get a lower bound of zero (abstain).
+
+    Returns
+    -------
+    prob_lb: n-length tensor of floats
+    """
+    counts = torch.as_tensor(counts).detach().cpu().double()
+    top_cats = torch.as_tensor(top_cats).detach().cpu().long()
+    nobs = counts.sum(dim=1).numpy()
+    top_counts = counts.gather(dim=1, index=top_cats.unsqueeze(1)).squeeze(1).numpy()
+    lower, _ = proportion_confint(top_counts, np.maximum(nobs, 1), alpha=alpha, method="beta")
+    lower = np.where(nobs > 0, np.nan_to_num(lower), 0.0)
+    return torch.tensor(lower, dtype=torch.float)
+
+def noisy_loss(model, noise, loader):
+    """
+    Mean loss of the base model on noisy copies of the examples of loader, i.e. the objective of
+    training with noise augmentation, evaluated without gradients.
+    """
+    total, n = 0., 0
+    with torch.no_grad():
+        for x, y in loader:
+            x, y = x.to(model.device), y.to(model.device)
+            x = noise.sample(x.view(len(x), -1)).view(x.shape)
+            total += model.loss(x, y).sum().item()
+            n += len(x)
+    return total / n
+
+
+def certified_accuracy(model, noise, loader, radii, adv, alpha=0.001, sample_size_pred=64,
+                       sample_size_cert=1000, noise_batch_size=512):
+    """
+    Certified accuracy of the smoothed model on the examples of loader, at each of the radii.
+
+    Returns
+    -------
+    accuracy: array of floats, one per radius
+    """
+    correct = np.zeros(len(radii))
+    total = 0
+    for x, y in loader:
+        x, y = x.to(model.device), y.to(model.device)
+        with torch.no_grad():
+            preds = smooth_predict_hard(model, x, noise, sample_size_pred, noise_batch_size)
+            top_cats = preds.probs.argmax(dim=1)
+            prob_lb = certify_prob_lb(model, x, top_cats, alpha, noise, sample_size_cert,
+                                      noise_batch_size)
+        radius = certify_radius(noise, prob_lb, adv).cpu().numpy()
+        hit = (top_cats == y).cpu().numpy()
+        correct += ((radius[:, None] >= np.asarray(radii)[None, :]) & hit[:, None]).sum(axis=0)
+        total += len(x)
+    return correct / total
+
+def certify_radius(noise, prob_lb, adv):
+    """
+    Robust radius for a probability lower bound against an l1, l2 or linf adversary.
+    """
+    if adv == 1:
+        return noise.certifyl1(prob_lb)
+    if adv == 2:
+        return noise.certifyl2(prob_lb)
+    if adv == float("inf"):
+        return noise.certifylinf(prob_lb)
+    raise ValueError("Can only certify against 1,2,inf norm adversaries.")
+
+def expected_radius(prob, noise, adv, sample_size, alpha=0.001):
+    """
+    Radius that would be certified with sample_size samples if the top-class probability were
+    exactly prob. Used to plan certification from pilot estimates, never to certify.
+
+    Returns
+    -------
+    radius: n-length array of floats (-1 where nothing would be certified)
+    """
+    prob = np.asarray(prob, dtype=np.float64)
+    lower, _ = proportion_confint(np.round(prob * sample_size), sample_size,
+                                  alpha=alpha, method="beta")
+    radius = certify_radius(noise, torch.tensor(np.atleast_1d(lower), dtype=torch.float), adv)
+    radius = np.asarray(radius.cpu().numpy() if torch.is_tensor(radius) else radius)
+    return np.nan_to_num(radius, nan=-1.0)
+
+def certification_probability(pilot_counts, pilot_size, noise, adv, radii, sample_size,
+                              alpha=0.001):
+    """
+    Probability that certifying with sample_size fresh samples reaches each of the radii, given
+    pilot_counts top-class votes out of pilot_size pilot samples. The top-class probability is
+    given the Beta(pilot_counts + 1, pilot_size - pilot_counts + 1) posterior of a uniform prior,
+    so the number of fresh top-class votes is beta-binomial.
+
+    Returns
+    -------
+    prob: (n x len(radii)) array of floats
+    """
+    votes = np.arange(sample_size + 1)
+    lower, _ = proportion_confint(votes, sample_size, alpha=alpha, method="beta")
+    radius = certify_radius(noise, torch.tensor(np.nan_to_num(lower), dtype=torch.float), adv)
+    radius = np.asarray(radius.cpu().numpy() if torch.is_tensor(radius) else radius)
+    radius = np.maximum.accumulate(np.nan_to_num(radius, nan=-1.0))
+    # fewest votes that certify each radius (sample_size + 1 if none does)
+    min_votes = np.searchsorted(radius, np.asarray(radii, dtype=np.float64))
+    pilot_counts = np.asarray(pilot_counts, dtype=np.float64)
+    return betabinom.sf(min_votes[None, :] - 1, sample_size, pilot_counts[:, None] + 1,
+                        pilot_size - pilot_counts[:, None] + 1)
+
+def allocate_sample_budget(pilot_counts, pilot_size, noise, adv, radii, budget, sample_sizes,
+                           alpha=0.001, min_gain=1e-6):
+    """
+    Allocate a global certification budget (total number of noisy forward passes) across a
+    set of examples, based on pilot votes for each example's top class.
+
+    For every example and every candidate sample size we compute the expected number of target
+    radii that certification would reach, accounting for the uncertainty of the pilot estimate
+    (see certification_probability). Sample sizes are then handed out greedily by marginal
+    utility per forward pass along the upper concave hull of each example's utility curve, until
+    the budget is spent or no example would gain more than min_gain expected radii.
+
+    The pilot votes only decide *how many* samples an example receives; certificates must
+    still be computed from fresh samples for them to remain valid.
+
+    Returns
+    -------
+    allocation: n-length array of ints, the number of certification samples per example
+                (0 means the example is not worth certifying and should abstain)
+    utility: n-length array of floats, expected number of target radii covered
+    """
+    pilot_counts = np.asarray(pilot_counts, dtype=np.float64)
+    sample_sizes = np.array(sorted(set(int(n) for n in sample_sizes)))
+
+    utils = np.zeros((len(pilot_counts), len(sample_sizes) + 1))
+    for k, n in enumerate(sample_sizes):
+        utils[:, k + 1] = certification_probability(pilot_counts, pilot_size, noise, adv, radii,
+                                                    n, alpha).sum(axis=1)
+    costs = np.concatenate([[0], sample_sizes])
+
+    # segments of the upper concave hull of (cost, utility) for each example
+    segments = []
+    for i in range(len(pilot_counts)):
+        hull = [0]
+        for k in range(1, len(costs)):
+            while len(hull) >= 2:
+                k1, k2 = hull[-2], hull[-1]
+                lhs = (utils[i, k2] - utils[i, k1]) * (costs[k] - costs[k1])
+                rhs = (utils[i, k] - utils[i, k1]) * (costs[k2] - costs[k1])
+                if lhs <= rhs:
+                    hull.pop()
+                else:
+                    break
+            hull.append(k)
+        for k1, k2 in zip(hull[:-1], hull[1:]):
+            gain = utils[i, k2] - utils[i, k1]
+            if gain > min_gain:
+                segments.append((gain / (costs[k2] - costs[k1]), i, k1, k2))
+
+    allocation = np.zeros(len(pilot_counts), dtype=np.int64)
+    blocked = []
+    remaining = budget
+    for _, i, k1, k2 in sorted(segments, key=lambda seg: -seg[0]):
+        if i in blocked:
+            continue
+        cost = costs[k2] - costs[k1]
+        if cost > remaining:
+            blocked.append(i)
+            continue
+        allocation[i] = costs[k2]
+        remaining -= cost
+
+    # what is left goes to the examples whose next segment did not fit, best ones first, as the
+    # most useful sample size that still fits
+    for i in blocked:
+        k1 = np.searchsorted(costs, allocation[i])
+        fits = [k for k in range(k1 + 1, len(costs))
+                if costs[k] - costs[k1] <= remaining and utils[i, k] > utils[i, k1] + min_gain]
+        if fits:
+            k2 = max(fits, key=lambda k: utils[i, k])
+            allocation[i] = costs[k2]
+            remaining -= costs[k2] - costs[k1]
+
+    return allocation, utils[np.arange(len(pilot_counts)),
+                             np.searchsorted(costs, allocation)]
+
 #def certify_smoothed(model, x, top_cats, alpha, noise, adv, sample_size=10**5, noise_batch_size=512):
 #    """
 #    Certify a smoothed model, given the top categories to certify for.
@@ -2,6 +2,7 @@ import numpy as np
 import pathlib
 import os
 import sys
+import time
 import torch
 import torch.nn as nn
 from argparse import ArgumentParser
@@ -13,7 +14,9 @@ from src.attacks import *
 from src.smooth import *
 from src.noises import *
 from src.datasets import *
-from src.utils import parse_noise_from_args
+from src.selection import *
+from src.counts import save_results
+from src.utils import parse_noise_from_args, manual_seed_all, derive_seed
 
 
 if __name__ == "__main__":
@@ -38,8 +41,27 @@ if __name__ == "__main__":
     argparser.add_argument("--rotate", action="store_true")
     argparser.add_argument("--output-dir", type=str, default=os.getenv("PT_OUTPUT_DIR"))
     argparser.add_argument("--save-path", type=str, default=None)
+    argparser.add_argument("--seed", type=int, default=None)
+    argparser.add_argument("--selector", default="vote", type=str, choices=["vote", "clean", "proxy"])
+    argparser.add_argument("--selector-model", default="LeNet", type=str)
+    argparser.add_argument("--selector-save-path", type=str, default=None)
+    argparser.add_argument("--budget", type=int, default=None)
+    argparser.add_argument("--sample-size-pilot", default=1000, type=int)
+    argparser.add_argument("--budget-adv", default=1, type=float)
+    argparser.add_argument("--budget-radii", default="0.25,0.5,1.0,1.5,2.0", type=str)
+    argparser.add_argument("--budget-num-sizes", default=8, type=int)
+    argparser.add_argument("--cascade-models", type=str, default=None)
+    argparser.add_argument("--cascade-save-paths", type=str, default=None)
+    argparser.add_argument("--cascade-adv", default=1, type=float)
+    argparser.add_argument("--cascade-radius", default=0.5, type=float)
     args = argparser.parse_args()
 
+    if args.budget and args.rotate:
+        argparser.error("--budget requires the same inputs in the pilot and certification passes, "
+                        "so it cannot be combined with --rotate")
+    if args.budget and args.cascade_models:
+        argparser.error("--budget and --cascade-models cannot be combined")
+
     test_dataset = get_dataset(args.dataset, "test")
     test_dataset = Subset(test_dataset, list(range(0, len(test_dataset), args.dataset_skip)))
     test_loader = DataLoader(test_dataset, shuffle=False, batch_size=args.batch_size,
@@ -50,13 +72,28 @@ if __name__ == "__main__":
     else:
         save_path = args.save_path
 
-    model = eval(args.model)(dataset=args.dataset, device=args.device)
-    saved_dict = torch.load(save_path)
-    model.load_state_dict(saved_dict)
-    model.eval()
+    model = load_model(args.model, args.dataset, args.device, save_path)
 
     noise = parse_noise_from_args(args, device=args.device, dim=get_dim(args.dataset))
 
+    if args.selector == "vote":
+        selector = SmoothedVoteSelector(model, noise, args.sample_size_pred, args.noise_batch_size)
+    elif args.selector == "clean":
+        selector = CleanSelector(model)
+    elif args.selector == "proxy":
+        proxy = load_model(args.selector_model, args.dataset, args.device, args.selector_save_path)
+        selector = ProxySelector(proxy, noise, args.sample_size_pred, args.noise_batch_size)
+
+    # cascade tiers, cheapest first; the model given by --model is always the final tier
+    tiers = []
+    if args.cascade_models:
+        for tier_name, tier_path in zip(args.cascade_models.split(","),
+                                        args.cascade_save_paths.split(",")):
+            tiers.append((tier_name, load_model(tier_name, args.dataset, args.device, tier_path)))
+        tiers.append((args.model, model))
+        tier_forwards = np.zeros(len(tiers), dtype=np.int64)
+        tier_elapsed = np.zeros(len(tiers))
+
     results = {
         "preds": np.zeros((len(test_dataset), get_num_labels(args.dataset))),
         "labels": np.zeros(len(test_dataset)),
@@ -65,23 +102,161 @@ if __name__ == "__main__":
         "radius_l1": np.zeros(len(test_dataset)),
         "radius_l2": np.zeros(len(test_dataset)),
         "radius_linf": np.zeros(len(test_dataset)),
+        "selection_agree": np.zeros(len(test_dataset)),
     }
+    if args.cascade_models:
+        results["tier"] = np.zeros(len(test_dataset))
+    counts = np.zeros((len(test_dataset), get_num_labels(args.dataset)), dtype=np.int64)
+    seeds = np.zeros(len(test_dataset), dtype=np.uint64)
+    pilot_seeds = np.zeros(len(test_dataset), dtype=np.uint64)
+    # every batch's noise is drawn from recorded seeds: the batch seed for certification (or,
+    # in a cascade, one derived per tier) and a derived one per tier for selection or the pilot,
+    # so that no certification replays the draws that chose its class, its sample size or its tier
+    batch_seeds = [torch.seed() if args.seed is None else args.seed + i
+                   for i in range(len(test_loader))]
+    selected = np.zeros(len(test_dataset), dtype=np.int64)
+    cert_forwards, cert_elapsed = 0, 0.0
 
     if args.rotate:
         rotate_noise = RotationNoise(0.0, args.device, dim=get_dim(args.dataset))
 
+    if args.budget:
+
+        # pilot stage: cheap estimates of the top-class probability, used only to decide how
+        # many of the budgeted samples each example receives in the certification stage
+        prob_pilot = np.zeros(len(test_dataset))
+
+        for i, (x, y) in tqdm(enumerate(test_loader), total=len(test_loader)):
+
+            x = x.to(args.device)
+            lower, upper = i * args.batch_size, (i + 1) * args.batch_size
+            pilot_seeds[lower:upper] = derive_seed(batch_seeds[i], "pilot", 0)
+            manual_seed_all(pilot_seeds[lower])
+            preds, top_cats = selector.select(x)
+            preds_pilot = smooth_predict_hard(model, x, noise, args.sample_size_pilot,
+                                              noise_batch_size=args.noise_batch_size)
+
+            results["preds"][lower:upper, :] = preds.probs.data.cpu().numpy()
+            prob_pilot[lower:upper] = preds_pilot.probs.gather(dim=1, index=top_cats.unsqueeze(1)) \
+                                                 .squeeze(1).cpu().numpy()
+
+        sample_sizes = np.geomspace(args.sample_size_pilot, args.sample_size_cert,
+                                    args.budget_num_sizes).round().astype(int)
+        radii = [float(r) for r in args.budget_radii.split(",")]
+        results["sample_size"], utility = allocate_sample_budget(
+            np.round(prob_pilot * args.sample_size_pilot), args.sample_size_pilot, noise,
+            args.budget_adv, radii, args.budget, sample_sizes)
+        results["prob_pilot"] = prob_pilot
+        pilot_forwards = len(test_dataset) * args.sample_size_pilot
+
+        print(f"Budget: {results['sample_size'].sum()} / {args.budget} forward passes, "
+              f"plus {pilot_forwards} for the pilot "
+              f"(total {results['sample_size'].sum() + pilot_forwards}), "
+              f"{(results['sample_size'] == 0).sum()} / {len(test_dataset)} abstained, "
+              f"fixed budget equivalent: {args.budget // len(test_dataset)} per example, "
+              f"expected radii covered: {utility.sum():.0f} / {len(radii) * len(test_dataset)}")
+
     for i, (x, y) in tqdm(enumerate(test_loader), total=len(test_loader)):
 
         x, y = x.to(args.device), y.to(args.device)
         x = rotate_noise.sample(x) if args.rotate else x
+        lower, upper = i * args.batch_size, (i + 1) * args.batch_size
 
-        preds = smooth_predict_hard(model, x, noise, args.sample_size_pred,
-                                           noise_batch_size=args.noise_batch_size)
-        top_cats = preds.probs.argmax(dim=1)
-        prob_lb = certify_prob_lb(model, x, top_cats, 0.001, noise,
-                                  args.sample_size_cert, noise_batch_size=args.noise_batch_size)
+        if args.budget:
+            preds = Categorical(probs=torch.tensor(results["preds"][lower:upper, :],
+                                                   dtype=torch.float, device=args.device))
+            top_cats = preds.probs.argmax(dim=1)
+        elif not args.cascade_models:
+            pilot_seeds[lower:upper] = derive_seed(batch_seeds[i], "pilot", 0)
+            manual_seed_all(pilot_seeds[lower])
+            preds, top_cats = selector.select(x)
 
-        lower, upper = i * args.batch_size, (i + 1) * args.batch_size
+        if not args.cascade_models:
+            seeds[lower:upper] = batch_seeds[i]
+            manual_seed_all(batch_seeds[i])
+
+        synchronize(args.device)
+        start = time.perf_counter()
+        if args.cascade_models:
+            preds = torch.zeros(len(x), get_num_labels(args.dataset), device=args.device)
+            top_cats = torch.zeros(len(x), dtype=torch.long, device=args.device)
+            prob_lb = torch.zeros(len(x))
+            active = torch.arange(len(x))
+            for t, (tier_name, tier_model) in enumerate(tiers):
+                if len(active) == 0:
+                    break
+                synchronize(args.device)
+                tier_start = time.perf_counter()
+                x_tier = x[active.to(args.device)]
+                pilot_seed = derive_seed(batch_seeds[i], "pilot", t)
+                cert_seed = derive_seed(batch_seeds[i], "cert", t)
+                manual_seed_all(pilot_seed)
+                if t < len(tiers) - 1:
+                    # independent pilot votes decide whether this tier is expected to reach the
+                    # requested radius; the certification outcome itself never triggers escalation
+                    preds_tier = smooth_predict_hard(tier_model, x_tier, noise, args.sample_size_pilot,
+                                                     args.noise_batch_size)
+                    cats_tier = preds_tier.probs.argmax(dim=1)
+                    prob_tier = preds_tier.probs.gather(dim=1, index=cats_tier.unsqueeze(1)).squeeze(1)
+                    keep = torch.from_numpy(expected_radius(prob_tier.cpu().numpy(), noise,
+                                                            args.cascade_adv, args.sample_size_cert)
+                                            >= args.cascade_radius)
+                    tier_forwards[t] += len(x_tier) * args.sample_size_pilot
+                else:
+                    num_forwards = selector.num_forwards
+                    preds_tier, cats_tier = selector.select(x_tier)
+                    keep = torch.ones(len(x_tier), dtype=torch.bool)
+                    tier_forwards[t] += selector.num_forwards - num_forwards
+                idx, sel = keep.nonzero().squeeze(1), active[keep]
+                if len(idx) > 0:
+                    idx_dev, sel_dev = idx.to(args.device), sel.to(args.device)
+                    manual_seed_all(cert_seed)
+                    prob_lb[sel], cert_counts = certify_prob_lb(tier_model, x_tier[idx_dev],
+                                                               cats_tier[idx_dev], 0.001, noise,
+                                                               args.sample_size_cert,
+                                                               args.noise_batch_size,
+                                                               return_counts=True)
+                    counts[lower + sel.numpy()] = cert_counts.cpu().numpy()
+                    seeds[lower + sel.numpy()] = cert_seed
+                    pilot_seeds[lower + sel.numpy()] = pilot_seed
+                    top_cats[sel_dev] = cats_tier[idx_dev]
+                    preds[sel_dev] = preds_tier.probs[idx_dev]
+                    results["tier"][lower + sel.numpy()] = t
+                    results["selection_agree"][lower + sel.numpy()] = \
+                        (cert_counts.argmax(dim=1) == cats_tier[idx_dev]).cpu().numpy()
+                    tier_forwards[t] += len(idx) * args.sample_size_cert
+                active = active[~keep]
+                synchronize(args.device)
+                tier_elapsed[t] += time.perf_counter() - tier_start
+            preds = Categorical(probs=preds)
+            cert_forwards += tier_forwards[-1]
+        elif args.budget:
+            sample_size = torch.tensor(results["sample_size"][lower:upper])
+            prob_lb = torch.zeros(len(x))
+            for n in sample_size.unique():
+                if n == 0:
+                    continue
+                idx = (sample_size == n).nonzero().squeeze(1)
+                prob_lb[idx], cert_counts = certify_prob_lb(model, x[idx.to(args.device)],
+                                                           top_cats[idx.to(args.device)], 0.001,
+                                                           noise, int(n), args.noise_batch_size,
+                                                           return_counts=True)
+                counts[lower + idx.numpy()] = cert_counts.cpu().numpy()
+                results["selection_agree"][lower + idx.numpy()] = \
+                    (cert_counts.argmax(dim=1) == top_cats[idx.to(args.device)]).cpu().numpy()
+            cert_forwards += int(sample_size.sum())
+        else:
+            prob_lb, cert_counts = certify_prob_lb(model, x, top_cats, 0.001, noise,
+                                                  args.sample_size_cert, args.noise_batch_size,
+                                                  return_counts=True)
+            counts[lower:upper] = cert_counts.cpu().numpy()
+            results["selection_agree"][lower:upper] = \
+                (cert_counts.argmax(dim=1) == top_cats).cpu().numpy()
+            cert_forwards += len(x) * args.sample_size_cert
+        synchronize(args.device)
+        cert_elapsed += time.perf_counter() - start
+
+        selected[lower:upper] = top_cats.cpu().numpy()
         results["preds"][lower:upper, :] = preds.probs.data.cpu().numpy()
         results["labels"][lower:upper] = y.data.cpu().numpy()
         results["prob_lb"][lower:upper] = prob_lb.cpu().numpy()
@@ -90,10 +265,30 @@ if __name__ == "__main__":
         results["radius_linf"][lower:upper] = noise.certifylinf(prob_lb).cpu().numpy()
         results["preds_nll"][lower:upper] = -preds.log_prob(y).cpu().numpy()
 
-    save_path = f"{args.output_dir}/{args.experiment_name}"
-    pathlib.Path(save_path).mkdir(parents=True, exist_ok=True)
-    for k, v in results.items():
-        np.save(f"{save_path}/{k}.npy", v)
+    if args.cascade_models:
+        secs_per_forward = tier_elapsed[-1] / max(tier_forwards[-1], 1)
+        for t, (tier_name, _) in enumerate(tiers):
+            print(f"Tier {t} ({tier_name}): "
+                  f"Certified: {int((results['tier'] == t).sum())}\t"
+                  f"Forwards: {tier_forwards[t]}\t"
+                  f"Secs: {tier_elapsed[t]:.1f}")
+        if tier_forwards[-1] > 0:
+            print(f"Cascade secs: {tier_elapsed.sum():.1f} (vs. an estimated "
+                  f"{len(test_dataset) * (args.sample_size_pred + args.sample_size_cert) * secs_per_forward:.1f}"
+                  f" with {args.model} alone)")
+        cert_elapsed = secs_per_forward * cert_forwards
+
+    # the smoothed vote with the base model is what selection used to cost; estimate it from the
+    # per-forward cost observed during certification
+    baseline_elapsed = len(test_dataset) * args.sample_size_pred * cert_elapsed / max(cert_forwards, 1)
+    print(f"Selector: {selector}\t"
+          f"Agreement with certification vote: {results['selection_agree'].mean():.4f}\t"
+          f"Forwards: {selector.num_forwards}\t"
+          f"Secs: {selector.elapsed:.1f} (vs. {baseline_elapsed:.1f} for the smoothed vote, "
+          f"saved {baseline_elapsed - selector.elapsed:.1f})")
+
+    save_results(f"{args.output_dir}/{args.experiment_name}", results, counts, selected,
+                 results["labels"], seeds, args, pilot_seeds=pilot_seeds)
 
     train_dataset = get_dataset(args.dataset, "train")
     train_loader = DataLoader(train_dataset, shuffle=False, 
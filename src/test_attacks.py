@@ -0,0 +1,126 @@
+import unittest
+import torch
+from unittest import mock
+from src.attacks import project_onto_ball, project_onto_l1_ball_sort, steepest_ascent_direction, \
+                        pgd_attack_smooth, pgd_attack_smooth_multi_eps
+from src.models import LinearModel
+from src.noises import GaussianNoise
+
+
+class TestAttacks(unittest.TestCase):
+
+    def test_project_onto_l1_ball(self):
+        '''Test that the pivoting l1 projection agrees with the sorting-based one, both for points
+        inside and outside the ball, including the 2-d setting of ex_projection_l1_ball.'''
+        torch.manual_seed(0)
+        inputs = [torch.rand((10, 2)) * 1.5 * torch.sign(torch.rand((10, 2)) - 0.5),
+                  torch.randn(8, 3, 32, 32) * 0.05,
+                  torch.randn(4, 3, 224, 224) * 0.01]
+        for x in inputs:
+            for eps in [0.5, 1.0, 4.0, 1e4]:
+                with self.subTest(shape=tuple(x.shape), eps=eps):
+                    proj = project_onto_ball(x, eps, 1)
+                    self.assertEqual(proj.shape, x.shape)
+                    self.assertTrue(torch.allclose(proj, project_onto_l1_ball_sort(x, eps),
+                                                   atol=1e-6))
+                    norms = proj.reshape(len(x), -1).norm(p=1, dim=1)
+                    self.assertTrue((norms <= eps * (1 + 1e-5)).all())
+
+    def test_project_onto_ball_per_example_eps(self):
+        '''Test that a tensor of radii projects each row as its own scalar radius would.'''
+        torch.manual_seed(0)
+        x = torch.randn(6, 3, 8, 8)
+        eps = torch.tensor([0.1, 0.5, 1.0, 2.0, 5.0, 100.0])
+        for p in [1, 2, "inf"]:
+            with self.subTest(p=p):
+                proj = project_onto_ball(x, eps, p)
+                for row, r in enumerate(eps.tolist()):
+                    self.assertTrue(torch.allclose(proj[row:row + 1],
+                                                   project_onto_ball(x[row:row + 1], r, p),
+                                                   atol=1e-6))
+
+    def test_l1_steepest_ascent_direction(self):
+        '''Test that the sparse l1 step keeps the top 1/16 coordinates with unit l1 norm.'''
+        torch.manual_seed(0)
+        grads = torch.randn(5, 3072)
+        direction = steepest_ascent_direction(grads.clone(), 1)
+        k = 3072 - 3072 * 15 // 16 + 1
+        self.assertTrue(((direction != 0).sum(dim=1) == k).all())
+        self.assertTrue(torch.allclose(direction.abs().sum(dim=1), torch.ones(5)))
+        kept = grads.abs() >= torch.kthvalue(grads.abs(), 3072 * 15 // 16, dim=1).values[:, None]
+        self.assertTrue(torch.equal(direction != 0, kept))
+        self.assertTrue(torch.equal(torch.sign(direction[kept]), torch.sign(grads[kept])))
+
+    def test_pgd_early_stop_and_restarts(self):
+        '''Test that early stopping spends no steps on examples the smoothed model already gets
+        wrong and keeps every restart inside its ball.'''
+        torch.manual_seed(0)
+        model = LinearModel(dataset="mnist", device="cpu")
+        model.eval()
+        noise = GaussianNoise("cpu", 784, sigma=0.25)
+        x, y = torch.rand(8, 1, 28, 28), torch.randint(0, 10, (8,))
+        with torch.no_grad():
+            wrong = model.forward(x).argmax(dim=1) != y
+        for restarts in [1, 3]:
+            with self.subTest(restarts=restarts):
+                x_adv, _, steps_used = pgd_attack_smooth(model, x, y, 0.5, noise, 64, steps=6,
+                                                         adv=2, restarts=restarts,
+                                                         early_stop=False, return_steps=True)
+                self.assertTrue((steps_used == 6 * restarts).all())
+                x_adv, _, steps_used = pgd_attack_smooth(model, x, y, 0.5, noise, 64, steps=6,
+                                                         adv=2, restarts=restarts,
+                                                         early_stop=True, return_steps=True)
+                norms = (x_adv - x).reshape(len(x), -1).norm(dim=1)
+                self.assertTrue((norms <= 0.5 + 1e-4).all())
+                self.assertTrue((steps_used <= 6 * restarts).all())
+                # a linear model on these noise levels almost always agrees with its smoothed self
+                self.assertTrue((steps_used[wrong] < 6 * restarts).all())
+
+    def test_multi_eps_matches_separate_attacks(self):
+        '''Test that the batched attack at several radii finds the same adversarial examples as
+        separate attacks at each radius, given the same noise offsets, with and without warm
+        starts from the largest radius.'''
+        torch.manual_seed(0)
+        model = LinearModel(dataset="mnist", device="cpu")
+        model.eval()
+        noise = GaussianNoise("cpu", 784, sigma=0.25)
+        x = torch.rand(4, 1, 28, 28)
+        # labelled by the model itself, so that the attacks have something to do before they stop
+        with torch.no_grad():
+            y = model.forward(x).argmax(dim=1)
+        eps_range = [0.25, 1.0, 0.5]
+        offsets = [torch.randn(4, 32, 1, 28, 28) * 0.25 for _ in eps_range]
+        kwargs = dict(steps=5, adv=2, early_stop=True)
+
+        with mock.patch("src.attacks.sample_noise_offsets", side_effect=[torch.cat(offsets)]):
+            x_multi, steps_multi = pgd_attack_smooth_multi_eps(model, x, y, eps_range, noise, 32,
+                                                               return_steps=True, **kwargs)
+        self.assertTrue((steps_multi[0] > 1).any())
+        for k, eps in enumerate(eps_range):
+            with mock.patch("src.attacks.sample_noise_offsets", side_effect=[offsets[k]]):
+                x_adv, _, steps_used = pgd_attack_smooth(model, x, y, eps, noise, 32,
+                                                         return_steps=True, **kwargs)
+            self.assertTrue(torch.allclose(x_multi[k], x_adv, atol=1e-5))
+            self.assertTrue(torch.equal(steps_multi[k], steps_used))
+
+        # warm starts: the largest radius first, then the others from its solution
+        with mock.patch("src.attacks.sample_noise_offsets",
+                        side_effect=[offsets[1], torch.cat([offsets[0], offsets[2]])]):
+            x_multi, steps_multi = pgd_attack_smooth_multi_eps(model, x, y, eps_range, noise, 32,
+                                                               warm_start=True, warm_steps=3,
+                                                               return_steps=True, **kwargs)
+        with mock.patch("src.attacks.sample_noise_offsets", side_effect=[offsets[1]]):
+            x_largest, _, steps_largest = pgd_attack_smooth(model, x, y, 1.0, noise, 32,
+                                                            return_steps=True, **kwargs)
+        self.assertTrue(torch.allclose(x_multi[1], x_largest, atol=1e-5))
+        for k in [0, 2]:
+            with mock.patch("src.attacks.sample_noise_offsets", side_effect=[offsets[k]]):
+                x_adv, _, steps_used = pgd_attack_smooth(model, x, y, eps_range[k], noise, 32,
+                                                         delta_init=x_largest - x,
+                                                         return_steps=True,
+                                                         **dict(kwargs, steps=3))
+            self.assertTrue(torch.allclose(x_multi[k], x_adv, atol=1e-5))
+            self.assertTrue(torch.equal(steps_multi[k], steps_used + steps_largest))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+import torch.nn as nn
+from src.cache import CertificateCache, certify_cached
+from src.noises import GaussianNoise
+from src.smooth import prob_lb_from_counts
+
+
+class ConstantModel(nn.Module):
+    """
+    Votes for class 0 on every noisy sample, and counts its forward passes.
+    """
+    def __init__(self):
+        super().__init__()
+        self.num_forwards = 0
+
+    def forward(self, x):
+        self.num_forwards += len(x)
+        logits = torch.zeros(len(x), 10)
+        logits[:, 0] = 1
+        return logits
+
+
+class TestCertificateCache(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = ConstantModel()
+        self.noise = GaussianNoise('cpu', 3 * 4 * 4, sigma=0.5)
+        self.x = torch.rand(2, 3, 4, 4)
+        self.ladder = (1000, 2000, 4000)
+
+    def certify(self, cache, radius):
+        return certify_cached(self.model, self.x, self.noise, cache, radius, adv=2,
+                              sample_size_pred=8, sample_sizes=self.ladder, model_key="m")
+
+    def test_refine_up_the_ladder(self):
+        '''Test that repeat requests are answered from the cache, and that a larger radius only
+        draws the samples up to the next ladder size.'''
+        cache = CertificateCache()
+        self.certify(cache, 1.0)
+        self.assertEqual(self.model.num_forwards, 2 * (8 + 1000))
+        self.assertEqual(cache.misses, 2)
+
+        self.certify(cache, 1.0)
+        self.assertEqual(self.model.num_forwards, 2 * (8 + 1000))
+        self.assertEqual(cache.hits, 2)
+
+        _, _, radius = self.certify(cache, 1.25)
+        self.assertEqual(self.model.num_forwards, 2 * (8 + 2000))
+        self.assertEqual(cache.refinements, 2)
+        self.assertTrue((radius >= 1.25).all())
+        for entry in cache.entries.values():
+            self.assertEqual(entry.tolist(), [0, 2000, 2000])
+
+    def test_union_bound_over_the_ladder(self):
+        '''Test that the bound is computed at level alpha / len(ladder), even on a cache hit.'''
+        cache = CertificateCache()
+        for radius in [1.0, 1.0, 1.25]:
+            _, prob_lb, _ = self.certify(cache, radius)
+            size = 1000 if radius == 1.0 else 2000
+            expected = prob_lb_from_counts(torch.tensor([[size, 0]]), torch.tensor([0]),
+                                           0.001 / len(self.ladder))
+            self.assertTrue(torch.allclose(prob_lb, expected.expand(2)))
+            looser = prob_lb_from_counts(torch.tensor([[size, 0]]), torch.tensor([0]), 0.001)
+            self.assertTrue((prob_lb < looser).all())
+
+    def test_lru_and_disk_eviction(self):
+        '''Test that the least recently used entries move to disk, that the disk tier keeps only
+        the most recently evicted ones, and that a new cache reloads them from disk.'''
+        with tempfile.TemporaryDirectory() as disk_dir:
+            cache = CertificateCache(max_entries=2, disk_dir=disk_dir, max_disk_entries=2)
+            for k in range(5):
+                cache.put(f"key{k}", np.array([k, k, k]))
+            cache.get("key3")
+            cache.put("key5", np.array([5, 5, 5]))
+            self.assertEqual(list(cache.entries), ["key3", "key5"])
+            self.assertEqual(sorted(os.listdir(disk_dir)), ["key2.npy", "key4.npy"])
+            self.assertEqual(cache.evictions, 4)
+            self.assertEqual(cache.disk_evictions, 2)
+            self.assertIsNone(cache.get("key0"))
+
+            reloaded = CertificateCache(max_entries=2, disk_dir=disk_dir, max_disk_entries=2)
+            self.assertEqual(reloaded.get("key4").tolist(), [4, 4, 4])
+            self.assertEqual(reloaded.disk_hits, 1)
+            self.assertEqual(list(reloaded.entries), ["key4"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import runpy
+import sys
+import tempfile
+import unittest
+import numpy as np
+import torch
+import torch.nn as nn
+from unittest import mock
+from src.counts import save_counts, load_counts
+from src.noises import GaussianNoise
+from src.smooth import certify_prob_lb
+
+
+class TestCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.meta = {"noise": "GaussianNoise", "sigma": 0.5, "lambd": None, "k": None, "j": None,
+                     "a": None, "dataset": "cifar", "alpha": 0.001}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        '''Test that sparse counts, uint64 seeds and the other columns survive a save and load
+        with their values and dtypes.'''
+        counts = np.zeros((5, 1000), dtype=np.int64)
+        counts[0, [3, 999]] = [70000, 30000]
+        counts[2, 0] = 2 ** 31
+        counts[4, [1, 2, 3]] = [1, 2, 3]
+        seeds = np.array([0, 1, 2 ** 63, 2 ** 64 - 1, 12345], dtype=np.uint64)
+        pilot_seeds = seeds[::-1].copy()
+        path = os.path.join(self.tmp.name, "counts.npz")
+        save_counts(path, counts, [3, 0, 0, 1, 3], [3, 1, 0, 2, 2], seeds, self.meta,
+                    pilot_seeds=pilot_seeds)
+        with np.load(path) as data:
+            self.assertEqual(len(data["votes"]), 6)
+        store = load_counts(path)
+        self.assertTrue(np.array_equal(store["counts"], counts))
+        self.assertEqual(store["counts"].dtype, np.int64)
+        self.assertEqual(store["sample_size"].tolist(), [100000, 0, 2 ** 31, 0, 6])
+        self.assertEqual(store["top_cats"].tolist(), [3, 0, 0, 1, 3])
+        self.assertEqual(store["labels"].tolist(), [3, 1, 0, 2, 2])
+        self.assertEqual(store["seeds"].dtype, np.uint64)
+        self.assertTrue(np.array_equal(store["seeds"], seeds))
+        self.assertTrue(np.array_equal(store["pilot_seeds"], pilot_seeds))
+        self.assertEqual(store["meta"], self.meta)
+
+        save_counts(path, counts, [3, 0, 0, 1, 3], [3, 1, 0, 2, 2], seeds, self.meta)
+        self.assertIsNone(load_counts(path)["pilot_seeds"])
+
+    def test_recertify(self):
+        '''Test that recertify recomputes exactly the lower bounds that certification returned
+        from the stored counts.'''
+        torch.manual_seed(0)
+        model = nn.Sequential(nn.Flatten(), nn.Linear(3 * 32 * 32, 10))
+        noise = GaussianNoise('cpu', 3 * 32 * 32, sigma=0.5)
+        x = torch.rand(4, 3, 32, 32)
+        top_cats = model(x).argmax(dim=1)
+        with torch.no_grad():
+            prob_lb, counts = certify_prob_lb(model, x, top_cats, 0.001, noise, 500,
+                                              return_counts=True)
+        experiment_path = os.path.join(self.tmp.name, "exp")
+        os.makedirs(experiment_path)
+        save_counts(f"{experiment_path}/counts.npz", counts.numpy(), top_cats.numpy(),
+                    top_cats.numpy(), np.zeros(4, dtype=np.uint64), self.meta)
+        argv = ["recertify", "--output-dir", self.tmp.name, "--experiment-name", "exp",
+                "--tag", "t"]
+        with mock.patch.object(sys, "argv", argv), mock.patch("builtins.print"):
+            runpy.run_module("src.recertify", run_name="__main__")
+        recertified = np.load(f"{experiment_path}/recertify_t/prob_lb.npy")
+        self.assertTrue(np.array_equal(recertified, prob_lb.numpy()))
+        self.assertTrue(np.allclose(np.load(f"{experiment_path}/recertify_t/radius_l2.npy"),
+                                    noise.certifyl2(prob_lb).numpy()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+import torch
+from unittest import mock
+from PIL import Image
+from torchvision import transforms
+import torchvision.transforms.functional as TF
+from src.datasets import random_crop_flip, InMemoryLoader
+
+
+class TestInMemoryLoader(unittest.TestCase):
+
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        self.data = torch.randint(0, 256, (64, 3, 32, 32), dtype=torch.uint8, generator=generator)
+        self.targets = torch.randint(0, 10, (64,), generator=generator)
+
+    def test_crop_flip_matches_torchvision(self):
+        '''Test that the batched crop and flip equal RandomCrop(32, padding=4) followed by
+        RandomHorizontalFlip() and ToTensor() with the same offsets and flips, and that the
+        offsets and flips are drawn as uniformly as torchvision draws them.'''
+        x = random_crop_flip(self.data, generator=torch.Generator().manual_seed(1)).float() / 255
+        generator = torch.Generator().manual_seed(1)
+        oy = torch.randint(0, 9, (64, 1), generator=generator).squeeze(1)
+        ox = torch.randint(0, 9, (64, 1), generator=generator).squeeze(1)
+        flip = (torch.rand(64, 1, generator=generator) < 0.5).squeeze(1)
+        self.assertTrue(flip.any() and not flip.all())
+        for i in range(64):
+            image = Image.fromarray(self.data[i].permute(1, 2, 0).numpy())
+            image = TF.crop(TF.pad(image, 4), int(oy[i]), int(ox[i]), 32, 32)
+            if flip[i]:
+                image = TF.hflip(image)
+            self.assertTrue(torch.equal(x[i], transforms.ToTensor()(image)))
+
+        # RandomCrop draws its offsets uniformly from 0, ..., 2 * padding
+        generator = torch.Generator().manual_seed(2)
+        ones = torch.ones(20000, 1, 8, 8, dtype=torch.uint8)
+        x = random_crop_flip(ones, padding=4, generator=generator)
+        # the number of padded rows above the image is max(0, 4 - offset)
+        top = (x[:, 0].sum(dim=2) > 0).float().argmax(dim=1)
+        frequencies = np.bincount(top.numpy(), minlength=5) / 20000
+        self.assertTrue(np.allclose(frequencies, [5 / 9, 1 / 9, 1 / 9, 1 / 9, 1 / 9], atol=0.015))
+
+    def test_normalization(self):
+        '''Test that unaugmented batches equal ToTensor() on the same images, in order.'''
+        with mock.patch("src.datasets.get_uint8_dataset", return_value=(self.data, self.targets)):
+            loader = InMemoryLoader("cifar", "test", batch_size=10)
+        batches = list(loader)
+        self.assertEqual(len(batches), 7)
+        x, y = torch.cat([b[0] for b in batches]), torch.cat([b[1] for b in batches])
+        self.assertTrue(torch.equal(y, self.targets))
+        for i in range(64):
+            image = Image.fromarray(self.data[i].permute(1, 2, 0).numpy())
+            self.assertTrue(torch.equal(x[i], transforms.ToTensor()(image)))
+
+if __name__ == '__main__':
+    unittest.main()
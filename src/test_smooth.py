@@ -0,0 +1,114 @@
+import unittest
+import numpy as np
+import torch
+import torch.nn as nn
+from src.noises import GaussianNoise
+from src.smooth import direct_train_log_lik, direct_train_backward, sample_noise_offsets, \
+                       smooth_predict_soft, smooth_loss_grad, certification_probability, \
+                       allocate_sample_budget, prob_lb_from_counts
+from src.utils import PhaseTimer
+
+
+class TestDirectTraining(unittest.TestCase):
+
+    def test_micro_batched_gradient(self):
+        '''Test that the micro-batched backward pass of the direct training objective matches
+        backpropagating through a single forward of all samples.'''
+        torch.manual_seed(0)
+        model = nn.Sequential(nn.Flatten(), nn.Linear(3 * 4 * 4, 16), nn.ReLU(), nn.Linear(16, 10))
+        noise = GaussianNoise('cpu', 3 * 4 * 4, sigma=0.5)
+        x, y = torch.rand(6, 3, 4, 4), torch.randint(0, 10, (6,))
+        samples = noise.sample(x.unsqueeze(1).expand(6, 16, 3, 4, 4).reshape(-1, 3, 4, 4))
+
+        model.zero_grad()
+        loss = -direct_train_log_lik(model, x, y, noise, 16, samples=samples).mean()
+        loss.backward()
+        grads = [p.grad.clone() for p in model.parameters()]
+
+        for micro_batch_size in [512, 32, 16, 5, 1]:
+            with self.subTest(micro_batch_size=micro_batch_size):
+                model.zero_grad()
+                timer = PhaseTimer()
+                loss_mb = direct_train_backward(model, x, y, noise, 16, micro_batch_size,
+                                                samples=samples, timer=timer)
+                self.assertEqual(set(timer.pop()), {"noise", "forward", "backward"})
+                self.assertAlmostEqual(loss.item(), loss_mb.item(), places=5)
+                for p, g in zip(model.parameters(), grads):
+                    self.assertTrue(torch.allclose(p.grad, g, atol=1e-6))
+
+    def test_running_stats_updated_once(self):
+        '''Test that the two-pass backward updates the batch norm running statistics once per
+        micro-batch of the second pass, as training on those micro-batches would.'''
+        torch.manual_seed(0)
+        model = nn.Sequential(nn.Flatten(), nn.Linear(3 * 4 * 4, 16), nn.BatchNorm1d(16),
+                              nn.ReLU(), nn.Linear(16, 10))
+        noise = GaussianNoise('cpu', 3 * 4 * 4, sigma=0.5)
+        x, y = torch.rand(3, 3, 4, 4), torch.randint(0, 10, (3,))
+        samples = noise.sample(x.unsqueeze(1).expand(3, 16, 3, 4, 4).reshape(-1, 3, 4, 4))
+        bn = nn.BatchNorm1d(16)
+        bn.load_state_dict(model[2].state_dict())
+        direct_train_backward(model, x, y, noise, 16, 6, samples=samples)
+        with torch.no_grad():
+            for example in samples.view(3, 16, 3, 4, 4):
+                for chunk in example.split(6):
+                    bn(model[1](model[0](chunk)))
+        self.assertTrue(torch.allclose(model[2].running_mean, bn.running_mean, atol=1e-6))
+        self.assertTrue(torch.allclose(model[2].running_var, bn.running_var, atol=1e-6))
+        self.assertEqual(model[2].num_batches_tracked.item(), bn.num_batches_tracked.item())
+
+    def test_chunked_smooth_loss_grad(self):
+        '''Test that the chunked gradient of the soft smoothed loss matches backpropagating
+        through a single forward of all samples, including chunks that do not divide the
+        sample size.'''
+        torch.manual_seed(0)
+        model = nn.Sequential(nn.Flatten(), nn.Linear(3 * 4 * 4, 16), nn.ReLU(), nn.Linear(16, 10))
+        noise = GaussianNoise('cpu', 3 * 4 * 4, sigma=0.5)
+        x, y = torch.rand(6, 3, 4, 4), torch.randint(0, 10, (6,))
+        offsets = sample_noise_offsets(noise, x, 64)
+
+        x_grad = x.clone().requires_grad_()
+        forecast = smooth_predict_soft(model, x_grad, noise, 64, 64, offsets=offsets)
+        loss = -forecast.log_prob(y)
+        loss.sum().backward()
+
+        for noise_batch_size in [512, 64, 16, 5, 1]:
+            with self.subTest(noise_batch_size=noise_batch_size):
+                loss_chunked, probs, grads = smooth_loss_grad(model, x, y, noise, 64,
+                                                              noise_batch_size, offsets=offsets)
+                self.assertTrue(torch.allclose(loss_chunked, loss.detach(), atol=1e-5))
+                self.assertTrue(torch.allclose(probs, forecast.probs.detach(), atol=1e-6))
+                self.assertTrue(torch.allclose(grads, x_grad.grad, atol=1e-6))
+
+    def test_certification_probability(self):
+        '''Test the probability of certifying each radius given pilot votes against simulating
+        the posterior, fresh votes and their certificates.'''
+        noise = GaussianNoise('cpu', 3072, sigma=0.5)
+        rng = np.random.RandomState(0)
+        pilot_counts, pilot_size, sample_size = np.array([1000, 990, 900, 700, 550]), 1000, 2000
+        radii = [0.25, 0.5, 1.0]
+        prob = certification_probability(pilot_counts, pilot_size, noise, 2, radii, sample_size)
+        for i, k in enumerate(pilot_counts):
+            p = rng.beta(k + 1, pilot_size - k + 1, size=4000)
+            votes = rng.binomial(sample_size, p)
+            counts = np.stack([votes, sample_size - votes], axis=1)
+            radius = noise.certifyl2(prob_lb_from_counts(counts, np.zeros(4000, dtype=int),
+                                                         0.001)).numpy()
+            for j, r in enumerate(radii):
+                self.assertAlmostEqual(prob[i, j], (radius >= r).mean(), delta=0.03)
+
+    def test_allocate_sample_budget(self):
+        '''Test that the allocation stays within the budget, skips hopeless examples and gives
+        more samples to uncertain examples than to sure ones.'''
+        noise = GaussianNoise('cpu', 3072, sigma=0.5)
+        pilot_counts = np.array([1000, 990, 900, 700, 550, 300])
+        sample_sizes = np.geomspace(1000, 100000, 8).round().astype(int)
+        allocation, utility = allocate_sample_budget(pilot_counts, 1000, noise, 2,
+                                                     [0.25, 0.5, 1.0], 200000, sample_sizes)
+        self.assertLessEqual(allocation.sum(), 200000)
+        self.assertGreater(allocation.sum(), 150000)
+        self.assertEqual(allocation[-1], 0)
+        self.assertGreater(allocation[1], allocation[0])
+        self.assertTrue((utility <= 3).all())
+
+if __name__ == '__main__':
+    unittest.main()
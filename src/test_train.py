@@ -0,0 +1,61 @@
+import runpy
+import sys
+import tempfile
+import unittest
+import torch
+from unittest import mock
+from torch.utils.data import TensorDataset
+from src.utils import save_atomic
+
+
+class Interrupted(Exception):
+    pass
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        self.dataset = TensorDataset(torch.rand(96, 1, 28, 28, generator=generator),
+                                     torch.randint(0, 10, (96,), generator=generator))
+
+    def train(self, output_dir, extra_args, interrupt=False):
+        argv = ["train", "--device", "cpu", "--model", "LinearModel", "--dataset", "mnist",
+                "--batch-size", "16", "--num-workers", "0", "--num-epochs", "2",
+                "--save-every", "1", "--seed", "0", "--noise", "GaussianNoise", "--sigma", "0.25",
+                "--experiment-name", "exp", "--output-dir", output_dir] + extra_args
+
+        def save_then_interrupt(obj, path):
+            save_atomic(obj, path)
+            if interrupt and path.endswith("train_state.torch"):
+                raise Interrupted
+
+        with mock.patch.object(sys, "argv", argv), \
+             mock.patch("src.datasets.get_dataset", return_value=self.dataset), \
+             mock.patch("src.utils.save_atomic", side_effect=save_then_interrupt), \
+             mock.patch("builtins.print"):
+            runpy.run_module("src.train", run_name="__main__")
+        return torch.load(f"{output_dir}/exp/model_ckpt.torch")
+
+    def test_resume_matches_straight_run(self):
+        '''Test that training 2 epochs straight gives the same parameters as training 1 epoch,
+        stopping, and resuming for the second, also from the middle of an epoch and with adversarial
+        warm starts.'''
+        for extra_args, position in [([], (1, 0)),
+                                     (["--ckpt-every-iters", "4"], (0, 4)),
+                                     (["--adversarial", "--adv-warm-start", "--adv-steps", "2",
+                                       "--eps", "0.5"], (1, 0))]:
+            with self.subTest(extra_args=extra_args), tempfile.TemporaryDirectory() as tmp:
+                straight = self.train(f"{tmp}/straight", extra_args)
+                with self.assertRaises(Interrupted):
+                    self.train(f"{tmp}/resumed", extra_args, interrupt=True)
+                state = torch.load(f"{tmp}/resumed/exp/train_state.torch", weights_only=False)
+                self.assertEqual((state["epoch"], state["itr"]), position)
+                self.assertEqual(state["perturbations"] is None,
+                                 "--adv-warm-start" not in extra_args)
+                resumed = self.train(f"{tmp}/resumed", extra_args + ["--resume"])
+                for name in straight:
+                    self.assertTrue(torch.equal(straight[name], resumed[name]), name)
+
+if __name__ == '__main__':
+    unittest.main()
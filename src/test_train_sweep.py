@@ -0,0 +1,37 @@
+import unittest
+import torch
+from argparse import Namespace
+from src.train_sweep import SweepTrainer, StackedSweepTrainer
+
+
+class TestStackedSweep(unittest.TestCase):
+
+    def test_stacked_matches_looped(self):
+        '''Test that training the stacked parameters gives the same models as training each
+        model of the sweep separately, from the same seed.'''
+        run_args = [Namespace(model="MLP", dataset="mnist", device="cpu", lr=0.05, num_epochs=2,
+                              print_every=10 ** 9, save_every=10 ** 9, noise=noise, sigma=sigma,
+                              lambd=None, k=None, j=None, a=None, experiment_name=f"run{i}",
+                              output_dir=None)
+                    for i, (noise, sigma) in enumerate([("GaussianNoise", 0.25),
+                                                        ("GaussianNoise", 0.5),
+                                                        ("UniformNoise", 0.5)])]
+        batches = [(torch.rand(16, 1, 28, 28), torch.randint(0, 10, (16,))) for _ in range(5)]
+        trainers = []
+        for trainer_cls in [SweepTrainer, StackedSweepTrainer]:
+            torch.manual_seed(0)
+            trainer = trainer_cls(run_args, len(batches))
+            for x, y in batches:
+                trainer.step(x, y)
+            if trainer_cls is StackedSweepTrainer:
+                trainer.stacked.unstack()
+            trainers.append(trainer)
+        looped, stacked = trainers
+        for model_looped, model_stacked in zip(looped.models, stacked.models):
+            for p_looped, p_stacked in zip(model_looped.parameters(), model_stacked.parameters()):
+                self.assertTrue(torch.allclose(p_looped, p_stacked, atol=1e-6))
+        for losses_looped, losses_stacked in zip(looped.train_losses, stacked.train_losses):
+            self.assertAlmostEqual(losses_looped[0], losses_stacked[0], places=5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import torch
+from src.utils import derive_seed, manual_seed_all, has_plateaued, compress_lr_schedule
+
+
+class TestSeeds(unittest.TestCase):
+
+    def draw(self, seed):
+        manual_seed_all(seed)
+        return torch.randn(1000)
+
+    def test_derived_streams(self):
+        '''Test that derived seeds are reproducible, and that the pilot and certification streams
+        of the cascade tiers differ from each other and from the stream of the batch seed.'''
+        seed = 2 ** 64 - 1
+        self.assertEqual(derive_seed(seed, "cert", 1), derive_seed(seed, "cert", 1))
+        streams = [self.draw(seed)] + [self.draw(derive_seed(seed, stage, t))
+                                       for stage in ("pilot", "cert") for t in range(3)]
+        for i in range(len(streams)):
+            for j in range(i + 1, len(streams)):
+                self.assertFalse((streams[i] == streams[j]).any())
+
+
+class TestPlateau(unittest.TestCase):
+
+    def test_has_plateaued(self):
+        '''Test that the loss plateaus once none of the last patience losses improved on the best
+        before them by more than the relative min_delta, and never on a too-short history.'''
+        losses = [1.0, 0.8, 0.79, 0.795, 0.81]
+        self.assertFalse(has_plateaued([], 2, 0.01))
+        self.assertFalse(has_plateaued(losses[:2], 2, 0.01))
+        self.assertFalse(has_plateaued([1.0, 1.0, 1.0], 3, 0.01))
+        # 0.79 improves on 0.8 by 1.25%, so only the last two losses count as no improvement
+        self.assertTrue(has_plateaued(losses, 2, 0.01))
+        self.assertFalse(has_plateaued(losses, 3, 0.01))
+        self.assertTrue(has_plateaued(losses, 3, 0.02))
+        self.assertFalse(has_plateaued(losses + [0.7], 2, 0.01))
+
+    def test_compress_lr_schedule(self):
+        '''Test that after a plateau the learning rate anneals from its current value to zero
+        at the new end epoch, through every remaining epoch.'''
+        optimizer = torch.optim.SGD([torch.zeros(1, requires_grad=True)], lr=0.1)
+        annealer = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, 100)
+        for epoch in range(9):
+            optimizer.step()
+            annealer.step()
+        plateau_lr, end_epoch = optimizer.param_groups[0]["lr"], 15
+        # epoch 9 is trained with plateau_lr, then plateaus, as in src.train
+        optimizer.step()
+        annealer = compress_lr_schedule(optimizer, 9, end_epoch)
+        annealer.step()
+        lrs = []
+        for epoch in range(10, end_epoch):
+            lrs.append(optimizer.param_groups[0]["lr"])
+            optimizer.step()
+            annealer.step()
+        self.assertTrue(plateau_lr > lrs[0] and all(a > b > 0 for a, b in zip(lrs, lrs[1:])))
+        self.assertAlmostEqual(optimizer.param_groups[0]["lr"], 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
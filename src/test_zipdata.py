@@ -0,0 +1,73 @@
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from PIL import Image
+from torchvision import transforms
+from src.lib.zipdata import ZipData
+
+
+class TestZipData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "val.zip")
+        self.map_file = os.path.join(self.tmp.name, "val_map.txt")
+        rng = np.random.RandomState(0)
+        self.images = {}
+        with ZipFile(self.path, "w") as zip_file, open(self.map_file, "w") as map_file:
+            zip_file.writestr("val/", "")
+            for i in range(6):
+                name = f"val/{i}.jpg" if i % 2 == 0 else f"val/{i}.png"
+                buffer = BytesIO()
+                image = Image.fromarray(rng.randint(0, 256, (300, 400, 3), dtype=np.uint8))
+                image.save(buffer, format="JPEG" if name.endswith(".jpg") else "PNG")
+                zip_file.writestr(name, buffer.getvalue(),
+                                  compress_type=ZIP_STORED if i < 3 else ZIP_DEFLATED)
+                map_file.write(f"val.zip@/{name}\t{i % 3}\n")
+                self.images[i] = np.asarray(Image.open(BytesIO(buffer.getvalue())).convert("RGB"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_and_pickle(self):
+        '''Test that members are read as ZipFile would, from a persisted index, and that the
+        dataset survives pickling (as for spawned data loader workers).'''
+        dataset = ZipData(self.path, self.map_file)
+        self.assertTrue(os.path.exists(self.path + ".index.npz"))
+        self.assertEqual(len(dataset), 6)
+        self.assertEqual(dataset.targets.tolist(), [0, 1, 2, 0, 1, 2])
+        for i in range(6):
+            image, target = dataset[i]
+            self.assertEqual(target, i % 3)
+            self.assertTrue(np.array_equal(np.asarray(image), self.images[i]))
+
+        names = [f"val/{i}.jpg" if i % 2 == 0 else f"val/{i}.png" for i in range(6)]
+        self.assertEqual(dataset.samples, [(name, i % 3) for i, name in enumerate(names)])
+        self.assertEqual(dataset.class_to_idx, {name: i % 3 for i, name in enumerate(names)})
+
+        dataset = pickle.loads(pickle.dumps(ZipData(self.path, self.map_file)))
+        self.assertTrue(np.array_equal(np.asarray(dataset[3][0]), self.images[3]))
+        dataset = pickle.loads(pickle.dumps(dataset))
+        self.assertTrue(np.array_equal(np.asarray(dataset[4][0]), self.images[4]))
+        self.assertEqual(dataset.samples[4], ("val/4.jpg", 1))
+
+    def test_draft_decode(self):
+        '''Test that JPEGs are decoded at a reduced scale that still covers the resize.'''
+        dataset = ZipData(self.path, self.map_file, transforms.Resize(100))
+        self.assertEqual(dataset.draft_size, (100, 100))
+        image, _ = dataset[0]
+        self.assertEqual(min(image.size), 100)
+        dataset = ZipData(self.path, self.map_file,
+                          transforms.Compose([transforms.Resize(100), transforms.CenterCrop(90)]))
+        sample = Image.open(BytesIO(dataset._read(0)))
+        sample.draft("RGB", dataset.draft_size)
+        self.assertEqual(sample.size, (200, 150))
+        self.assertIsNone(ZipData(self.path, self.map_file,
+                                  transforms.RandomResizedCrop(90)).draft_size)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,34 @@
+import contextlib
+import json
 import logging
 import pathlib
 import pickle
 import os
+import time
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
+import torch.multiprocessing as mp
 from argparse import ArgumentParser
 from torchnet import meter
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset, DistributedSampler
 from tqdm import tqdm
 from src.models import *
 from src.noises import *
 from src.smooth import *
-from src.attacks import pgd_attack_smooth
-from src.datasets import get_dataset, get_dim
-from src.utils import parse_noise_from_args
+from src.attacks import pgd_attack_smooth, free_adversarial_step
+from src.datasets import get_dataset, get_dim, InMemoryLoader, NoiseCollate, seed_noise_worker, \
+                         IndexedDataset, get_stratified_indices, get_uint8_dataset
+from src.background_cert import certify_checkpoints
+from src.distributed import init_distributed, broadcast_module, sync_gradients_before_step, \
+                            broadcast_flag, broadcast_scalar, convert_sync_batchnorm, \
+                            average_buffers, averaged_buffers
+from src.utils import parse_noise_from_args, get_rng_states, set_rng_states, save_atomic, \
+                      PhaseTimer, append_jsonl, has_plateaued, compress_lr_schedule, \
+                      manual_seed_all
 
 
 if __name__ == "__main__":
@@ -40,68 +53,418 @@ if __name__ == "__main__":
     argparser.add_argument("--model", default="ResNet", type=str)
     argparser.add_argument("--dataset", default="cifar", type=str)
     argparser.add_argument("--adversarial", action="store_true")
+    argparser.add_argument("--adv-mode", default="pgd", type=str, choices=["pgd", "free"])
+    argparser.add_argument("--adv-steps", default=20, type=int)
+    argparser.add_argument("--adv-steps-min", default=None, type=int)
+    argparser.add_argument("--adv-sample-size", default=4, type=int)
+    argparser.add_argument("--adv-sample-size-min", default=None, type=int)
+    argparser.add_argument("--adv-warm-start", action="store_true")
+    argparser.add_argument("--free-replays", default=4, type=int)
     argparser.add_argument("--stability", action="store_true")
     argparser.add_argument("--direct", action="store_true")
+    argparser.add_argument("--direct-micro-batch-size", default=None, type=int)
+    argparser.add_argument("--direct-memory-mb", default=None, type=float)
+    argparser.add_argument("--fast-data", action="store_true")
+    argparser.add_argument("--noise-in-workers", action="store_true")
+    argparser.add_argument("--seed", default=None, type=int)
+    argparser.add_argument("--distributed", action="store_true")
+    argparser.add_argument("--sync-bn", action="store_true")
+    argparser.add_argument("--num-threads", default=None, type=int)
+    argparser.add_argument("--holdout-size", default=0, type=int)
+    argparser.add_argument("--holdout-sample-size", default=1000, type=int)
+    argparser.add_argument("--holdout-radii", default="0.25,0.5,1.0", type=str)
+    argparser.add_argument("--teacher", default=None, type=str)
+    argparser.add_argument("--distill-temp", default=1.0, type=float)
+    argparser.add_argument("--teacher-cache", action="store_true")
+    argparser.add_argument("--teacher-cache-samples", default=16, type=int)
+    argparser.add_argument("--distill-report-size", default=500, type=int)
+    argparser.add_argument("--distill-report-sample-size", default=1000, type=int)
+    argparser.add_argument("--val-size", default=0, type=int)
+    argparser.add_argument("--plateau-patience", default=5, type=int)
+    argparser.add_argument("--plateau-min-delta", default=0.01, type=float)
+    argparser.add_argument("--plateau-action", default="stop", type=str, choices=["stop", "compress"])
+    argparser.add_argument("--plateau-compress-epochs", default=10, type=int)
+    argparser.add_argument("--bg-cert-size", default=0, type=int)
+    argparser.add_argument("--bg-cert-sample-size", default=1000, type=int)
+    argparser.add_argument("--bg-cert-threads", default=1, type=int)
+    argparser.add_argument("--resume", action="store_true")
+    argparser.add_argument("--init-from", default=None, type=str)
+    argparser.add_argument("--ckpt-every-iters", default=None, type=int)
+    argparser.add_argument("--ckpt-every-mins", default=None, type=float)
+    argparser.add_argument("--state-every", default=None, type=int)
     argparser.add_argument('--output-dir', type=str, default=os.getenv("PT_OUTPUT_DIR"))
     args = argparser.parse_args()
 
-    logging.basicConfig(level=logging.INFO)
+    if args.noise_in_workers and (args.fast_data or args.adversarial):
+        argparser.error("--noise-in-workers cannot be combined with --fast-data or --adversarial")
+    if args.teacher is not None and (args.adversarial or args.stability or args.direct):
+        argparser.error("--teacher cannot be combined with --adversarial, --stability or --direct")
+    if args.teacher_cache and (args.teacher is None or args.noise_in_workers):
+        argparser.error("--teacher-cache requires --teacher and cannot be used with "
+                        "--noise-in-workers")
+    if args.sync_bn and not args.distributed:
+        argparser.error("--sync-bn requires --distributed")
+
+    rank, world_size = 0, 1
+    if args.distributed:
+        # one process per replica, launched with torchrun; each process draws its own noise,
+        # so the seeds are offset by rank
+        rank, world_size, local_world_size = init_distributed()
+        torch.set_num_threads(args.num_threads or max(os.cpu_count() // local_world_size, 1))
+        manual_seed_all((args.seed if args.seed is not None else 0) + rank)
+    else:
+        if args.num_threads is not None:
+            torch.set_num_threads(args.num_threads)
+        if args.seed is not None:
+            manual_seed_all(args.seed)
+
+    logging.basicConfig(level=logging.INFO if rank == 0 else logging.WARNING)
     logger = logging.getLogger(__name__)
 
     model = eval(args.model)(dataset=args.dataset, device=args.device)
+    if args.init_from is not None:
+        # warm start from the final weights of another experiment, e.g. a neighbouring sigma
+        model.load_state_dict(torch.load(f"{args.output_dir}/{args.init_from}/model_ckpt.torch",
+                                         map_location=args.device))
+    if args.distributed:
+        model = unwrap_data_parallel(model)
+        if args.sync_bn:
+            model = convert_sync_batchnorm(model)
+        broadcast_module(model)
     model.train()
 
-    train_loader = DataLoader(get_dataset(args.dataset, "train"),
-                              shuffle=True,
-                              batch_size=args.batch_size,
-                              num_workers=args.num_workers,
-                              pin_memory=False)
+    noise = parse_noise_from_args(args, device=args.device, dim=get_dim(args.dataset))
+    need_indices = args.adv_warm_start or args.teacher_cache
+    noise_in_loader = args.fast_data and not (args.adversarial or args.stability or args.direct)
+
+    train_indices, val_loader = None, None
+    if args.val_size > 0:
+        # a fixed stratified part of the training split is held out, and the noisy loss on it is
+        # monitored to detect when training has plateaued
+        val_dataset = get_dataset(args.dataset, "train")
+        val_indices = get_stratified_indices(val_dataset, args.val_size, seed=1)
+        train_indices = np.setdiff1d(np.arange(len(val_dataset)), val_indices)
+        val_loader = DataLoader(Subset(val_dataset, val_indices), batch_size=args.batch_size)
+
+    if args.fast_data:
+        train_loader = InMemoryLoader(args.dataset, "train",
+                                      shuffle=True,
+                                      batch_size=args.batch_size,
+                                      noise=noise if noise_in_loader else None,
+                                      device=args.device,
+                                      indices=train_indices,
+                                      return_indices=need_indices,
+                                      num_replicas=world_size,
+                                      rank=rank,
+                                      seed=args.seed or 0)
+    elif args.noise_in_workers:
+        mode = "direct" if args.direct else "stability" if args.stability else "augment"
+        worker_noise = parse_noise_from_args(args, device="cpu", dim=get_dim(args.dataset))
+        train_dataset = get_dataset(args.dataset, "train")
+        if train_indices is not None:
+            train_dataset = Subset(train_dataset, train_indices)
+        sampler = DistributedSampler(train_dataset, world_size, rank, seed=args.seed or 0) \
+                  if args.distributed else None
+        train_loader = DataLoader(train_dataset,
+                                  shuffle=sampler is None,
+                                  sampler=sampler,
+                                  batch_size=args.batch_size,
+                                  num_workers=args.num_workers,
+                                  collate_fn=NoiseCollate(worker_noise, mode, sample_size=16),
+                                  worker_init_fn=seed_noise_worker,
+                                  pin_memory=args.device.startswith("cuda"))
+    else:
+        train_dataset = get_dataset(args.dataset, "train")
+        if train_indices is not None:
+            train_dataset = Subset(train_dataset, train_indices)
+        if need_indices:
+            train_dataset = IndexedDataset(train_dataset)
+        sampler = DistributedSampler(train_dataset, world_size, rank, seed=args.seed or 0) \
+                  if args.distributed else None
+        train_loader = DataLoader(train_dataset,
+                                  shuffle=sampler is None,
+                                  sampler=sampler,
+                                  batch_size=args.batch_size,
+                                  num_workers=args.num_workers,
+                                  pin_memory=False)
+
+    teacher, teacher_probs = None, None
+    if args.teacher is not None:
+        # distillation: the model is trained on noisy inputs to match the teacher's outputs
+        teacher_args = pickle.load(open(f"{args.output_dir}/{args.teacher}/args.pkl", "rb"))
+        teacher = eval(teacher_args.model)(dataset=args.dataset, device=args.device)
+        teacher.load_state_dict(torch.load(f"{args.output_dir}/{args.teacher}/model_ckpt.torch",
+                                           map_location=args.device))
+        teacher.eval()
+
+    if args.teacher_cache:
+        # instead of the teacher's output on each noisy input, its smoothed class probabilities
+        # on the (unaugmented) training example, computed once and reused every epoch
+        if args.fast_data:
+            cache_data = train_loader.data
+        else:
+            cache_data = get_uint8_dataset(args.dataset, "train")[0]
+            if train_indices is not None:
+                cache_data = cache_data[train_indices]
+        teacher_probs = torch.zeros(len(cache_data), get_num_labels(args.dataset))
+        with torch.no_grad():
+            for lower in range(0, len(cache_data), args.batch_size):
+                x = cache_data[lower:lower + args.batch_size].to(args.device).float() / 255
+                teacher_probs[lower:lower + args.batch_size] = \
+                    smooth_predict_soft(teacher, x, noise, args.teacher_cache_samples).probs.cpu()
 
     optimizer = optim.SGD(model.parameters(),
                           lr=args.lr,
                           momentum=0.9,
                           weight_decay=1e-4,
                           nesterov=True)
+    if args.distributed:
+        sync_gradients_before_step(optimizer)
     annealer = optim.lr_scheduler.CosineAnnealingLR(optimizer, args.num_epochs)
 
     loss_meter = meter.AverageValueMeter()
     time_meter = meter.TimeMeter(unit=False)
 
-    noise = parse_noise_from_args(args, device=args.device, dim=get_dim(args.dataset))
-
     train_losses = []
+    val_losses = []
+    # the run ends early at end_epoch once the validation loss plateaus
+    end_epoch, plateau_epoch = args.num_epochs, None
+
+    experiment_path = f"{args.output_dir}/{args.experiment_name}"
+    state_path = f"{experiment_path}/train_state.torch"
+    if rank == 0:
+        pathlib.Path(experiment_path).mkdir(parents=True, exist_ok=True)
+        pickle.dump(args, open(f"{experiment_path}/args.pkl", "wb"))
+
+    bg_cert_proc = None
+    if args.bg_cert_size > 0 and rank == 0:
+        # certifies each checkpoint as it appears, writing cert_acc_epochs.jsonl
+        bg_cert_proc = mp.get_context("spawn").Process(
+            target=certify_checkpoints,
+            args=(experiment_path, args.bg_cert_size, args.bg_cert_sample_size,
+                  [float(r) for r in args.holdout_radii.split(",")], args.device,
+                  args.bg_cert_threads, 10.0, args.batch_size, time.time()),
+            daemon=True)
+        bg_cert_proc.start()
+
+    def save_train_state(epoch, itr, epoch_rng_states):
+        """
+        Full training state, written so that --resume reproduces an uninterrupted run exactly:
+        the RNG states at the start of the epoch regenerate the same shuffling, and the current
+        RNG states continue the noise and augmentation draws where they stopped.
+        The --adv-warm-start perturbations (as large as the training set) are only included when
+        warm starts are on. In distributed mode the RNG states and the perturbations (which each
+        rank only holds for the examples it attacked) of every rank are gathered and rank 0 writes
+        the file.
+        """
+        rng_states, saved_perturbations = get_rng_states(), perturbations
+        if args.distributed:
+            gathered = [None] * world_size
+            dist.all_gather_object(gathered, (epoch_rng_states, rng_states))
+            epoch_rng_states, rng_states = [states[0] for states in gathered], \
+                                           [states[1] for states in gathered]
+            if args.adv_warm_start:
+                saved_perturbations = [None] * world_size if rank == 0 else None
+                dist.gather_object(perturbations, saved_perturbations)
+        if rank != 0:
+            return
+        save_atomic({
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "annealer": annealer.state_dict(),
+            "epoch": epoch,
+            "itr": itr,
+            "epoch_rng_states": epoch_rng_states,
+            "rng_states": rng_states,
+            "train_losses": train_losses,
+            "loss_meter": dict(loss_meter.__dict__),
+            "val_losses": val_losses,
+            "end_epoch": end_epoch,
+            "plateau_epoch": plateau_epoch,
+            "perturbations": saved_perturbations,
+            "args": args,
+        }, state_path)
+
+    perturbations = None
+    start_epoch, start_itr, resume_rng_states = 0, 0, None
+    if args.resume and os.path.exists(state_path):
+        state = torch.load(state_path, weights_only=False)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        annealer.load_state_dict(state["annealer"])
+        train_losses = state["train_losses"]
+        loss_meter.__dict__.update(state["loss_meter"])
+        val_losses, end_epoch, plateau_epoch = state["val_losses"], state["end_epoch"], \
+                                               state["plateau_epoch"]
+        start_epoch, start_itr = state["epoch"], state["itr"]
+        if args.distributed:
+            state["epoch_rng_states"] = state["epoch_rng_states"][rank]
+            state["rng_states"] = state["rng_states"][rank]
+            state["perturbations"] = state["perturbations"] and state["perturbations"][rank]
+        perturbations = state["perturbations"]
+        set_rng_states(state["epoch_rng_states"])
+        resume_rng_states = state["rng_states"]
+        logger.info(f"Resuming from epoch {start_epoch}, itr {start_itr}")
+    elif args.resume:
+        logger.warning(f"--resume given but {state_path} does not exist, training from scratch")
+
+    last_ckpt_time, num_itrs = time.time(), 0
+    timings_path = f"{experiment_path}/timings_train.jsonl"
+    samples_per_image = 16 if args.direct else 4 if args.adversarial else 1
+    pending_loss, pending_n = 0., 0
+    direct_micro_batch_size = args.direct_micro_batch_size
+
+    def checkpoint_due():
+        due = (args.ckpt_every_iters is not None and num_itrs % args.ckpt_every_iters == 0) or \
+              (args.ckpt_every_mins is not None and
+               time.time() - last_ckpt_time >= 60 * args.ckpt_every_mins)
+        if args.distributed and args.ckpt_every_mins is not None:
+            # clocks differ between processes, and saving is a collective
+            due = broadcast_flag(due)
+        return due
+
+    for epoch in range(start_epoch, args.num_epochs):
 
-    for epoch in range(args.num_epochs):
+        if epoch >= end_epoch:
+            break
 
-        for i, (x, y) in enumerate(train_loader):
+        epoch_rng_states = get_rng_states()
+        if args.distributed:
+            (train_loader if args.fast_data else train_loader.sampler).set_epoch(epoch)
+        batches = enumerate(train_loader)
+        if epoch == start_epoch and start_itr > 0:
+            # replay the interrupted epoch's shuffling up to where it stopped (a state written
+            # at the end of an epoch already holds the RNG states the next epoch starts from)
+            for _ in range(start_itr):
+                next(batches)
+            set_rng_states(resume_rng_states)
 
-            x, y = x.to(args.device), y.to(args.device)
+        if args.adv_steps_min is None:
+            adv_steps = args.adv_steps
+        else:
+            adv_steps = int(round(args.adv_steps_min + (args.adv_steps - args.adv_steps_min) *
+                                  epoch / max(args.num_epochs - 1, 1)))
 
-            if args.adversarial:
+        # phase timings are accumulated per print window and per epoch; the loss is summed on
+        # device and only read back when logging, so no step forces a host sync
+        timer = PhaseTimer()
+        epoch_timings, epoch_images, window_images = {}, 0, 0
+
+        for i, batch in batches:
+
+            if need_indices:
+                *batch, idx = batch
+
+            if args.noise_in_workers:
+                x, x_noisy, y = (t.to(args.device, non_blocking=True) for t in batch)
+            else:
+                x, y = batch
+                x, y = x.to(args.device), y.to(args.device)
+            timer.mark("data")
+
+            if args.adversarial and args.adv_warm_start:
+                if perturbations is None:
+                    # last perturbation found for each training example, used to warm-start its
+                    # attack in the next epoch
+                    perturbations = torch.zeros(torch.Size([len(train_loader.dataset)
+                                                            if not args.fast_data
+                                                            else len(train_loader.data)])
+                                                + x.shape[1:], dtype=torch.half)
+                delta_init = perturbations[idx].to(args.device).float()
+            else:
+                delta_init = None
+
+            if args.adversarial and args.adv_mode == "free":
+                loss, delta = free_adversarial_step(model, optimizer, x, y, args.eps, noise,
+                                                    sample_size=args.adv_sample_size,
+                                                    replays=args.free_replays,
+                                                    adv=args.adv, delta=delta_init, timer=timer)
+                if args.adv_warm_start:
+                    perturbations[idx] = delta.cpu().half()
+            elif args.adversarial:
                 model.eval()
-                x, loss = pgd_attack_smooth(model, x, y, args.eps, noise, sample_size=4, adv=args.adv)
+                x_adv, loss = pgd_attack_smooth(model, x, y, args.eps, noise,
+                                                sample_size=args.adv_sample_size,
+                                                steps=adv_steps, adv=args.adv, delta_init=delta_init,
+                                                sample_size_min=args.adv_sample_size_min)
                 model.train()
+                if args.adv_warm_start:
+                    perturbations[idx] = (x_adv - x).cpu().half()
             elif args.stability:
-                x_tilde = noise.sample(x.view(len(x), -1)).view(x.shape)
-            elif not args.direct:
+                x_tilde = x_noisy if args.noise_in_workers else \
+                          noise.sample(x.view(len(x), -1)).view(x.shape)
+            elif args.noise_in_workers and not args.direct:
+                x = x_noisy
+            elif not args.direct and not noise_in_loader:
                 x = noise.sample(x.view(len(x), -1)).view(x.shape)
 
-            if args.direct:
-                loss = -direct_train_log_lik(model, x, y, noise, sample_size=16).mean()
+            timer.mark("noise")
+
+            if args.direct and direct_micro_batch_size is None and args.direct_memory_mb:
+                direct_micro_batch_size = estimate_micro_batch_size(model, x, args.direct_memory_mb)
+                logger.info(f"Direct training micro-batch size: {direct_micro_batch_size}")
+
+            if not (args.adversarial and args.adv_mode == "free"):
+                optimizer.zero_grad()
+            if args.direct and direct_micro_batch_size is not None:
+                samples = x_noisy if args.noise_in_workers else None
+                loss = direct_train_backward(model, x, y, noise, sample_size=16,
+                                             micro_batch_size=direct_micro_batch_size,
+                                             samples=samples, timer=timer)
+            elif args.direct:
+                samples = x_noisy if args.noise_in_workers else None
+                loss = -direct_train_log_lik(model, x, y, noise, sample_size=16,
+                                             samples=samples).mean()
             elif args.stability:
                 pred_x = model.forecast(model.forward(x_tilde))
                 pred_x_tilde = model.forecast(model.forward(x_tilde))
                 loss = -pred_x.log_prob(y) + 6.0 * torch.distributions.kl_divergence(pred_x, pred_x_tilde)
                 loss = loss.mean()
+            elif args.teacher_cache:
+                target = teacher_probs[idx].to(args.device)
+                loss = -(target * F.log_softmax(model.forward(x), dim=1)).sum(dim=1).mean()
+            elif args.teacher is not None:
+                with torch.no_grad():
+                    target = F.softmax(teacher.forward(x) / args.distill_temp, dim=1)
+                log_probs = F.log_softmax(model.forward(x) / args.distill_temp, dim=1)
+                loss = -(target * log_probs).sum(dim=1).mean() * args.distill_temp ** 2
             elif not args.adversarial:
                 loss = model.loss(x, y).mean()
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            loss_meter.add(loss.cpu().data.numpy(), n=1)
+            timer.mark("forward")
+
+            if args.adversarial and args.adv_mode == "free":
+                pass  # the replays have already updated the parameters
+            elif args.direct and direct_micro_batch_size is not None:
+                optimizer.step()
+            else:
+                loss.backward()
+                timer.mark("backward")
+                optimizer.step()
+            timer.mark("optimizer")
+            pending_loss, pending_n = pending_loss + loss.detach(), pending_n + 1
+            window_images += len(y)
 
             if i % args.print_every == 0:
+                loss_meter.add(float(pending_loss), n=pending_n)
+                pending_loss, pending_n = 0., 0
+                timer.mark("sync")
+                timings = timer.pop()
+                for phase, secs in timings.items():
+                    epoch_timings[phase] = epoch_timings.get(phase, 0.) + secs
+                window_secs = sum(timings.values())
+                if rank == 0:
+                    append_jsonl(timings_path, {
+                        "type": "window",
+                        "epoch": epoch,
+                        "itr": i,
+                        "loss": loss_meter.value()[0],
+                        "images": window_images,
+                        **{f"{phase}_secs": secs for phase, secs in timings.items()},
+                        "images_per_sec": window_images / window_secs,
+                        "samples_per_sec": window_images * samples_per_image / window_secs,
+                    })
+                epoch_images, window_images = epoch_images + window_images, 0
                 logger.info(f"Epoch: {epoch}\t"
                             f"Itr: {i} / {len(train_loader)}\t"
                             f"Loss: {loss_meter.value()[0]:.2f}\t"
@@ -110,18 +473,143 @@ if __name__ == "__main__":
                 train_losses.append(loss_meter.value()[0])
                 loss_meter.reset()
 
+            num_itrs += 1
+            if i + 1 < len(train_loader) and checkpoint_due():
+                if pending_n > 0:
+                    loss_meter.add(float(pending_loss), n=pending_n)
+                    pending_loss, pending_n = 0., 0
+                save_train_state(epoch, i + 1, epoch_rng_states)
+                last_ckpt_time = time.time()
+
+        for phase, secs in timer.pop().items():
+            epoch_timings[phase] = epoch_timings.get(phase, 0.) + secs
+        epoch_images += window_images
+        epoch_secs = sum(epoch_timings.values())
+        if rank == 0:
+            append_jsonl(timings_path, {
+                "type": "epoch",
+                "epoch": epoch,
+                "images": epoch_images,
+                **{f"{phase}_secs": secs for phase, secs in epoch_timings.items()},
+                "images_per_sec": epoch_images / epoch_secs,
+                "samples_per_sec": epoch_images * samples_per_image / epoch_secs,
+            })
+        logger.info(f"Epoch: {epoch}\t"
+                    f"Images/s: {epoch_images / epoch_secs:.1f}\t" +
+                    "\t".join(f"{phase}: {100 * secs / epoch_secs:.0f}%"
+                               for phase, secs in epoch_timings.items()))
+
         if (epoch + 1) % args.save_every == 0:
-            save_path = f"{args.output_dir}/{args.experiment_name}/{epoch}/"
-            pathlib.Path(save_path).mkdir(parents=True, exist_ok=True)
-            torch.save(model.state_dict(), f"{save_path}/model_ckpt.torch")
+            # without --sync-bn each rank's batch norm running statistics only reflect its own
+            # shard, so checkpoints get their average; every rank then trains on with its own
+            with averaged_buffers(model) if args.distributed else contextlib.nullcontext():
+                if rank == 0:
+                    save_path = f"{args.output_dir}/{args.experiment_name}/{epoch}/"
+                    pathlib.Path(save_path).mkdir(parents=True, exist_ok=True)
+                    save_atomic(data_parallel_state_dict(model), f"{save_path}/model_ckpt.torch")
+
+        if val_loader is not None:
+            model.eval()
+            # the same noise (and augmentation) every epoch, without disturbing training
+            rng_states = get_rng_states()
+            manual_seed_all(0)
+            val_loss = noisy_loss(model, noise, val_loader)
+            set_rng_states(rng_states)
+            if args.distributed:
+                # without --sync-bn the ranks' running statistics differ, so they would disagree
+                # on the plateau and stop at different epochs; every rank acts on rank 0's loss
+                val_loss = broadcast_scalar(val_loss)
+            val_losses.append(val_loss)
+            model.train()
+            logger.info(f"Epoch: {epoch}\tVal loss: {val_losses[-1]:.3f}")
+            if plateau_epoch is None and \
+               has_plateaued(val_losses, args.plateau_patience, args.plateau_min_delta):
+                plateau_epoch = epoch
+                if args.plateau_action == "stop":
+                    end_epoch = epoch + 1
+                else:
+                    # anneal from the current learning rate to zero over the remaining epochs
+                    end_epoch = min(end_epoch, epoch + 1 + args.plateau_compress_epochs)
+                    annealer = compress_lr_schedule(optimizer, epoch, end_epoch)
+                logger.info(f"Val loss plateaued at epoch {epoch}, ending at epoch {end_epoch}")
 
         annealer.step()
 
-    pathlib.Path(f"{args.output_dir}/{args.experiment_name}").mkdir(parents=True, exist_ok=True)
-    save_path = f"{args.output_dir}/{args.experiment_name}/model_ckpt.torch"
-    torch.save(model.state_dict(), save_path)
-    args_path = f"{args.output_dir}/{args.experiment_name}/args.pkl"
-    pickle.dump(args, open(args_path, "wb"))
-    save_path = f"{args.output_dir}/{args.experiment_name}/losses_train.npy"
-    np.save(save_path, np.array(train_losses))
+        # besides the iteration and wall-clock intervals, the state is written every --state-every
+        # epochs (by default along with the model checkpoints), so that --resume has something
+        # to resume from
+        state_every = args.state_every or args.save_every
+        if checkpoint_due() or (epoch + 1) % state_every == 0:
+            save_train_state(epoch + 1, 0, get_rng_states())
+            last_ckpt_time = time.time()
+
+    if args.distributed:
+        average_buffers(model)
+        dist.destroy_process_group()
+
+    if rank == 0:
+        pathlib.Path(f"{args.output_dir}/{args.experiment_name}").mkdir(parents=True, exist_ok=True)
+        if val_loader is not None:
+            save_path = f"{args.output_dir}/{args.experiment_name}/losses_val.npy"
+            np.save(save_path, np.array(val_losses))
+            # written before the final checkpoint, from which background_cert.py reads the epoch
+            # training actually ended at
+            save_path = f"{args.output_dir}/{args.experiment_name}/early_stop.json"
+            json.dump({
+                "reason": "plateau" if plateau_epoch is not None else "num_epochs",
+                "action": args.plateau_action if plateau_epoch is not None else None,
+                "plateau_epoch": plateau_epoch,
+                "end_epoch": end_epoch,
+                "num_epochs": args.num_epochs,
+                "best_val_loss": min(val_losses),
+                "best_epoch": int(np.argmin(val_losses)),
+            }, open(save_path, "w"), indent=2)
+        save_path = f"{args.output_dir}/{args.experiment_name}/model_ckpt.torch"
+        save_atomic(data_parallel_state_dict(model), save_path)
+        args_path = f"{args.output_dir}/{args.experiment_name}/args.pkl"
+        pickle.dump(args, open(args_path, "wb"))
+        save_path = f"{args.output_dir}/{args.experiment_name}/losses_train.npy"
+        np.save(save_path, np.array(train_losses))
+
+        if args.holdout_size > 0:
+            # certified accuracy on a fixed stratified subset of the test set, to compare training
+            # modes (e.g. --adv-mode, --adv-warm-start) against each other at a modest sample budget
+            test_dataset = get_dataset(args.dataset, "test")
+            holdout_loader = DataLoader(Subset(test_dataset, get_stratified_indices(test_dataset,
+                                                                                    args.holdout_size)),
+                                        batch_size=args.batch_size, num_workers=args.num_workers)
+            radii = [float(r) for r in args.holdout_radii.split(",")]
+            model.eval()
+            torch.manual_seed(0)
+            cert_acc = certified_accuracy(model, noise, holdout_loader, radii, args.adv,
+                                          sample_size_cert=args.holdout_sample_size)
+            logger.info("Holdout certified accuracy: " +
+                        "\t".join(f"{r}: {acc:.3f}" for r, acc in zip(radii, cert_acc)))
+            save_path = f"{args.output_dir}/{args.experiment_name}/cert_acc_holdout.npy"
+            np.save(save_path, np.stack([radii, cert_acc]))
+
+        if args.teacher is not None and args.distill_report_size > 0:
+            # certified accuracy and certification time of the student against its teacher
+            test_dataset = get_dataset(args.dataset, "test")
+            report_loader = DataLoader(Subset(test_dataset, get_stratified_indices(
+                                           test_dataset, args.distill_report_size)),
+                                       batch_size=args.batch_size, num_workers=args.num_workers)
+            radii = [float(r) for r in args.holdout_radii.split(",")]
+            report = {"radii": radii}
+            model.eval()
+            for name, forecaster in (("student", model), ("teacher", teacher)):
+                torch.manual_seed(0)
+                start = time.time()
+                cert_acc = certified_accuracy(forecaster, noise, report_loader, radii, args.adv,
+                                              sample_size_cert=args.distill_report_sample_size)
+                report.update({f"cert_acc_{name}": cert_acc.tolist(),
+                               f"secs_{name}": time.time() - start})
+            logger.info(f"Certification speedup over teacher: "
+                        f"{report['secs_teacher'] / report['secs_student']:.1f}x\t" +
+                        "\t".join(f"{r}: {s:.3f} vs. {t:.3f}" for r, s, t in
+                                   zip(radii, report["cert_acc_student"], report["cert_acc_teacher"])))
+            save_path = f"{args.output_dir}/{args.experiment_name}/distill_report.json"
+            json.dump(report, open(save_path, "w"), indent=2)
 
+    if bg_cert_proc is not None:
+        bg_cert_proc.join()
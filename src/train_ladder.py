@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from argparse import ArgumentParser
+
+
+def ladder_order(sigmas, anchor):
+    """
+    Order sigmas so that each one after the anchor can start from the closest sigma trained
+    before it.
+
+    Returns
+    -------
+    ladder: list of (sigma, init_sigma) pairs, with init_sigma None for the anchor
+    """
+    ladder, finished = [(anchor, None)], [anchor]
+    remaining = sorted(set(sigmas) - {anchor})
+    while remaining:
+        sigma = min(remaining, key=lambda s: (min(abs(s - f) for f in finished), s))
+        init_sigma = min(finished, key=lambda f: (abs(sigma - f), f))
+        ladder.append((sigma, init_sigma))
+        finished.append(sigma)
+        remaining.remove(sigma)
+    return ladder
+
+
+if __name__ == "__main__":
+
+    argparser = ArgumentParser(description="Train a ladder of sigmas with src.train, warm "
+                                           "starting each run from its nearest finished "
+                                           "neighbour. Unrecognised arguments are passed on "
+                                           "to src.train.")
+    argparser.add_argument("--sigmas", default="0.15,0.25,0.5,0.75,1.0,1.25,1.5,1.75,2.0,2.25,"
+                                               "2.5,2.75,3.0,3.25,3.5", type=str)
+    argparser.add_argument("--anchor-sigma", default=None, type=float)
+    argparser.add_argument("--num-epochs", default=120, type=int)
+    argparser.add_argument("--warm-epochs", default=30, type=int)
+    argparser.add_argument("--warm-lr", default=None, type=float)
+    argparser.add_argument("--parity-sigmas", default="", type=str)
+    argparser.add_argument("--holdout-size", default=500, type=int)
+    argparser.add_argument("--experiment-name", default="cifar_{sigma}", type=str)
+    # every run of the ladder is a subprocess writing under it, so there must be one
+    argparser.add_argument("--output-dir", type=str, default=os.getenv("PT_OUTPUT_DIR"),
+                           required=os.getenv("PT_OUTPUT_DIR") is None)
+    args, train_args = argparser.parse_known_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    sigmas = [float(s) for s in args.sigmas.split(",")]
+    anchor = args.anchor_sigma if args.anchor_sigma is not None else \
+             sorted(sigmas)[len(sigmas) // 2]
+    parity_sigmas = [float(s) for s in args.parity_sigmas.split(",") if s]
+
+    def run(sigma, experiment_name, num_epochs, init_from=None, lr=None):
+        """
+        Train one model with src.train, unless it has already finished.
+
+        Returns
+        -------
+        secs: wall-clock seconds spent training (about 0 if it had finished)
+        radii: radii of the held-out certified accuracy
+        cert_acc: held-out certified accuracy per radius, as saved by src.train
+        """
+        path = f"{args.output_dir}/{experiment_name}"
+        start = time.time()
+        if not os.path.exists(f"{path}/cert_acc_holdout.npy"):
+            cmd = [sys.executable, "-m", "src.train", *train_args,
+                   "--sigma", str(sigma),
+                   "--num-epochs", str(num_epochs),
+                   "--holdout-size", str(args.holdout_size),
+                   "--experiment-name", experiment_name,
+                   "--output-dir", args.output_dir]
+            if init_from is not None:
+                cmd += ["--init-from", init_from]
+            if lr is not None:
+                cmd += ["--lr", str(lr)]
+            logger.info(" ".join(cmd))
+            subprocess.run(cmd, check=True)
+        radii, cert_acc = np.load(f"{path}/cert_acc_holdout.npy")
+        return time.time() - start, radii, cert_acc
+
+    report = []
+    for sigma, init_sigma in ladder_order(sigmas, anchor):
+        name = args.experiment_name.format(sigma=sigma)
+        if init_sigma is None:
+            secs, radii, cert_acc = run(sigma, name, args.num_epochs)
+        else:
+            secs, radii, cert_acc = run(sigma, name, args.warm_epochs,
+                                        args.experiment_name.format(sigma=init_sigma),
+                                        args.warm_lr)
+        entry = {
+            "sigma": sigma,
+            "init_sigma": init_sigma,
+            "num_epochs": args.num_epochs if init_sigma is None else args.warm_epochs,
+            "secs": secs,
+            "radii": radii.tolist(),
+            "cert_acc": cert_acc.tolist(),
+        }
+        if sigma in parity_sigmas and init_sigma is not None:
+            secs, _, cert_acc_scratch = run(sigma, f"{name}_scratch", args.num_epochs)
+            entry.update(secs_scratch=secs, cert_acc_scratch=cert_acc_scratch.tolist(),
+                         cert_acc_gap=(cert_acc - cert_acc_scratch).tolist())
+        report.append(entry)
+
+    total_epochs = sum(entry["num_epochs"] for entry in report)
+    logger.info(f"Ladder epochs: {total_epochs}\t"
+                f"From scratch: {args.num_epochs * len(report)}\t"
+                f"Saved: {1 - total_epochs / (args.num_epochs * len(report)):.0%}")
+    for entry in report:
+        if "cert_acc_gap" in entry:
+            logger.info(f"Sigma: {entry['sigma']}\tWarm - scratch certified accuracy: " +
+                        "\t".join(f"{r}: {gap:+.3f}"
+                                  for r, gap in zip(entry["radii"], entry["cert_acc_gap"])))
+    report_path = f"{args.output_dir}/{args.experiment_name.format(sigma='ladder')}_report.json"
+    json.dump(report, open(report_path, "w"), indent=2)
@@ -0,0 +1,265 @@
+import logging
+import pathlib
+import pickle
+import os
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+from argparse import ArgumentParser, Namespace
+from torchnet import meter
+from torch.utils.data import DataLoader
+from src.models import *
+from src.noises import *
+from src.datasets import get_dataset, get_dim, InMemoryLoader
+from src.ensemble import StackedForecaster
+from src.utils import parse_noise_from_args, manual_seed_all
+
+
+class SweepTrainer(object):
+    """
+    Trains several models, one per (noise, sigma) configuration, on the same stream of
+    augmented batches. Each model has its own noise, optimizer and cosine schedule, and its
+    checkpoints, args.pkl and losses_train.npy are written exactly as src.train writes them.
+    """
+    def __init__(self, run_args, num_batches):
+        self.run_args = run_args
+        self.num_batches = num_batches
+        self.logger = logging.getLogger(__name__)
+        self.models, self.noises, self.optimizers, self.annealers = [], [], [], []
+        for args in run_args:
+            model = eval(args.model)(dataset=args.dataset, device=args.device)
+            model.train()
+            optimizer = optim.SGD(model.parameters(),
+                                  lr=args.lr,
+                                  momentum=0.9,
+                                  weight_decay=1e-4,
+                                  nesterov=True)
+            self.models.append(model)
+            self.optimizers.append(optimizer)
+            self.annealers.append(optim.lr_scheduler.CosineAnnealingLR(optimizer, args.num_epochs))
+            self.noises.append(parse_noise_from_args(args, device=args.device,
+                                                     dim=get_dim(args.dataset)))
+        self.loss_meters = [meter.AverageValueMeter() for _ in run_args]
+        self.time_meter = meter.TimeMeter(unit=False)
+        self.train_losses = [[] for _ in run_args]
+        self.epoch, self.itr = 0, 0
+
+    def step(self, x, y):
+        for args, model, noise, optimizer, loss_meter, train_losses in zip(
+                self.run_args, self.models, self.noises, self.optimizers, self.loss_meters,
+                self.train_losses):
+            x_noisy = noise.sample(x.view(len(x), -1)).view(x.shape)
+            loss = model.loss(x_noisy, y).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            loss_meter.add(loss.cpu().data.numpy(), n=1)
+
+            if self.itr % args.print_every == 0:
+                self.logger.info(f"Epoch: {self.epoch}\t"
+                                 f"Itr: {self.itr} / {self.num_batches}\t"
+                                 f"Loss: {loss_meter.value()[0]:.2f}\t"
+                                 f"Mins: {(self.time_meter.value() / 60):.2f}\t"
+                                 f"Experiment: {args.experiment_name}")
+                train_losses.append(loss_meter.value()[0])
+                loss_meter.reset()
+        self.itr += 1
+
+    def end_epoch(self):
+        for args, model, annealer in zip(self.run_args, self.models, self.annealers):
+            if (self.epoch + 1) % args.save_every == 0:
+                save_path = f"{args.output_dir}/{args.experiment_name}/{self.epoch}/"
+                pathlib.Path(save_path).mkdir(parents=True, exist_ok=True)
+                torch.save(model.state_dict(), f"{save_path}/model_ckpt.torch")
+            annealer.step()
+        self.epoch, self.itr = self.epoch + 1, 0
+
+    def finish(self):
+        for args, model, train_losses in zip(self.run_args, self.models, self.train_losses):
+            pathlib.Path(f"{args.output_dir}/{args.experiment_name}").mkdir(parents=True, exist_ok=True)
+            save_path = f"{args.output_dir}/{args.experiment_name}/model_ckpt.torch"
+            torch.save(model.state_dict(), save_path)
+            args_path = f"{args.output_dir}/{args.experiment_name}/args.pkl"
+            pickle.dump(args, open(args_path, "wb"))
+            save_path = f"{args.output_dir}/{args.experiment_name}/losses_train.npy"
+            np.save(save_path, np.array(train_losses))
+
+
+class StackedSweepTrainer(SweepTrainer):
+    """
+    SweepTrainer for small models (LinearModel, MLP, LeNet) that stacks the parameters of all
+    runs and trains them with one vmapped forward and backward pass per batch. All runs must share
+    the model, learning rate and number of epochs; they differ in noise and sigma.
+
+    Stacking saves the per-model overhead of a step (operator dispatch, optimizer), not
+    arithmetic, so it only helps where that overhead is a sizeable part of the step: on one CPU
+    core a step is 1.3-2.7x faster than the loop of SweepTrainer for LinearModel and MLP, while
+    LeNet only gains at small batches and is slower at batch size 64, where its vmapped
+    convolutions dominate. Measure with examples/ex_stacked_sweep_benchmark.py before using it.
+    """
+    def __init__(self, run_args, num_batches):
+        super().__init__(run_args, num_batches)
+        args = run_args[0]
+        self.stacked = StackedForecaster(self.models)
+        # the fused update avoids the temporaries of the unfused one, which are as large as all
+        # K models' parameters together
+        optimizer = optim.SGD(self.stacked.parameters(),
+                              lr=args.lr,
+                              momentum=0.9,
+                              weight_decay=1e-4,
+                              nesterov=True,
+                              fused=True)
+        self.optimizers = [optimizer]
+        self.annealers = [optim.lr_scheduler.CosineAnnealingLR(optimizer, args.num_epochs)]
+
+    def step(self, x, y):
+        x_noisy = torch.stack([noise.sample(x.view(len(x), -1)).view(x.shape)
+                               for noise in self.noises])
+        losses = self.stacked.loss(x_noisy, y).mean(dim=1)
+        self.optimizers[0].zero_grad()
+        losses.sum().backward()
+        self.optimizers[0].step()
+
+        losses = losses.detach()
+        for args, loss, loss_meter, train_losses in zip(self.run_args, losses, self.loss_meters,
+                                                        self.train_losses):
+            loss_meter.add(float(loss), n=1)
+            if self.itr % args.print_every == 0:
+                self.logger.info(f"Epoch: {self.epoch}\t"
+                                 f"Itr: {self.itr} / {self.num_batches}\t"
+                                 f"Loss: {loss_meter.value()[0]:.2f}\t"
+                                 f"Mins: {(self.time_meter.value() / 60):.2f}\t"
+                                 f"Experiment: {args.experiment_name}")
+                train_losses.append(float(loss_meter.value()[0]))
+                loss_meter.reset()
+        self.itr += 1
+
+    def end_epoch(self):
+        self.stacked.unstack()
+        for args, model in zip(self.run_args, self.models):
+            if (self.epoch + 1) % args.save_every == 0:
+                save_path = f"{args.output_dir}/{args.experiment_name}/{self.epoch}/"
+                pathlib.Path(save_path).mkdir(parents=True, exist_ok=True)
+                torch.save(model.state_dict(), f"{save_path}/model_ckpt.torch")
+        self.annealers[0].step()
+        self.epoch, self.itr = self.epoch + 1, 0
+
+    def finish(self):
+        self.stacked.unstack()
+        super().finish()
+
+
+def sweep_worker(run_args, num_batches, queue, num_threads, trainer_cls=SweepTrainer, seed=None):
+    """
+    Process-group member: trains its share of the sweep on batches received through queue.
+    Batches are passed as shared-memory tensors, so they are decoded and augmented only once.
+    """
+    logging.basicConfig(level=logging.INFO)
+    torch.set_num_threads(num_threads)
+    if seed is not None:
+        manual_seed_all(seed)
+    trainer = trainer_cls(run_args, num_batches)
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        elif item == "end_epoch":
+            trainer.end_epoch()
+        else:
+            x, y = item
+            trainer.step(x.to(trainer.run_args[0].device), y.to(trainer.run_args[0].device))
+    trainer.finish()
+
+
+if __name__ == "__main__":
+
+    argparser = ArgumentParser()
+    argparser.add_argument("--device", default="cuda", type=str)
+    argparser.add_argument("--lr", default=0.1, type=float)
+    argparser.add_argument("--batch-size", default=64, type=int)
+    argparser.add_argument("--num-workers", default=min(os.cpu_count(), 8), type=int)
+    argparser.add_argument("--num-epochs", default=120, type=int)
+    argparser.add_argument("--print-every", default=20, type=int)
+    argparser.add_argument("--save-every", default=50, type=int)
+    argparser.add_argument("--experiment-name", default="cifar_{noise}_{sigma}", type=str)
+    argparser.add_argument("--noises", default="UniformNoise,GaussianNoise,LaplaceNoise", type=str)
+    argparser.add_argument("--sigmas", default="0.15,0.25,0.5,0.75,1.0,1.25,1.5,1.75,2.0,"
+                                                "2.25,2.5,2.75,3.0,3.25,3.5", type=str)
+    argparser.add_argument("--k", default=None, type=int)
+    argparser.add_argument("--j", default=None, type=int)
+    argparser.add_argument("--a", default=None, type=int)
+    argparser.add_argument("--model", default="ResNet", type=str)
+    argparser.add_argument("--dataset", default="cifar", type=str)
+    argparser.add_argument("--fast-data", action="store_true")
+    argparser.add_argument("--num-procs", default=1, type=int)
+    argparser.add_argument("--stacked", action="store_true")
+    argparser.add_argument("--seed", default=None, type=int)
+    argparser.add_argument('--output-dir', type=str, default=os.getenv("PT_OUTPUT_DIR"))
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.seed is not None:
+        manual_seed_all(args.seed)
+
+    # one args Namespace per run, interchangeable with the ones src.train saves
+    run_args = []
+    for noise_str in args.noises.split(","):
+        for sigma in args.sigmas.split(","):
+            run_args.append(Namespace(**dict(vars(args),
+                                             noise=noise_str,
+                                             sigma=float(sigma),
+                                             lambd=None,
+                                             adv=2,
+                                             eps=0.0,
+                                             adversarial=False,
+                                             stability=False,
+                                             direct=False,
+                                             experiment_name=args.experiment_name.format(
+                                                 noise=noise_str, sigma=sigma))))
+
+    if args.fast_data:
+        train_loader = InMemoryLoader(args.dataset, "train",
+                                      shuffle=True,
+                                      batch_size=args.batch_size)
+    else:
+        train_loader = DataLoader(get_dataset(args.dataset, "train"),
+                                  shuffle=True,
+                                  batch_size=args.batch_size,
+                                  num_workers=args.num_workers,
+                                  pin_memory=False)
+
+    trainer_cls = StackedSweepTrainer if args.stacked else SweepTrainer
+
+    if args.num_procs == 1:
+        trainer = trainer_cls(run_args, len(train_loader))
+        for epoch in range(args.num_epochs):
+            for x, y in train_loader:
+                trainer.step(x.to(args.device), y.to(args.device))
+            trainer.end_epoch()
+        trainer.finish()
+
+    else:
+        ctx = mp.get_context("spawn")
+        queues, procs = [], []
+        num_threads = max(1, torch.get_num_threads() // args.num_procs)
+        for rank in range(args.num_procs):
+            queue = ctx.Queue(maxsize=4)
+            proc = ctx.Process(target=sweep_worker,
+                               args=(run_args[rank::args.num_procs], len(train_loader), queue,
+                                     num_threads, trainer_cls,
+                                     None if args.seed is None else args.seed + rank))
+            proc.start()
+            queues.append(queue)
+            procs.append(proc)
+        for epoch in range(args.num_epochs):
+            for x, y in train_loader:
+                x, y = x.share_memory_(), y.share_memory_()
+                for queue in queues:
+                    queue.put((x, y))
+            for queue in queues:
+                queue.put("end_epoch")
+        for queue in queues:
+            queue.put(None)
+        for proc in procs:
+            proc.join()
@@ -1,4 +1,9 @@
+import json
+import os
+import random
 import re
+import time
+from collections import defaultdict
 from src.noises import *
 
 
@@ -21,3 +26,95 @@ def parse_noise_from_args(args, device, dim):
     kwargs = {k: v for k, v in kwargs.items() if v is not None}
     return eval(args.noise)(device=device, dim=dim, **kwargs)
 
+def get_rng_states():
+    """
+    Snapshot of every random number generator that training draws from.
+    """
+    states = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+def set_rng_states(states):
+    torch.set_rng_state(states["torch"])
+    np.random.set_state(states["numpy"])
+    random.setstate(states["random"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+def manual_seed_all(seed):
+    """
+    Seed torch and numpy, which the scipy-backed noises draw from, so that a recorded seed
+    reproduces the noise of every noise distribution (also in DataLoader workers, see
+    seed_noise_worker).
+    """
+    torch.manual_seed(int(seed))
+    np.random.seed(int(seed) % 2 ** 32)
+
+def derive_seed(seed, *keys):
+    """
+    Seed of a noise stream derived from seed and keys (strings or integers, e.g. a stage and a
+    cascade tier), independent of the stream of seed itself and of those with other keys.
+    """
+    keys = [int.from_bytes(key.encode(), "little") if isinstance(key, str) else int(key)
+            for key in keys]
+    return int(np.random.SeedSequence([int(seed)] + keys).generate_state(1, np.uint64)[0])
+
+def save_atomic(obj, path):
+    """
+    torch.save that never leaves a partially written file behind if interrupted.
+    """
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def has_plateaued(losses, patience, min_delta):
+    """
+    Whether none of the last patience losses improved on the best loss before them by a
+    relative margin of more than min_delta.
+    """
+    if len(losses) <= patience:
+        return False
+    return min(losses[-patience:]) > min(losses[:-patience]) * (1 - min_delta)
+
+def compress_lr_schedule(optimizer, epoch, end_epoch):
+    """
+    Cosine schedule replacing the optimizer's at the end of epoch, annealing from the current
+    learning rate to zero at end_epoch, as the schedule over the full run reaches zero once its
+    last epoch has been trained.
+    """
+    for group in optimizer.param_groups:
+        group["initial_lr"] = group["lr"]
+    return torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, end_epoch - epoch)
+
+
+class PhaseTimer(object):
+    """
+    Accumulates wall-clock seconds spent in named phases of a loop, where each call to mark()
+    charges the time since the previous mark to the given phase. Timings are taken on the host
+    without synchronising the device, so on GPU they measure time until work is queued and the
+    wait shows up in whichever phase next reads a result back.
+    """
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.totals[phase] += now - self.last
+        self.last = now
+
+    def pop(self):
+        totals, self.totals = dict(self.totals), defaultdict(float)
+        return totals
+
+
+def append_jsonl(path, record):
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
@@ -25,6 +25,14 @@ if __name__ == "__main__":
     argparser.add_argument("--a", default=None, type=int)
     argparser.add_argument("--lambd", default=None, type=float)
     argparser.add_argument("--adv", default=2, type=int)
+    argparser.add_argument("--eps-range", default="3.0,2.0,1.0,0.5,0.25", type=str)
+    argparser.add_argument("--steps", default=20, type=int)
+    argparser.add_argument("--warm-start", action="store_true")
+    argparser.add_argument("--warm-steps", default=10, type=int)
+    argparser.add_argument("--restarts", default=1, type=int)
+    argparser.add_argument("--early-stop", action="store_true")
+    argparser.add_argument("--attack-sample-size", default=128, type=int)
+    argparser.add_argument("--attack-sample-size-min", default=None, type=int)
     argparser.add_argument("--experiment-name", default="cifar", type=str)
     argparser.add_argument("--dataset", default="cifar", type=str)
     argparser.add_argument("--model", default="ResNet", type=str)
@@ -42,21 +50,29 @@ if __name__ == "__main__":
 
     noise = parse_noise_from_args(args, device=args.device, dim=get_dim(args.dataset))
 
-    eps_range = (3.0, 2.0, 1.0, 0.5, 0.25)
+    eps_range = tuple(float(eps) for eps in args.eps_range.split(","))
 
     results = {f"preds_adv_{eps}": np.zeros((len(test_dataset), 10)) for eps in eps_range}
+    results.update({f"steps_used_{eps}": np.zeros(len(test_dataset)) for eps in eps_range})
 
     for i, (x, y) in tqdm(enumerate(test_loader), total=len(test_loader)):
 
         x, y = x.to(args.device), y.to(args.device)
         lower, upper = i * args.batch_size, (i + 1) * args.batch_size
 
-        for eps in eps_range:
-            x_adv, _ = pgd_attack_smooth(model, x, y, eps=eps, noise=noise, sample_size=128,
-                                         steps=20, p=args.adv, clamp=(0, 1))
-            preds_adv = smooth_predict_hard(model, x_adv, noise, args.sample_size_pred,
-                                            args.noise_batch_size)
-            results[f"preds_adv_{eps}"][lower:upper, :] = preds_adv.probs.data.cpu().numpy()
+        # all radii are attacked in one batched run, and predicted on in one batch
+        x_advs, steps_used = pgd_attack_smooth_multi_eps(
+            model, x, y, eps_range, noise, sample_size=args.attack_sample_size,
+            steps=args.steps, adv=args.adv, clamp=(0, 1), warm_start=args.warm_start,
+            warm_steps=args.warm_steps, restarts=args.restarts, early_stop=args.early_stop,
+            return_steps=True, noise_batch_size=args.noise_batch_size,
+            sample_size_min=args.attack_sample_size_min)
+        preds_adv = smooth_predict_hard(model, torch.cat(x_advs), noise, args.sample_size_pred,
+                                        args.noise_batch_size).probs.data.cpu().numpy()
+        for eps, x_adv, preds, steps in zip(eps_range, x_advs,
+                                            np.split(preds_adv, len(eps_range)), steps_used):
+            results[f"preds_adv_{eps}"][lower:upper, :] = preds
+            results[f"steps_used_{eps}"][lower:upper] = steps.cpu().numpy()
             assert ((x - x_adv).reshape(x.shape[0], -1).norm(dim=1, p=args.adv) <= eps + 1e-2).all()
 
     save_path = f"{args.output_dir}/{args.experiment_name}"